@@ -1,18 +1,49 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, asdict
-from datetime import datetime
-from typing import List, Dict, Any, Optional
-
-from flask import Flask, jsonify, request, send_from_directory, render_template
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Union
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from flask import Flask, Response, jsonify, request, send_from_directory, render_template
+from flask.json.provider import DefaultJSONProvider
 import csv
-from sqlalchemy import create_engine, Column, String, Integer, Text, DateTime, text, func
-from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session
+from sqlalchemy import create_engine, Column, String, Integer, Text, Date, DateTime, LargeBinary, Index, text, func, literal, and_, or_, case, delete, select, insert, update, union_all, inspect, bindparam
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session, load_only
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
+try:
+    import orjson  # Codificador JSON rápido (opcional)
+except ImportError:
+    orjson = None
+try:
+    import openpyxl  # Exportación a Excel (opcional, ver INSTALAR_OPENPYXL.md)
+except ImportError:
+    openpyxl = None
+try:
+    import numpy as np  # Analítica vectorizada (opcional, ver /api/reportes/analitica)
+except ImportError:
+    np = None
+import base64
+import codecs
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import operator
 import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
 import uuid
 
 
@@ -41,6 +72,14 @@ except Exception:
 
 Base = declarative_base()
 
+# Valor de LibroDB.imagen mientras la portada se genera en segundo plano (ver renderizar_portadas_pendientes).
+# Es una URL válida: las vistas muestran el placeholder hasta que llega la portada. Un worker que toma
+# un lote lo marca con PORTADA_EN_CURSO + '<AAAAMMDDhhmmss>-<dueño>', que sigue siendo el placeholder.
+PORTADA_PENDIENTE = '/static/img/placeholder-book.svg?pendiente=1'
+PORTADA_EN_CURSO = PORTADA_PENDIENTE + '&lote='
+# Condición del índice parcial de portadas; las consultas la repiten literal para que el planificador lo use
+CONDICION_PORTADA_PENDIENTE = f"imagen LIKE '{PORTADA_PENDIENTE}%'"
+
 
 class LibroDB(Base):
     __tablename__ = "libros"
@@ -60,15 +99,35 @@ class LibroDB(Base):
     cantidad_prestado = Column(Integer, default=0)
     imagen = Column(String(512), nullable=True)
     codigo_inventario = Column(String(128), nullable=True)  # Para equipos: ej. Portátil A1
+    clave_grupo = Column(String(768), nullable=True)  # Clave de agrupación de copias (ver clave_grupo())
     creado_en = Column(DateTime, nullable=False)
     actualizado_en = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        Index('idx_libros_clave_grupo', 'clave_grupo'),
+        # Filtros del catálogo (/api/libros) y paginación por cursor (orden, id)
+        Index('idx_libros_categoria_subcategoria', 'categoria', 'subcategoria'),
+        Index('idx_libros_categoria_creado_en', 'categoria', 'creado_en', 'id'),
+        Index('idx_libros_estado_elemento', 'estado_elemento'),
+        Index('idx_libros_codigo_inv', 'codigo_inventario'),
+        Index('idx_libros_creado_en_id', 'creado_en', 'id'),
+        Index('idx_libros_actualizado_en_id', 'actualizado_en', 'id'),
+        Index('idx_libros_titulo_id', 'titulo', 'id'),
+        # Portadas pendientes o en curso (parcial: solo las filas con el placeholder)
+        Index(
+            'idx_libros_portada_pendiente', 'imagen', 'id',
+            postgresql_where=text(CONDICION_PORTADA_PENDIENTE),
+            sqlite_where=text(CONDICION_PORTADA_PENDIENTE),
+        ),
+    )
+
 
 class PrestamoDB(Base):
     __tablename__ = "prestamos"
     id = Column(String(64), primary_key=True)
     id_elemento = Column(String(64), nullable=False)
-    id_usuario = Column(String(128), nullable=True)  # requerido para equipos, opcional para libros
+    id_usuario = Column(String(128), nullable=True)  # UserDB.id; requerido para equipos, opcional para libros
+    usuario_original = Column(String(128), nullable=True)  # ID, documento o username tal como se recibió
     fecha_prestamo = Column(DateTime, nullable=False)
     fecha_devolucion = Column(DateTime, nullable=True)
     observaciones = Column(Text, nullable=True)
@@ -76,6 +135,15 @@ class PrestamoDB(Base):
     creado_en = Column(DateTime, nullable=False)
     actualizado_en = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        # Préstamos de un usuario (/prestamos?usuario=, resumen de "mi cuenta") ya ordenados
+        Index('idx_prestamos_usuario_creado_en', 'id_usuario', 'creado_en', 'id'),
+        Index('idx_prestamos_estado_fecha_devolucion', 'estado', 'fecha_devolucion'),
+        # Listado de /prestamos por estado y paginación por cursor (creado_en, id)
+        Index('idx_prestamos_estado_creado_en', 'estado', 'creado_en', 'id'),
+        Index('idx_prestamos_creado_en_id', 'creado_en', 'id'),
+    )
+
 
 class UserDB(Base):
     __tablename__ = "usuarios"
@@ -89,12 +157,19 @@ class UserDB(Base):
     creado_en = Column(DateTime, nullable=False)
     actualizado_en = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        Index('idx_usuarios_documento', 'documento'),
+        Index('idx_usuarios_creado_en', 'creado_en'),
+    )
+
 
 class MensajeDB(Base):
     __tablename__ = "mensajes"
     id = Column(String(64), primary_key=True)
     id_remitente = Column(String(64), nullable=False)  # ID usuario que envía
     id_destinatario = Column(String(64), nullable=False)  # 'admin' o ID usuario
+    remitente_original = Column(String(128), nullable=True)  # Identificadores tal como se recibieron
+    destinatario_original = Column(String(128), nullable=True)
     asunto = Column(String(255), nullable=True)
     contenido = Column(Text, nullable=False)
     leido = Column(Integer, nullable=False, default=0)  # 0=no leído, 1=leído
@@ -103,26 +178,45 @@ class MensajeDB(Base):
     creado_en = Column(DateTime, nullable=False)
     actualizado_en = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        Index('idx_mensajes_id_remitente', 'id_remitente'),
+        Index('idx_mensajes_id_destinatario', 'id_destinatario'),
+    )
+
 
 class WaitlistDB(Base):
     __tablename__ = "waitlist"
     id = Column(String(64), primary_key=True)
     id_elemento = Column(String(64), nullable=False)
-    id_usuario = Column(String(64), nullable=True)
+    id_usuario = Column(String(64), nullable=True)  # UserDB.id cuando el usuario está registrado
+    usuario_original = Column(String(128), nullable=True)
     contacto = Column(String(255), nullable=True)  # correo o documento
-    estado = Column(String(32), nullable=False)  # pendiente, notificado
+    estado = Column(String(32), nullable=False)  # pendiente, notificado, atendido, expirado
+    reservado_hasta = Column(DateTime, nullable=True)  # Unidad apartada para esta solicitud hasta esta fecha
     creado_en = Column(DateTime, nullable=False)
     actualizado_en = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        Index('idx_waitlist_id_usuario', 'id_usuario'),
+        # Cabeza de la cola de cada elemento y barrido de reservas vencidas
+        Index('idx_waitlist_elemento_estado_creado_id', 'id_elemento', 'estado', 'creado_en', 'id'),
+        Index('idx_waitlist_estado_reservado', 'estado', 'reservado_hasta'),
+    )
+
 
 class FavoritoDB(Base):
     __tablename__ = "favoritos"
     id = Column(String(64), primary_key=True)
-    id_usuario = Column(String(64), nullable=False)
+    id_usuario = Column(String(64), nullable=False)  # UserDB.id
+    usuario_original = Column(String(128), nullable=True)
     id_elemento = Column(String(64), nullable=False)
     creado_en = Column(DateTime, nullable=False)
     actualizado_en = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        Index('idx_favoritos_usuario_elemento', 'id_usuario', 'id_elemento'),
+    )
+
 
 class SancionTipoDB(Base):
     __tablename__ = "sancion_tipo"
@@ -151,6 +245,13 @@ class SancionDB(Base):
     creado_en = Column(DateTime, nullable=False)
     actualizado_en = Column(DateTime, nullable=False)
 
+    __table_args__ = (
+        # Reportes por rango de fechas (/api/reportes/*)
+        Index('idx_sanciones_creado_en', 'creado_en'),
+        Index('idx_sanciones_usuario_creado_en', 'id_usuario', 'creado_en'),
+        Index('idx_sanciones_estado_creado_en', 'estado', 'creado_en'),
+    )
+
 
 class SancionCausaDB(Base):
     __tablename__ = "sancion_causa"
@@ -162,6 +263,81 @@ class SancionCausaDB(Base):
     actualizado_en = Column(DateTime, nullable=False)
 
 
+class LibroGrupoDB(Base):
+    """Grupos de copias del mismo elemento, con totales materializados (ver recalcular_grupos)"""
+    __tablename__ = "libro_grupo"
+    clave = Column(String(768), primary_key=True)  # Igual a LibroDB.clave_grupo
+    id_representativo = Column(String(64), nullable=False)  # Copia con menor id del grupo
+    stock = Column(Integer, nullable=False, default=0)
+    cantidad_disponible = Column(Integer, nullable=False, default=0)
+    cantidad_prestado = Column(Integer, nullable=False, default=0)
+    copias = Column(Integer, nullable=False, default=0)
+    actualizado_en = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('idx_libro_grupo_representativo', 'id_representativo'),
+    )
+
+
+class VersionDatosDB(Base):
+    """Contadores de versión por conjunto de datos (p. ej. 'catalogo'), compartidos por todos los workers"""
+    __tablename__ = "version_datos"
+    nombre = Column(String(64), primary_key=True)
+    valor = Column(Integer, nullable=False, default=0)
+    actualizado_en = Column(DateTime, nullable=False)
+
+
+class PrestamoVencidoDB(Base):
+    """Préstamos aprobados con la fecha de devolución vencida (ver revisar_prestamos_vencidos)"""
+    __tablename__ = "prestamo_vencido"
+    id_prestamo = Column(String(64), primary_key=True)
+    id_usuario = Column(String(128), nullable=True)
+    id_elemento = Column(String(64), nullable=False)
+    fecha_devolucion = Column(DateTime, nullable=False)
+    id_sancion = Column(String(64), nullable=True)  # Sanción creada automáticamente, si hay causa configurada
+    detectado_en = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('idx_prestamo_vencido_fecha', 'fecha_devolucion'),
+    )
+
+
+class EstadisticaPrestamoDiaDB(Base):
+    """
+    Rollup diario de préstamos: cuántos préstamos creados ese día están en cada estado, por categoría.
+    'usuarios' guarda un sketch HyperLogLog de los usuarios (ver hll_estimar).
+    """
+    __tablename__ = "estadistica_prestamo_dia"
+    fecha = Column(Date, primary_key=True)  # Día de creación del préstamo (UTC)
+    categoria = Column(String(120), primary_key=True)
+    estado = Column(String(32), primary_key=True)
+    cantidad = Column(Integer, nullable=False, default=0)
+    usuarios = Column(LargeBinary, nullable=True)
+    actualizado_en = Column(DateTime, nullable=False)
+
+
+class MarcaProcesoDB(Base):
+    """Marca de agua de procesos incrementales (hasta qué fecha se revisó)"""
+    __tablename__ = "marca_proceso"
+    nombre = Column(String(64), primary_key=True)
+    marca = Column(DateTime, nullable=False)
+    actualizado_en = Column(DateTime, nullable=False)
+
+
+class ImportacionCSVDB(Base):
+    """Progreso de una importación CSV: filas ya confirmadas, para reanudar tras un fallo"""
+    __tablename__ = "importacion_csv"
+    id = Column(String(40), primary_key=True)  # sha1 del primer bloque y del tamaño del archivo
+    nombre_archivo = Column(String(255), nullable=True)
+    filas_confirmadas = Column(Integer, nullable=False, default=0)
+    creados = Column(Integer, nullable=False, default=0)
+    actualizados = Column(Integer, nullable=False, default=0)
+    estado = Column(String(16), nullable=False, default='en_curso')  # en_curso / error / completa
+    error = Column(Text, nullable=True)
+    creado_en = Column(DateTime, nullable=False)
+    actualizado_en = Column(DateTime, nullable=False)
+
+
 class LibroHistorialDB(Base):
     """Tabla de historial para mantener trazabilidad de libros eliminados"""
     __tablename__ = "libro_historial"
@@ -198,6 +374,17 @@ else:
 SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False))
 
 
+def insert_dialecto(tabla):
+    """insert() de PostgreSQL o SQLite (admite on_conflict_do_nothing / on_conflict_do_update); None en otros motores"""
+    if engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as insertar
+    elif engine.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as insertar
+    else:
+        return None
+    return insertar(tabla)
+
+
 def now_iso() -> str:
     return datetime.utcnow().isoformat() + 'Z'
 
@@ -225,6 +412,214 @@ def parse_iso_datetime(value: Any) -> Optional[datetime]:
     return None
 
 
+def arg_bool(nombre: str) -> Optional[bool]:
+    """Leer un parámetro booleano de la query string ('true'/'1'/'si' o 'false'/'0'/'no')."""
+    valor = (request.args.get(nombre) or '').strip().lower()
+    if valor in ('1', 'true', 'si', 'sí', 'yes'):
+        return True
+    if valor in ('0', 'false', 'no'):
+        return False
+    return None
+
+
+def codificar_cursor(valor: Any, ultimo_id: str) -> str:
+    """Cursor opaco para paginación keyset: (valor de la columna de orden, id del último elemento)."""
+    if isinstance(valor, datetime):
+        valor = valor.isoformat()
+    payload = json.dumps([valor, ultimo_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(cursor: str, *, es_fecha: bool = False) -> Optional[tuple[Any, str]]:
+    """Inverso de codificar_cursor. Retorna None si el cursor no es válido."""
+    try:
+        relleno = '=' * (-len(cursor) % 4)
+        valor, ultimo_id = json.loads(base64.urlsafe_b64decode(cursor + relleno).decode('utf-8'))
+    except Exception:
+        return None
+    if es_fecha:
+        valor = parse_iso_datetime(valor)
+        if valor is None:
+            return None
+    return valor, str(ultimo_id)
+
+
+# -------------------------------
+# Serialización JSON
+# -------------------------------
+# Las respuestas se codifican con orjson cuando está instalado (json estándar si no), sin ordenar
+# claves. Las fechas naive (UTC) se emiten como '2024-01-01T10:00:00Z', igual que isoformat() + 'Z',
+# por lo que los esquemas pasan los datetime sin convertir y el codificador hace el trabajo.
+
+
+def _json_default(valor: Any) -> Any:
+    if isinstance(valor, datetime):
+        return valor.isoformat() + 'Z' if valor.tzinfo is None else valor.isoformat()
+    if isinstance(valor, date):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return int(valor) if valor == valor.to_integral_value() else float(valor)
+    if isinstance(valor, (set, frozenset)):
+        return list(valor)
+    raise TypeError(f"Objeto de tipo {type(valor).__name__} no serializable a JSON")
+
+
+if orjson is not None:
+    _OPCIONES_ORJSON = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS
+
+    def json_bytes(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_json_default, option=_OPCIONES_ORJSON)
+else:
+    def json_bytes(obj: Any) -> bytes:
+        return json.dumps(obj, default=_json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class ProveedorJSON(DefaultJSONProvider):
+    """Proveedor JSON de Flask que usa json_bytes: jsonify() de todas las rutas pasa por aquí."""
+    sort_keys = False
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return json_bytes(obj).decode('utf-8')
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_bytes(obj), mimetype=self.mimetype)
+
+
+app.json = ProveedorJSON(app)
+
+
+class EsquemaJSON:
+    """
+    Serializador precompilado de un modelo: lee una lista fija de atributos con un único
+    operator.attrgetter y arma el dict listo para json_bytes.
+    Los atributos 'opcionales' se leen con getattr(obj, campo, None) (columnas agregadas por migración).
+    """
+
+    def __init__(self, campos: Iterable[str], opcionales: Iterable[str] = ()):
+        self.campos = tuple(campos)
+        self.opcionales = tuple(opcionales)
+        self._leer = operator.attrgetter(*self.campos) if len(self.campos) > 1 else None
+        self._proyecciones: Dict[tuple[str, ...], EsquemaJSON] = {}
+
+    def __call__(self, obj: Any) -> Dict[str, Any]:
+        if self._leer is not None:
+            item = dict(zip(self.campos, self._leer(obj)))
+        else:
+            item = {campo: getattr(obj, campo) for campo in self.campos}
+        for campo in self.opcionales:
+            item[campo] = getattr(obj, campo, None)
+        return item
+
+    def proyectar(self, campos: Iterable[str]) -> 'EsquemaJSON':
+        """Esquema con solo los campos indicados (se compila una vez por combinación)."""
+        clave = tuple(c for c in self.campos + self.opcionales if c in set(campos))
+        esquema = self._proyecciones.get(clave)
+        if esquema is None:
+            esquema = EsquemaJSON(
+                [c for c in clave if c in self.campos],
+                [c for c in clave if c in self.opcionales],
+            )
+            self._proyecciones[clave] = esquema
+        return esquema
+
+
+ESQUEMA_LIBRO = EsquemaJSON([
+    'id', 'titulo', 'autor', 'isbn', 'editorial', 'anio_publicacion', 'categoria', 'subcategoria',
+    'descripcion', 'estado_disponibilidad', 'estado_elemento', 'stock', 'cantidad_disponible',
+    'cantidad_prestado', 'imagen', 'codigo_inventario', 'creado_en', 'actualizado_en',
+])
+ESQUEMA_PRESTAMO = EsquemaJSON([
+    'id', 'id_elemento', 'id_usuario', 'fecha_prestamo', 'fecha_devolucion', 'observaciones',
+    'estado', 'creado_en', 'actualizado_en',
+])
+ESQUEMA_USUARIO = EsquemaJSON(
+    ['id', 'nombre', 'documento', 'correo', 'username', 'role', 'creado_en'],
+    opcionales=['numero_ficha', 'telefono', 'direccion', 'tipo_usuario', 'tipo_documento'],
+)
+ESQUEMA_MENSAJE = EsquemaJSON([
+    'id', 'id_remitente', 'id_destinatario', 'asunto', 'contenido', 'leido', 'relacionado_con',
+    'tipo', 'creado_en',
+])
+ESQUEMA_SANCION = EsquemaJSON([
+    'id', 'tipo_id', 'id_usuario', 'id_prestamo', 'causa_id', 'observaciones', 'estado',
+    'fecha_inicio', 'fecha_fin', 'resuelto_en', 'usuario_registro', 'creado_en', 'actualizado_en',
+])
+ESQUEMA_ESPERA = EsquemaJSON(['id', 'id_elemento', 'id_usuario', 'contacto', 'estado', 'reservado_hasta', 'creado_en'])
+ESQUEMA_FAVORITO = EsquemaJSON(['id', 'id_usuario', 'id_elemento', 'creado_en'])
+ESQUEMA_SANCION_TIPO = EsquemaJSON(['id', 'codigo', 'descripcion', 'usuario_creacion', 'creado_en', 'actualizado_en'])
+ESQUEMA_SANCION_CAUSA = EsquemaJSON(['id', 'tipo_id', 'nombre', 'descripcion', 'creado_en', 'actualizado_en'])
+
+
+# -------------------------------
+# Respuestas JSON en streaming
+# -------------------------------
+# Los listados completos se envían como un arreglo JSON generado por lotes desde un cursor del
+# servidor (yield_per), de modo que la memoria del worker no crece con el tamaño del resultado.
+
+LOTE_STREAM_JSON = int(os.environ.get('LOTE_STREAM_JSON', '1000'))
+# Tamaño máximo de una respuesta en streaming que se conserva para la caché del catálogo
+MAX_BYTES_CACHE_STREAM = int(os.environ.get('MAX_BYTES_CACHE_STREAM', str(8 * 1024 * 1024)))
+
+
+def serializar_con(esquema: EsquemaJSON) -> Callable[[Any, list], List[Dict[str, Any]]]:
+    """Serializador de lotes que solo aplica un esquema a cada fila"""
+    return lambda db, filas: [esquema(fila) for fila in filas]
+
+
+def respuesta_json_stream(
+    construir_consulta: Callable[[Any], Any],
+    serializar_lote: Callable[[Any, list], List[Dict[str, Any]]],
+    *,
+    lote: Optional[int] = None,
+    guardar: Optional[Callable[[bytes], None]] = None,
+) -> Response:
+    """
+    Responde un arreglo JSON leyendo la consulta por lotes.
+
+    - construir_consulta(db) devuelve la Query a recorrer; se ejecuta dentro del generador, con una
+      sesión propia que se cierra al terminar (o si el cliente corta la conexión).
+    - serializar_lote(db, filas) convierte cada lote en una lista de dicts (puede consultar datos
+      relacionados del lote completo).
+    - guardar(contenido), si se indica, recibe la respuesta completa cuando no supera MAX_BYTES_CACHE_STREAM.
+    """
+    lote = lote or LOTE_STREAM_JSON
+
+    def generar() -> Iterator[bytes]:
+        db = SessionLocal()
+        partes: Optional[List[bytes]] = [] if guardar is not None else None
+        tamano = 0
+        try:
+            filas_iter = iter(construir_consulta(db).yield_per(lote))
+            separador = b'['
+            while True:
+                filas = list(islice(filas_iter, lote))
+                if not filas:
+                    break
+                cuerpo = json_bytes(serializar_lote(db, filas))[1:-1]
+                del filas
+                if not cuerpo:
+                    continue
+                fragmento = separador + cuerpo
+                separador = b','
+                if partes is not None:
+                    tamano += len(fragmento)
+                    if tamano <= MAX_BYTES_CACHE_STREAM:
+                        partes.append(fragmento)
+                    else:
+                        partes = None
+                yield fragmento
+            cierre = b'[]' if separador == b'[' else b']'
+            if partes is not None:
+                partes.append(cierre)
+                guardar(b''.join(partes))
+            yield cierre
+        finally:
+            db.close()
+
+    return Response(generar(), mimetype='application/json')
+
+
 def _load_font(size: int, *, bold: bool = False) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
     """Intentar cargar una fuente TrueType común; si falla, usar la fuente por defecto."""
     candidate_paths = [
@@ -438,7 +833,7 @@ def generar_portada(nombre_libro: str, autor: str = "", output_path: Optional[st
     return f"uploads/{os.path.basename(output_path)}"
 
 
-def libro_from_request_db(data: Dict[str, Any]) -> LibroDB:
+def libro_from_request_db(data: Dict[str, Any], *, portada_diferida: bool = False) -> LibroDB:
     now = datetime.utcnow()
     # Detectar si es un equipo/PC o un libro
     categoria = (data.get('categoria', '') or '').lower()
@@ -547,9 +942,12 @@ def libro_from_request_db(data: Dict[str, Any]) -> LibroDB:
         creado_en=now,
         actualizado_en=now,
     )
+    libro.clave_grupo = clave_grupo(libro)
 
     # Generar portada automática si no se proporcionó imagen
-    if not libro.imagen and libro.titulo:
+    if not libro.imagen and libro.titulo and portada_diferida:
+        libro.imagen = PORTADA_PENDIENTE
+    elif not libro.imagen and libro.titulo:
         try:
             libro.imagen = generar_portada(libro.titulo, autor or '')
         except Exception:
@@ -559,6 +957,160 @@ def libro_from_request_db(data: Dict[str, Any]) -> LibroDB:
     return libro
 
 
+# -------------------------------
+# Versiones de datos y caché por proceso
+# -------------------------------
+
+VERSION_CATALOGO = 'catalogo'
+VERSION_REPORTES = 'reportes'  # Préstamos, sanciones y usuarios (ver /api/reportes)
+
+
+def leer_version(db, nombre: str) -> int:
+    """Versión actual de un conjunto de datos (0 si nunca se ha modificado)."""
+    valor = db.query(VersionDatosDB.valor).filter(VersionDatosDB.nombre == nombre).scalar()
+    return int(valor or 0)
+
+
+def incrementar_version(db, nombre: str) -> None:
+    """
+    Incrementar la versión de un conjunto de datos dentro de la transacción actual.
+    Al confirmarse, todos los workers invalidan sus cachés asociadas en la siguiente lectura.
+    """
+    now = datetime.utcnow()
+    result = db.execute(
+        update(VersionDatosDB)
+        .where(VersionDatosDB.nombre == nombre)
+        .values(valor=VersionDatosDB.valor + 1, actualizado_en=now)
+    )
+    if result.rowcount == 0:
+        db.add(VersionDatosDB(nombre=nombre, valor=1, actualizado_en=now))
+
+
+class CacheVersionada:
+    """
+    Caché en memoria (por worker) de respuestas ya serializadas.
+    Las entradas pertenecen a una versión de datos; al observar otra versión se descartan todas.
+    """
+
+    def __init__(self, nombre: str, max_entradas: int = 32):
+        self.nombre = nombre
+        self.max_entradas = max_entradas
+        self.hits = 0
+        self.misses = 0
+        self._version: Optional[int] = None
+        self._entradas: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, version: int, clave: str) -> Optional[bytes]:
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._entradas.clear()
+            valor = self._entradas.get(clave)
+            if valor is None:
+                self.misses += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.hits += 1
+            return valor
+
+    def guardar(self, version: int, clave: str, valor: bytes) -> None:
+        with self._lock:
+            if version != self._version:
+                return
+            self._entradas[clave] = valor
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'version': self._version,
+                'entradas': len(self._entradas),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else None,
+            }
+
+
+CACHES: Dict[str, CacheVersionada] = {}
+
+
+def registrar_cache(nombre: str, max_entradas: int = 32) -> CacheVersionada:
+    cache = CacheVersionada(nombre, max_entradas=max_entradas)
+    CACHES[nombre] = cache
+    return cache
+
+
+def clave_cache_request() -> str:
+    """Clave de caché a partir de los parámetros de la query string (independiente del orden)."""
+    return '&'.join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+
+
+def respuesta_json_cacheada(contenido: bytes, estado_cache: str) -> Response:
+    response = Response(contenido, mimetype='application/json')
+    response.headers['X-Cache'] = estado_cache
+    return response
+
+
+cache_catalogo = registrar_cache(VERSION_CATALOGO, max_entradas=int(os.environ.get('CACHE_CATALOGO_ENTRADAS', '32')))
+
+
+@app.get('/api/cache')
+def cache_estadisticas():
+    """Contadores de aciertos/fallos de las cachés de este worker"""
+    return jsonify({'pid': os.getpid(), 'caches': {nombre: c.estadisticas() for nombre, c in CACHES.items()}})
+
+
+# -------------------------------
+# Tareas periódicas por worker
+# -------------------------------
+# Cada worker arranca en su primera petición un hilo por tarea registrada. Las tareas deben ser
+# seguras si varios workers las ejecutan a la vez (UPDATE condicionales) y confirmar su propio trabajo.
+
+TAREAS_PERIODICAS: Dict[str, tuple[int, Callable[[Any], Any]]] = {}
+_tareas_iniciadas = False
+_tareas_lock = threading.Lock()
+
+
+def registrar_tarea_periodica(nombre: str, segundos: int, funcion: Callable[[Any], Any]) -> None:
+    """Ejecutar funcion(db) cada 'segundos' (0 o menos la desactiva)"""
+    if segundos > 0:
+        TAREAS_PERIODICAS[nombre] = (segundos, funcion)
+
+
+def _ejecutar_tarea_periodica(nombre: str, segundos: int, funcion: Callable[[Any], Any]) -> None:
+    while True:
+        time.sleep(segundos)
+        db = SessionLocal()
+        try:
+            resultado = funcion(db)
+            if resultado:
+                print(f"✓ Tarea {nombre}: {resultado}")
+        except Exception as e:
+            db.rollback()
+            print(f"Error en tarea {nombre}: {e}")
+        finally:
+            db.close()
+
+
+@app.before_request
+def iniciar_tareas_periodicas() -> None:
+    """Arrancar (una vez por worker) los hilos de las tareas periódicas"""
+    global _tareas_iniciadas
+    if _tareas_iniciadas:
+        return
+    with _tareas_lock:
+        if not _tareas_iniciadas:
+            for nombre, (segundos, funcion) in TAREAS_PERIODICAS.items():
+                threading.Thread(
+                    target=_ejecutar_tarea_periodica, args=(nombre, segundos, funcion), name=nombre, daemon=True
+                ).start()
+            _tareas_iniciadas = True
+
+
 # -------------------------------
 # Rutas de HTML estático
 # -------------------------------
@@ -603,6 +1155,87 @@ def serve_uploads(filename: str):
     return ("No encontrado", 404)
 
 
+# -------------------------------
+# Referencias a usuarios
+# -------------------------------
+# Préstamos, lista de espera, favoritos y mensajes guardan en id_usuario (id_remitente/id_destinatario)
+# el UserDB.id canónico; el identificador recibido (ID, documento o username) queda en *_original.
+# Si la referencia no corresponde a ningún usuario registrado se guarda tal cual en ambas columnas.
+
+# (modelo, columna con el ID canónico, columna con el identificador original)
+REFERENCIAS_USUARIO = (
+    (PrestamoDB, 'id_usuario', 'usuario_original'),
+    (WaitlistDB, 'id_usuario', 'usuario_original'),
+    (FavoritoDB, 'id_usuario', 'usuario_original'),
+    (MensajeDB, 'id_remitente', 'remitente_original'),
+    (MensajeDB, 'id_destinatario', 'destinatario_original'),
+)
+
+
+def mapa_usuarios(db, referencias: Iterable[str]) -> Dict[str, UserDB]:
+    """Resolver referencias (ID, documento o username) con una sola consulta IN; el ID tiene prioridad"""
+    referencias = {r for r in referencias if r}
+    usuarios_map: Dict[str, UserDB] = {}
+    if not referencias:
+        return usuarios_map
+    usuarios = db.query(UserDB).options(
+        load_only(UserDB.id, UserDB.nombre, UserDB.documento, UserDB.correo, UserDB.username)
+    ).filter(
+        UserDB.id.in_(referencias) | UserDB.documento.in_(referencias) | UserDB.username.in_(referencias)
+    ).all()
+    for campo in ('id', 'documento', 'username'):
+        for u in usuarios:
+            clave = getattr(u, campo)
+            if clave in referencias:
+                usuarios_map.setdefault(clave, u)
+    return usuarios_map
+
+
+def id_usuario_canonico(db, referencia: Optional[str]) -> Optional[str]:
+    """UserDB.id de la referencia; la referencia sin cambios si no hay usuario ('admin' incluido)"""
+    if not referencia or referencia == 'admin':
+        return referencia
+    usuario = mapa_usuarios(db, [referencia]).get(referencia)
+    return usuario.id if usuario else referencia
+
+
+def normalizar_referencias_usuario(db, lote: int = 1000) -> Dict[str, int]:
+    """
+    Backfill: copiar el identificador actual a *_original y reemplazarlo por el UserDB.id.
+    Procesa solo filas sin *_original, por lotes, confirmando cada lote. Devuelve filas tratadas por columna.
+    """
+    tratados: Dict[str, int] = {}
+    for modelo, columna, columna_original in REFERENCIAS_USUARIO:
+        col = getattr(modelo, columna)
+        col_original = getattr(modelo, columna_original)
+        total = 0
+        ultimo_id = ''
+        while True:
+            filas = db.execute(
+                select(modelo.id, col)
+                .where(col_original.is_(None), col.isnot(None), modelo.id > ultimo_id)
+                .order_by(modelo.id)
+                .limit(lote)
+            ).all()
+            if not filas:
+                break
+            usuarios_map = mapa_usuarios(db, [ref for _, ref in filas if ref != 'admin'])
+            cambios = []
+            for id_fila, referencia in filas:
+                usuario = usuarios_map.get(referencia)
+                cambios.append({
+                    'id': id_fila,
+                    columna: usuario.id if usuario else referencia,
+                    columna_original: referencia,
+                })
+            db.execute(update(modelo), cambios)
+            db.commit()
+            total += len(filas)
+            ultimo_id = filas[-1][0]
+        tratados[f'{modelo.__tablename__}.{columna}'] = total
+    return tratados
+
+
 # -------------------------------
 # API mock: autenticación muy básica
 # -------------------------------
@@ -610,29 +1243,11 @@ def serve_uploads(filename: str):
 @app.get('/api/usuarios')
 def listar_usuarios():
     """Listar todos los usuarios (solo admin)"""
-    db = SessionLocal()
-    try:
-        # En un sistema real, verificar token admin aquí
-        users = db.query(UserDB).all()
-        return jsonify([
-            {
-                "id": u.id,
-                "nombre": u.nombre,
-                "documento": u.documento,
-                "correo": getattr(u, 'correo', None),
-                "username": u.username,
-                "role": u.role,
-                "numero_ficha": getattr(u, 'numero_ficha', None),
-                "telefono": getattr(u, 'telefono', None),
-                "direccion": getattr(u, 'direccion', None),
-                "tipo_usuario": getattr(u, 'tipo_usuario', None),
-                "tipo_documento": getattr(u, 'tipo_documento', None),
-                "creado_en": u.creado_en.isoformat() + 'Z' if u.creado_en else None
-            }
-            for u in users
-        ])
-    finally:
-        db.close()
+    # En un sistema real, verificar token admin aquí
+    return respuesta_json_stream(
+        lambda db: db.query(UserDB).order_by(UserDB.creado_en, UserDB.id),
+        serializar_con(ESQUEMA_USUARIO),
+    )
 
 @app.get('/api/usuarios/<usuario_id>')
 def obtener_usuario(usuario_id: str):
@@ -644,23 +1259,148 @@ def obtener_usuario(usuario_id: str):
         ).first()
         if not user:
             return jsonify({"error": "Usuario no encontrado"}), 404
-        return jsonify({
-            "id": user.id,
-            "nombre": user.nombre,
-            "documento": user.documento,
-            "correo": getattr(user, 'correo', None),
-            "username": user.username,
-            "role": user.role,
-            "numero_ficha": getattr(user, 'numero_ficha', None),
-            "telefono": getattr(user, 'telefono', None),
-            "direccion": getattr(user, 'direccion', None),
-            "tipo_usuario": getattr(user, 'tipo_usuario', None),
-            "tipo_documento": getattr(user, 'tipo_documento', None),
-            "creado_en": user.creado_en.isoformat() + 'Z' if user.creado_en else None
-        })
+        return jsonify(ESQUEMA_USUARIO(user))
+    finally:
+        db.close()
+
+ESTADOS_ESPERA_ACTIVOS = ('pendiente', 'notificado')
+CAMPOS_ELEMENTO_RESUMEN = (
+    'id', 'titulo', 'autor', 'categoria', 'subcategoria', 'codigo_inventario', 'imagen',
+    'estado_disponibilidad', 'cantidad_disponible',
+)
+
+
+RESUMEN_SANCIONES_RESUELTAS = 50  # Historial de sanciones resueltas que muestra "mis préstamos"
+
+
+def huella_resumen_usuario(db, user: UserDB) -> str:
+    """
+    ETag del resumen de un usuario a partir de una sola consulta de conteos y últimas modificaciones
+    (préstamos, sanciones, favoritos y las colas de espera donde participa) más la versión del catálogo.
+    """
+    en_sus_colas = select(WaitlistDB.id_elemento).where(WaitlistDB.id_usuario == user.id)
+    partes = [
+        select(literal(n).label('parte'), func.count(), func.max(columna)).where(condicion)
+        for n, (columna, condicion) in enumerate((
+            (PrestamoDB.actualizado_en, PrestamoDB.id_usuario == user.id),
+            (SancionDB.actualizado_en, SancionDB.id_usuario == user.id),
+            (FavoritoDB.actualizado_en, FavoritoDB.id_usuario == user.id),
+            (WaitlistDB.actualizado_en, WaitlistDB.id_elemento.in_(en_sus_colas)),
+        ))
+    ]
+    filas = sorted(tuple(fila) for fila in db.execute(union_all(*partes)).all())
+    base = repr((user.id, str(user.actualizado_en), leer_version(db, VERSION_CATALOGO), filas))
+    return hashlib.sha1(base.encode('utf-8')).hexdigest()
+
+
+@app.get('/api/usuarios/<usuario_id>/resumen')
+def resumen_usuario(usuario_id: str):
+    """
+    Resumen de "mi cuenta" en una sola petición: préstamos con datos del elemento, sanciones (todas las
+    activas y las RESUMEN_SANCIONES_RESUELTAS resueltas más recientes), posiciones en la lista de espera y favoritos. usuario_id puede ser ID, documento o username.
+    Responde con ETag; si If-None-Match coincide devuelve 304 sin consultar el detalle.
+    """
+    db = SessionLocal()
+    try:
+        user = db.query(UserDB).filter(
+            (UserDB.id == usuario_id) | (UserDB.documento == usuario_id) | (UserDB.username == usuario_id)
+        ).first()
+        if not user:
+            return jsonify({"ok": False, "error": "Usuario no encontrado"}), 404
+
+        etag = huella_resumen_usuario(db, user)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        prestamos = db.query(PrestamoDB).filter(PrestamoDB.id_usuario == user.id).order_by(
+            PrestamoDB.creado_en.desc(), PrestamoDB.id.desc()
+        ).all()
+
+        sanciones = db.query(SancionDB).filter(
+            SancionDB.id_usuario == user.id, SancionDB.estado == 'activa'
+        ).order_by(SancionDB.creado_en.desc()).all()
+        sanciones += db.query(SancionDB).filter(
+            SancionDB.id_usuario == user.id, SancionDB.estado != 'activa'
+        ).order_by(SancionDB.creado_en.desc()).limit(RESUMEN_SANCIONES_RESUELTAS).all()
+        tipo_ids = {s.tipo_id for s in sanciones if s.tipo_id}
+        causa_ids = {s.causa_id for s in sanciones if s.causa_id}
+        tipos_map = {t.id: t for t in db.query(SancionTipoDB).filter(SancionTipoDB.id.in_(tipo_ids))} if tipo_ids else {}
+        causas_map = {c.id: c for c in db.query(SancionCausaDB).filter(SancionCausaDB.id.in_(causa_ids))} if causa_ids else {}
+        prestamos_map = {p.id: p for p in prestamos}
+
+        # Posición en cada cola: se numeran todas las solicitudes de los elementos donde el usuario espera
+        posicion = func.row_number().over(
+            partition_by=(WaitlistDB.id_elemento, WaitlistDB.estado),
+            order_by=(WaitlistDB.creado_en, WaitlistDB.id),
+        )
+        colas = select(
+            WaitlistDB.id.label('id'),
+            case((WaitlistDB.estado == 'pendiente', posicion), else_=None).label('posicion'),
+        ).where(
+            WaitlistDB.id_elemento.in_(select(WaitlistDB.id_elemento).where(WaitlistDB.id_usuario == user.id)),
+            WaitlistDB.estado.in_(ESTADOS_ESPERA_ACTIVOS),
+        ).subquery()
+        espera = db.query(WaitlistDB, colas.c.posicion).join(colas, colas.c.id == WaitlistDB.id).filter(
+            WaitlistDB.id_usuario == user.id
+        ).order_by(WaitlistDB.creado_en, WaitlistDB.id).all()
+
+        favoritos = db.query(FavoritoDB).filter(FavoritoDB.id_usuario == user.id).order_by(FavoritoDB.creado_en.desc()).all()
+
+        # Un solo IN para los elementos de préstamos, lista de espera y favoritos
+        elemento_ids = {p.id_elemento for p in prestamos} | {w.id_elemento for w, _ in espera} | {f.id_elemento for f in favoritos}
+        elementos_map = {}
+        if elemento_ids:
+            esquema_elemento = ESQUEMA_LIBRO.proyectar(CAMPOS_ELEMENTO_RESUMEN)
+            elementos = db.query(LibroDB).options(
+                load_only(*(getattr(LibroDB, c) for c in CAMPOS_ELEMENTO_RESUMEN))
+            ).filter(LibroDB.id.in_(elemento_ids)).all()
+            elementos_map = {e.id: esquema_elemento(e) for e in elementos}
+
+        items_prestamos = []
+        for p in prestamos:
+            item = ESQUEMA_PRESTAMO(p)
+            item['elemento'] = elementos_map.get(p.id_elemento)
+            items_prestamos.append(item)
+
+        items_espera = []
+        for w, pos in espera:
+            item = ESQUEMA_ESPERA(w)
+            item['posicion'] = pos
+            item['elemento'] = elementos_map.get(w.id_elemento)
+            items_espera.append(item)
+
+        items_favoritos = [
+            {'id': f.id, 'id_elemento': f.id_elemento, 'creado_en': f.creado_en, 'elemento': elementos_map.get(f.id_elemento)}
+            for f in favoritos
+        ]
+
+        resumen = {
+            'usuario': ESQUEMA_USUARIO(user),
+            'prestamos': items_prestamos,
+            'sanciones': [
+                sancion_to_dict(
+                    s,
+                    tipo=tipos_map.get(s.tipo_id),
+                    usuario=user,
+                    prestamo=prestamos_map.get(s.id_prestamo),
+                    causa=causas_map.get(s.causa_id),
+                )
+                for s in sanciones
+            ],
+            'espera': items_espera,
+            'favoritos': items_favoritos,
+        }
+        response = Response(json_bytes(resumen), mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
     finally:
         db.close()
 
+
 @app.post('/api/usuarios')
 def crear_usuario():
     data = request.get_json(silent=True) or request.form.to_dict()
@@ -691,6 +1431,7 @@ def crear_usuario():
             actualizado_en=now
         )
         db.add(u)
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         return jsonify({"ok": True, "id": u.id}), 201
     finally:
@@ -742,6 +1483,7 @@ def actualizar_usuario(usuario_id: str):
             setattr(user, 'tipo_documento', data['tipo_documento'])
         
         user.actualizado_en = datetime.utcnow()
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         return jsonify({"ok": True})
     finally:
@@ -763,6 +1505,7 @@ def eliminar_usuario(usuario_id: str):
             return jsonify({"ok": False, "error": "No se puede eliminar el administrador principal"}), 400
         
         db.delete(user)
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         return jsonify({"ok": True})
     finally:
@@ -815,131 +1558,772 @@ def api_login():
 # API CRUD de libros (en memoria)
 # -------------------------------
 
-@app.get('/api/libros')
-def libros_listar():
+def clave_grupo(libro: LibroDB) -> str:
     """
-    Listar libros. Si hay múltiples copias del mismo libro, agruparlos por código_inventario o título/ISBN.
-    IMPORTANTE: Evita duplicados procesando cada registro solo una vez.
+    Clave de agrupación de copias del mismo elemento:
+    'cod_<codigo_inventario>' si tiene código, si no 'tit_<titulo>_<autor>_<isbn>'.
     """
-    db = SessionLocal()
-    try:
-        rows = db.query(LibroDB).all()
-        
-        # Agrupar por código_inventario si existe, sino por título+autor+ISBN único
-        libros_agrupados = {}
-        ids_procesados = set()  # Para evitar procesar el mismo registro múltiples veces
-        
-        for r in rows:
-            # Si ya fue procesado, saltarlo
-            if r.id in ids_procesados:
-                continue
-            
-            # Determinar clave de agrupación
-            if r.codigo_inventario and r.codigo_inventario.strip():
-                # Agrupar por código_inventario
-                clave = f"cod_{r.codigo_inventario.strip()}"
-                
-                # Buscar TODAS las copias con este código_inventario
-                copias_relacionadas = db.query(LibroDB).filter(
-                    LibroDB.codigo_inventario == r.codigo_inventario
-                ).all()
-            else:
-                # Agrupar por título+autor+ISBN (libros idénticos)
-                titulo_norm = (r.titulo or '').strip()
-                autor_norm = (r.autor or '').strip()
-                isbn_norm = (r.isbn or '').strip()
-                clave = f"tit_{titulo_norm}_{autor_norm}_{isbn_norm}"
-                
-                # Buscar TODAS las copias con estos datos (que NO tengan código_inventario)
-                copias_relacionadas = db.query(LibroDB).filter(
-                    LibroDB.titulo == titulo_norm,
-                    LibroDB.autor == autor_norm,
-                    LibroDB.isbn == isbn_norm,
-                    ((LibroDB.codigo_inventario == None) | (LibroDB.codigo_inventario == ''))
-                ).all()
-            
-            # Agrupar todas las copias encontradas
-            if copias_relacionadas:
-                libro_base = copias_relacionadas[0]  # Usar el primero como base
-                
-                # Sumar stocks de todas las copias
-                stock_total = sum(c.stock or 0 for c in copias_relacionadas)
-                cantidad_disponible_total = sum(c.cantidad_disponible or 0 for c in copias_relacionadas)
-                cantidad_prestado_total = sum(c.cantidad_prestado or 0 for c in copias_relacionadas)
-                
-                # Crear entrada agrupada
-                libros_agrupados[clave] = {
-                    'id': libro_base.id,
-                    'titulo': libro_base.titulo,
-                    'autor': libro_base.autor,
-                    'isbn': libro_base.isbn,
-                    'editorial': libro_base.editorial,
-                    'anio_publicacion': libro_base.anio_publicacion,
-                    'categoria': libro_base.categoria,
-                    'subcategoria': libro_base.subcategoria,
-                    'descripcion': libro_base.descripcion,
-                    'estado_disponibilidad': libro_base.estado_disponibilidad,
-                    'estado_elemento': libro_base.estado_elemento,
-                    'stock': stock_total,
-                    'cantidad_disponible': cantidad_disponible_total,
-                    'cantidad_prestado': cantidad_prestado_total,
-                    'imagen': libro_base.imagen,
-                    'codigo_inventario': libro_base.codigo_inventario,
-                    'creado_en': libro_base.creado_en.isoformat() + 'Z',
-                    'actualizado_en': libro_base.actualizado_en.isoformat() + 'Z',
-                }
-                
-                # Marcar TODAS las copias como procesadas
-                for copia in copias_relacionadas:
-                    ids_procesados.add(copia.id)
-        
-        items = list(libros_agrupados.values())
-        return jsonify(items)
-    finally:
-        db.close()
+    codigo = (libro.codigo_inventario or '').strip()
+    if codigo:
+        return f"cod_{codigo}"
+    titulo_norm = (libro.titulo or '').strip()
+    autor_norm = (libro.autor or '').strip()
+    isbn_norm = (libro.isbn or '').strip()
+    return f"tit_{titulo_norm}_{autor_norm}_{isbn_norm}"
+
+
+def _columnas_agregado_grupos() -> tuple:
+    """Columnas de totales por clave_grupo sobre la tabla libros (en el orden de LibroGrupoDB)."""
+    return (
+        LibroDB.clave_grupo,
+        func.min(LibroDB.id),
+        func.sum(func.coalesce(LibroDB.stock, 0)),
+        func.sum(func.coalesce(LibroDB.cantidad_disponible, 0)),
+        func.sum(func.coalesce(LibroDB.cantidad_prestado, 0)),
+        func.count(LibroDB.id),
+    )
 
 
-@app.post('/api/libros')
-def libros_crear():
-    data = request.form.to_dict() if request.form else (request.get_json(silent=True) or {})
-    
-    # Debug: mostrar datos recibidos
-    print("=" * 60)
-    print("DATOS RECIBIDOS EN /api/libros:")
-    print(f"Tipo de request: {type(request.form)}")
-    print(f"Datos recibidos: {data}")
-    print(f"Campos en request.form: {list(request.form.keys()) if request.form else 'No hay form'}")
-    print("=" * 60)
-    
-    db = SessionLocal()
-    try:
-        # Validar campos requeridos
-        titulo = data.get('titulo', '').strip()
-        if not titulo:
-            return jsonify({"ok": False, "error": "El título es requerido"}), 400
-        
-        # Validar categoría
-        categoria = data.get('categoria', '').strip()
-        if not categoria:
-            return jsonify({"ok": False, "error": "La categoría es requerida"}), 400
-        
-        # Validar que para libros se tenga autor
-        es_equipo = 'equipo' in categoria.lower() or 'informático' in categoria.lower()
-        if not es_equipo:
-            autor = data.get('autor', '').strip()
-            if not autor:
-                return jsonify({"ok": False, "error": "El autor es requerido para libros"}), 400
-        # Para equipos, asegurar que autor sea cadena vacía si no está presente
-        elif es_equipo:
-            autor = data.get('autor', '').strip()
-            if not autor:
-                data['autor'] = ''  # Asegurar cadena vacía para equipos
-        
-        libro = libro_from_request_db(data)
-        
-        # Asegurar que todos los campos requeridos por la BD tengan valores
-        if not libro.titulo:
-            return jsonify({"ok": False, "error": "El título es requerido"}), 400
+def recalcular_grupos(db, claves: Iterable[Optional[str]]) -> None:
+    """
+    Recalcular las filas de libro_grupo de las claves indicadas dentro de la transacción actual.
+    Crea los grupos nuevos, actualiza los existentes y elimina los que se quedaron sin copias, con
+    sentencias masivas por lote de claves (sin cargar objetos LibroGrupoDB en la sesión).
+    """
+    claves = sorted({c for c in claves if c})
+    if not claves:
+        return
+    db.flush()
+    now = datetime.utcnow()
+    tabla = LibroGrupoDB.__table__
+    for i in range(0, len(claves), 500):
+        lote = claves[i:i + 500]
+        totales = {
+            clave: {
+                'b_clave': clave,
+                'b_id_representativo': id_base,
+                'b_stock': int(stock or 0),
+                'b_cantidad_disponible': int(disponible or 0),
+                'b_cantidad_prestado': int(prestado or 0),
+                'b_copias': int(copias or 0),
+                'b_actualizado_en': now,
+            }
+            for clave, id_base, stock, disponible, prestado, copias in (
+                db.query(*_columnas_agregado_grupos()).filter(LibroDB.clave_grupo.in_(lote)).group_by(LibroDB.clave_grupo).all()
+            )
+        }
+        existentes = set(db.execute(select(tabla.c.clave).where(tabla.c.clave.in_(lote))).scalars())
+        vacios = [clave for clave in existentes if clave not in totales]
+        if vacios:
+            db.execute(delete(tabla).where(tabla.c.clave.in_(vacios)))
+        nuevos = [{k[2:]: v for k, v in fila.items()} for clave, fila in totales.items() if clave not in existentes]
+        if nuevos:
+            db.execute(insert(tabla), nuevos)
+        actualizados = [fila for clave, fila in totales.items() if clave in existentes]
+        if actualizados:
+            db.execute(
+                update(tabla)
+                .where(tabla.c.clave == bindparam('b_clave'))
+                .values({
+                    columna: bindparam(f'b_{columna}')
+                    for columna in ('id_representativo', 'stock', 'cantidad_disponible', 'cantidad_prestado', 'copias', 'actualizado_en')
+                }),
+                actualizados,
+            )
+
+
+def ajustar_grupo(db, libro: LibroDB, *, stock: int = 0, cantidad_disponible: int = 0, cantidad_prestado: int = 0) -> None:
+    """Aplicar al grupo del libro el mismo cambio de cantidades que se hizo sobre la copia."""
+    if not libro.clave_grupo:
+        libro.clave_grupo = clave_grupo(libro)
+    result = db.execute(
+        update(LibroGrupoDB)
+        .where(LibroGrupoDB.clave == libro.clave_grupo)
+        .values(
+            stock=LibroGrupoDB.stock + stock,
+            cantidad_disponible=LibroGrupoDB.cantidad_disponible + cantidad_disponible,
+            cantidad_prestado=LibroGrupoDB.cantidad_prestado + cantidad_prestado,
+            actualizado_en=datetime.utcnow(),
+        )
+    )
+    if result.rowcount == 0:
+        # El grupo aún no está materializado: calcularlo completo
+        recalcular_grupos(db, [libro.clave_grupo])
+
+
+# Movimientos de unidades de una copia: UPDATE condicionales, sin leer las cantidades en Python.
+# Dos workers que aprueban la última unidad a la vez no pueden dejar cantidad_disponible en negativo:
+# el segundo UPDATE no encuentra fila que cumpla la condición y el llamador responde 409.
+
+def prestar_unidad(db, id_elemento: str, ahora: datetime, cantidad: int = 1) -> bool:
+    """Descontar 'cantidad' unidades disponibles de la copia. False (sin cambios) si no alcanzan."""
+    result = db.execute(
+        update(LibroDB)
+        .where(LibroDB.id == id_elemento, LibroDB.cantidad_disponible >= cantidad)
+        .values(
+            cantidad_disponible=LibroDB.cantidad_disponible - cantidad,
+            cantidad_prestado=func.coalesce(LibroDB.cantidad_prestado, 0) + cantidad,
+            # En SET las columnas valen lo que tenían antes del UPDATE
+            estado_disponibilidad=case((LibroDB.cantidad_disponible == cantidad, 'Prestado'), else_='Disponible'),
+            actualizado_en=ahora,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def prestar_hasta(db, id_elemento: str, ahora: datetime, cantidad: int) -> int:
+    """Descontar hasta 'cantidad' unidades; retorna cuántas se concedieron."""
+    if cantidad <= 0:
+        return 0
+    if prestar_unidad(db, id_elemento, ahora, cantidad):
+        return cantidad
+    # No alcanzan para todas: conceder de a una mientras queden
+    concedidas = 0
+    while concedidas < cantidad - 1 and prestar_unidad(db, id_elemento, ahora):
+        concedidas += 1
+    return concedidas
+
+
+def devolver_unidad(db, id_elemento: str, ahora: datetime, cantidad: int = 1) -> int:
+    """Reintegrar 'cantidad' unidades a la copia. Retorna el cambio aplicado a cantidad_prestado."""
+    result = db.execute(
+        update(LibroDB)
+        .where(LibroDB.id == id_elemento, LibroDB.cantidad_prestado >= cantidad)
+        .values(cantidad_prestado=LibroDB.cantidad_prestado - cantidad)
+        .execution_options(synchronize_session=False)
+    )
+    cambio_prestado = -cantidad if result.rowcount == 1 else 0
+    if result.rowcount == 0:
+        # Quedaban menos unidades prestadas que devoluciones: bajar de a una sin pasar de cero
+        while cambio_prestado > -cantidad and db.execute(
+            update(LibroDB)
+            .where(LibroDB.id == id_elemento, LibroDB.cantidad_prestado > 0)
+            .values(cantidad_prestado=LibroDB.cantidad_prestado - 1)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1:
+            cambio_prestado -= 1
+    db.execute(
+        update(LibroDB)
+        .where(LibroDB.id == id_elemento)
+        .values(
+            cantidad_disponible=func.coalesce(LibroDB.cantidad_disponible, 0) + cantidad,
+            estado_disponibilidad='Disponible',
+            actualizado_en=ahora,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return cambio_prestado
+
+
+def cambiar_estado_prestamo(db, prestamo_id: str, desde: str, hacia: str, ahora: datetime, **valores: Any) -> bool:
+    """Pasar el préstamo de 'desde' a 'hacia' solo si sigue en 'desde' (evita aprobar o devolver dos veces)."""
+    result = db.execute(
+        update(PrestamoDB)
+        .where(PrestamoDB.id == prestamo_id, PrestamoDB.estado == desde)
+        .values(estado=hacia, actualizado_en=ahora, **valores)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+# -------------------------------
+# Estadísticas diarias de préstamos
+# -------------------------------
+# estadistica_prestamo_dia cuenta los préstamos por (día de creación, categoría, estado actual).
+# Cada cambio de estado resta en el estado anterior y suma en el nuevo dentro de la misma transacción,
+# así los reportes mensuales y anuales leen unos cientos de filas en vez de toda la tabla prestamos.
+# Los usuarios distintos se estiman con HyperLogLog: los sketches se unen por máximo de registros,
+# por lo que se pueden combinar días, categorías y estados. Un sketch no olvida usuarios (al cambiar
+# de estado el usuario sigue contando en el estado anterior), pero el total de un periodo sí es correcto.
+
+HLL_BITS = 8
+HLL_REGISTROS = 1 << HLL_BITS  # 256 registros: error típico ~6.5 %
+CATEGORIA_SIN_DEFINIR = 'Sin categoría'
+
+
+def hll_agregar(registros: bytearray, valor: str) -> None:
+    h = int.from_bytes(hashlib.blake2b(valor.encode('utf-8'), digest_size=8).digest(), 'big')
+    indice = h & (HLL_REGISTROS - 1)
+    resto = h >> HLL_BITS
+    rango = (64 - HLL_BITS) - resto.bit_length() + 1
+    if rango > registros[indice]:
+        registros[indice] = rango
+
+
+def hll_unir(destino: bytearray, origen: Optional[bytes]) -> None:
+    if origen:
+        for i, valor in enumerate(origen):
+            if valor > destino[i]:
+                destino[i] = valor
+
+
+def hll_estimar(registros: bytes) -> int:
+    m = HLL_REGISTROS
+    ceros = registros.count(0)
+    if ceros == m:
+        return 0
+    alfa = 0.7213 / (1 + 1.079 / m)
+    estimado = alfa * m * m / sum(2.0 ** -r for r in registros)
+    if estimado <= 2.5 * m and ceros:
+        estimado = m * math.log(m / ceros)  # corrección para conjuntos pequeños
+    return int(round(estimado))
+
+
+def categoria_estadistica(categoria: Optional[str]) -> str:
+    return (categoria or '').strip() or CATEGORIA_SIN_DEFINIR
+
+
+def acumular_estadistica_prestamos(db, cambios: Iterable[tuple[PrestamoDB, Optional[str], Optional[str], str]]) -> None:
+    """
+    Aplicar al rollup diario cambios de estado de préstamos, dentro de la transacción actual.
+    cambios: (préstamo, categoría del elemento, estado anterior o None si el préstamo es nuevo, estado nuevo)
+    Solo se deben pasar cambios ya confirmados por cambiar_estado_prestamo: si el UPDATE condicional no
+    tocó la fila, otra transacción movió el préstamo y registró su propio cambio.
+    """
+    deltas: Dict[tuple, int] = {}
+    usuarios: Dict[tuple, set[str]] = {}
+    for prestamo, categoria, desde, hacia in cambios:
+        fecha = (prestamo.creado_en or datetime.utcnow()).date()
+        categoria = categoria_estadistica(categoria)
+        if desde:
+            clave = (fecha, categoria, desde)
+            deltas[clave] = deltas.get(clave, 0) - 1
+        clave = (fecha, categoria, hacia)
+        deltas[clave] = deltas.get(clave, 0) + 1
+        if prestamo.id_usuario:
+            usuarios.setdefault(clave, set()).add(prestamo.id_usuario)
+
+    now = datetime.utcnow()
+    # Claves en orden fijo: dos transacciones que tocan las mismas filas las bloquean en el mismo orden
+    claves = [c for c in sorted(deltas) if deltas[c] != 0 or usuarios.get(c)]
+    tabla = EstadisticaPrestamoDiaDB.__table__
+    insertar = insert_dialecto(tabla)
+    if insertar is not None and claves:
+        # Crear antes las filas que falten (INSERT ... ON CONFLICT DO NOTHING): así el SELECT ... FOR UPDATE
+        # siempre encuentra la fila y la bloquea, y dos préstamos del mismo día nuevo no chocan en la clave
+        db.execute(
+            insertar.on_conflict_do_nothing(index_elements=[tabla.c.fecha, tabla.c.categoria, tabla.c.estado]),
+            [dict(fecha=f, categoria=c, estado=e, cantidad=0, usuarios=None, actualizado_en=now) for f, c, e in claves],
+        )
+    for clave in claves:
+        fecha, categoria, estado = clave
+        delta = deltas[clave]
+        nuevos = usuarios.get(clave)
+        fila = db.query(EstadisticaPrestamoDiaDB).filter(
+            EstadisticaPrestamoDiaDB.fecha == fecha,
+            EstadisticaPrestamoDiaDB.categoria == categoria,
+            EstadisticaPrestamoDiaDB.estado == estado,
+        ).with_for_update().populate_existing().first()
+        if fila is None:
+            fila = EstadisticaPrestamoDiaDB(fecha=fecha, categoria=categoria, estado=estado, cantidad=0)
+            db.add(fila)
+        fila.cantidad = (fila.cantidad or 0) + delta
+        if nuevos:
+            registros = bytearray(fila.usuarios or bytes(HLL_REGISTROS))
+            for id_usuario in nuevos:
+                hll_agregar(registros, id_usuario)
+            fila.usuarios = bytes(registros)
+        fila.actualizado_en = now
+    if deltas:
+        incrementar_version(db, VERSION_REPORTES)
+    # autoflush está desactivado: las filas nuevas deben quedar visibles para la siguiente llamada
+    db.flush()
+
+
+def reconstruir_estadistica_prestamos(db, *, lote: int = 5000) -> int:
+    """
+    Reconstruir estadistica_prestamo_dia desde toda la historia de préstamos (una sola pasada en streaming).
+    Pensado para bases de datos existentes (ver reconstruir_estadisticas.py). Retorna la cantidad de filas.
+    """
+    db.query(EstadisticaPrestamoDiaDB).delete(synchronize_session=False)
+    acumulado: Dict[tuple, list] = {}
+    filas = db.execute(
+        select(PrestamoDB.creado_en, PrestamoDB.estado, PrestamoDB.id_usuario, LibroDB.categoria)
+        .outerjoin(LibroDB, LibroDB.id == PrestamoDB.id_elemento)
+        .execution_options(yield_per=lote)
+    )
+    for creado_en, estado, id_usuario, categoria in filas:
+        clave = (creado_en.date(), categoria_estadistica(categoria), estado)
+        item = acumulado.get(clave)
+        if item is None:
+            item = acumulado[clave] = [0, bytearray(HLL_REGISTROS)]
+        item[0] += 1
+        if id_usuario:
+            hll_agregar(item[1], id_usuario)
+
+    now = datetime.utcnow()
+    valores = [
+        dict(fecha=fecha, categoria=categoria, estado=estado, cantidad=cantidad, usuarios=bytes(registros), actualizado_en=now)
+        for (fecha, categoria, estado), (cantidad, registros) in acumulado.items()
+    ]
+    for inicio in range(0, len(valores), lote):
+        db.execute(insert(EstadisticaPrestamoDiaDB), valores[inicio:inicio + lote])
+    return len(valores)
+
+
+AGRUPACIONES_ESTADISTICA = {'dia': 10, 'mes': 7, 'anio': 4}  # largo del prefijo de la fecha ISO
+
+
+def resumen_estadistica_prestamos(db, desde: date, hasta: date, *, agrupar: str = 'mes',
+                                  categoria: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Préstamos creados entre desde y hasta (inclusive) por periodo: total, por estado, por categoría
+    y usuarios distintos estimados. Lee solo el rollup diario.
+    """
+    q = db.query(EstadisticaPrestamoDiaDB).filter(
+        EstadisticaPrestamoDiaDB.fecha >= desde, EstadisticaPrestamoDiaDB.fecha <= hasta
+    )
+    if categoria:
+        q = q.filter(EstadisticaPrestamoDiaDB.categoria == categoria)
+    largo = AGRUPACIONES_ESTADISTICA[agrupar]
+    periodos: Dict[str, Dict[str, Any]] = {}
+    sketches: Dict[str, bytearray] = {}
+    for fila in q.order_by(EstadisticaPrestamoDiaDB.fecha):
+        periodo = fila.fecha.isoformat()[:largo]
+        item = periodos.get(periodo)
+        if item is None:
+            item = periodos[periodo] = {'periodo': periodo, 'total': 0, 'por_estado': {}, 'por_categoria': {}}
+            sketches[periodo] = bytearray(HLL_REGISTROS)
+        item['total'] += fila.cantidad
+        item['por_estado'][fila.estado] = item['por_estado'].get(fila.estado, 0) + fila.cantidad
+        item['por_categoria'][fila.categoria] = item['por_categoria'].get(fila.categoria, 0) + fila.cantidad
+        hll_unir(sketches[periodo], fila.usuarios)
+    for periodo, item in periodos.items():
+        item['usuarios_distintos'] = hll_estimar(sketches[periodo])
+    return list(periodos.values())
+
+
+# -------------------------------
+# Lista de espera: reservas
+# -------------------------------
+# Cuando se devuelve una unidad y hay solicitudes pendientes para el elemento, en la misma transacción
+# se reclama la más antigua (pendiente -> notificado) y la unidad se aparta para ella durante
+# HORAS_RESERVA_ESPERA: no vuelve a cantidad_disponible. Al aprobar un préstamo del usuario se consume
+# la reserva (notificado -> atendido). Las reservas vencidas pasan a 'expirado' y la unidad se ofrece
+# a la siguiente solicitud o vuelve a estar disponible (ver liberar_reservas_vencidas).
+
+HORAS_RESERVA_ESPERA = float(os.environ.get('ESPERA_RESERVA_HORAS', '48'))
+SEGUNDOS_BARRIDO_ESPERA = int(os.environ.get('ESPERA_BARRIDO_SEGUNDOS', '300'))  # 0 desactiva el barrido
+LOTE_BARRIDO_ESPERA = int(os.environ.get('ESPERA_BARRIDO_LOTE', '200'))
+
+
+def apartar_unidad(db, id_elemento: str, ahora: datetime) -> bool:
+    """Sacar una unidad de cantidad_disponible para reservarla. False si no quedaba ninguna."""
+    result = db.execute(
+        update(LibroDB)
+        .where(LibroDB.id == id_elemento, LibroDB.cantidad_disponible > 0)
+        .values(
+            cantidad_disponible=LibroDB.cantidad_disponible - 1,
+            estado_disponibilidad=case((LibroDB.cantidad_disponible == 1, 'Reservado'), else_='Disponible'),
+            actualizado_en=ahora,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def liberar_unidades(db, id_elemento: str, ahora: datetime, cantidad: int) -> None:
+    """Devolver a cantidad_disponible unidades que estaban reservadas"""
+    db.execute(
+        update(LibroDB)
+        .where(LibroDB.id == id_elemento)
+        .values(
+            cantidad_disponible=func.coalesce(LibroDB.cantidad_disponible, 0) + cantidad,
+            estado_disponibilidad='Disponible',
+            actualizado_en=ahora,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reservar_solicitud(db, espera_id: str, id_elemento: str, ahora: datetime) -> Optional[bool]:
+    """
+    Reclamar una solicitud pendiente (pendiente -> notificado) y apartarle una unidad.
+    None si otro worker ya la había reclamado; False si no quedaba unidad (la solicitud sigue pendiente).
+    """
+    reclamada = db.execute(
+        update(WaitlistDB)
+        .where(WaitlistDB.id == espera_id, WaitlistDB.estado == 'pendiente')
+        .values(estado='notificado', reservado_hasta=ahora + timedelta(hours=HORAS_RESERVA_ESPERA), actualizado_en=ahora)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+    if not reclamada:
+        return None
+    if not apartar_unidad(db, id_elemento, ahora):
+        db.execute(
+            update(WaitlistDB)
+            .where(WaitlistDB.id == espera_id)
+            .values(estado='pendiente', reservado_hasta=None)
+            .execution_options(synchronize_session=False)
+        )
+        return False
+    return True
+
+
+def promover_espera(db, id_elemento: str, ahora: datetime, cantidad: int = 1) -> int:
+    """
+    Reservar hasta 'cantidad' unidades disponibles del elemento para las solicitudes pendientes más antiguas.
+    Debe llamarse en la misma transacción que liberó las unidades. Retorna cuántas se reservaron.
+    """
+    candidatos = db.execute(
+        select(WaitlistDB.id)
+        .where(WaitlistDB.id_elemento == id_elemento, WaitlistDB.estado == 'pendiente')
+        .order_by(WaitlistDB.creado_en, WaitlistDB.id)
+        .limit(cantidad)
+    ).scalars().all()
+    reservadas = 0
+    for espera_id in candidatos:
+        reservada = reservar_solicitud(db, espera_id, id_elemento, ahora)
+        if reservada is None:
+            continue  # Otro worker la tomó
+        if not reservada:
+            break  # No quedan unidades
+        reservadas += 1
+    return reservadas
+
+
+def consumir_reserva(db, id_elemento: str, id_usuario: Optional[str], ahora: datetime) -> bool:
+    """Marcar como atendida la reserva vigente del usuario para el elemento. La unidad pasa a prestada."""
+    if not id_usuario:
+        return False
+    reservas = db.execute(
+        select(WaitlistDB.id)
+        .where(
+            WaitlistDB.id_elemento == id_elemento,
+            WaitlistDB.estado == 'notificado',
+            WaitlistDB.id_usuario == id_usuario,
+            WaitlistDB.reservado_hasta > ahora,
+        )
+        .order_by(WaitlistDB.creado_en)
+    ).scalars().all()
+    for espera_id in reservas:
+        if db.execute(
+            update(WaitlistDB)
+            .where(WaitlistDB.id == espera_id, WaitlistDB.estado == 'notificado')
+            .values(estado='atendido', actualizado_en=ahora)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1:
+            db.execute(
+                update(LibroDB)
+                .where(LibroDB.id == id_elemento)
+                .values(
+                    cantidad_prestado=func.coalesce(LibroDB.cantidad_prestado, 0) + 1,
+                    estado_disponibilidad=case((LibroDB.cantidad_disponible > 0, 'Disponible'), else_='Prestado'),
+                    actualizado_en=ahora,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            return True
+    return False
+
+
+def tiene_reserva(db, id_elemento: str, id_usuario: Optional[str], ahora: datetime) -> bool:
+    if not id_usuario:
+        return False
+    return db.execute(
+        select(WaitlistDB.id)
+        .where(
+            WaitlistDB.id_elemento == id_elemento,
+            WaitlistDB.estado == 'notificado',
+            WaitlistDB.id_usuario == id_usuario,
+            WaitlistDB.reservado_hasta > ahora,
+        )
+        .limit(1)
+    ).first() is not None
+
+
+def prestar_con_reserva(db, elemento: LibroDB, id_usuario: Optional[str], ahora: datetime) -> bool:
+    """Prestar una unidad al usuario: primero su reserva vigente, si no una unidad disponible. Ajusta el grupo."""
+    if consumir_reserva(db, elemento.id, id_usuario, ahora):
+        ajustar_grupo(db, elemento, cantidad_prestado=1)
+        return True
+    if prestar_unidad(db, elemento.id, ahora):
+        ajustar_grupo(db, elemento, cantidad_disponible=-1, cantidad_prestado=1)
+        return True
+    return False
+
+
+def devolver_y_promover(db, elemento: LibroDB, ahora: datetime, cantidad: int = 1) -> int:
+    """Reintegrar unidades y reservarlas para la lista de espera. Ajusta el grupo; retorna las reservadas."""
+    cambio_prestado = devolver_unidad(db, elemento.id, ahora, cantidad)
+    reservadas = promover_espera(db, elemento.id, ahora, cantidad)
+    ajustar_grupo(db, elemento, cantidad_disponible=cantidad - reservadas, cantidad_prestado=cambio_prestado)
+    return reservadas
+
+
+def liberar_reservas_vencidas(db, *, lote: Optional[int] = None, ahora: Optional[datetime] = None) -> int:
+    """
+    Barrido de reservas vencidas, por lotes (confirma cada lote): la solicitud pasa a 'expirado' y su
+    unidad se reserva para la siguiente solicitud pendiente o vuelve a cantidad_disponible.
+    Retorna cuántas reservas se liberaron.
+    """
+    lote = lote or LOTE_BARRIDO_ESPERA
+    liberadas = 0
+    while True:
+        ahora_lote = ahora or datetime.utcnow()
+        vencidas = db.execute(
+            select(WaitlistDB.id, WaitlistDB.id_elemento)
+            .where(WaitlistDB.estado == 'notificado', WaitlistDB.reservado_hasta <= ahora_lote)
+            .order_by(WaitlistDB.reservado_hasta)
+            .limit(lote)
+        ).all()
+        if not vencidas:
+            break
+        por_elemento: Dict[str, int] = {}
+        for espera_id, id_elemento in vencidas:
+            if db.execute(
+                update(WaitlistDB)
+                .where(WaitlistDB.id == espera_id, WaitlistDB.estado == 'notificado')
+                .values(estado='expirado', actualizado_en=ahora_lote)
+                .execution_options(synchronize_session=False)
+            ).rowcount == 1:
+                por_elemento[id_elemento] = por_elemento.get(id_elemento, 0) + 1
+        elementos = db.query(LibroDB).filter(LibroDB.id.in_(por_elemento)).all() if por_elemento else []
+        for elemento in elementos:
+            cantidad = por_elemento[elemento.id]
+            liberar_unidades(db, elemento.id, ahora_lote, cantidad)
+            reservadas = promover_espera(db, elemento.id, ahora_lote, cantidad)
+            ajustar_grupo(db, elemento, cantidad_disponible=cantidad - reservadas)
+        if elementos:
+            incrementar_version(db, VERSION_CATALOGO)
+        db.commit()
+        liberadas += sum(por_elemento.values())
+        if len(vencidas) < lote:
+            break
+    return liberadas
+
+
+registrar_tarea_periodica('barrido-espera', SEGUNDOS_BARRIDO_ESPERA, liberar_reservas_vencidas)
+
+
+def reconstruir_libro_grupo(db, *, lote: int = 1000) -> int:
+    """
+    Recalcular clave_grupo de todos los libros y reconstruir libro_grupo desde cero.
+    Pensado para bases de datos existentes (ver reconstruir_grupos.py). Retorna la cantidad de grupos.
+    """
+    ultimo_id = ''
+    while True:
+        libros = (
+            db.query(LibroDB)
+            .options(load_only(LibroDB.id, LibroDB.titulo, LibroDB.autor, LibroDB.isbn,
+                               LibroDB.codigo_inventario, LibroDB.clave_grupo))
+            .filter(LibroDB.id > ultimo_id)
+            .order_by(LibroDB.id.asc())
+            .limit(lote)
+            .all()
+        )
+        if not libros:
+            break
+        for libro in libros:
+            clave = clave_grupo(libro)
+            if libro.clave_grupo != clave:
+                libro.clave_grupo = clave
+        ultimo_id = libros[-1].id
+        db.flush()
+        db.expunge_all()
+
+    db.query(LibroGrupoDB).delete(synchronize_session=False)
+    agregado = select(*_columnas_agregado_grupos(), literal(datetime.utcnow(), DateTime)).group_by(LibroDB.clave_grupo)
+    db.execute(
+        insert(LibroGrupoDB).from_select(
+            ['clave', 'id_representativo', 'stock', 'cantidad_disponible', 'cantidad_prestado', 'copias', 'actualizado_en'],
+            agregado,
+        )
+    )
+    return db.query(LibroGrupoDB).count()
+
+
+# Campos que puede devolver /api/libros (proyección con ?fields=)
+CAMPOS_LIBRO_LISTADO = (
+    'id', 'titulo', 'autor', 'isbn', 'editorial', 'anio_publicacion', 'categoria', 'subcategoria',
+    'descripcion', 'estado_disponibilidad', 'estado_elemento', 'stock', 'cantidad_disponible',
+    'cantidad_prestado', 'imagen', 'codigo_inventario', 'creado_en', 'actualizado_en',
+)
+# Campos agregados por grupo (no se leen de la fila representativa)
+CAMPOS_LIBRO_TOTALES = ('stock', 'cantidad_disponible', 'cantidad_prestado')
+# Columnas por las que se puede ordenar el catálogo (?sort=campo o ?sort=-campo)
+ORDENES_CATALOGO = {
+    'titulo': LibroDB.titulo,
+    'creado_en': LibroDB.creado_en,
+    'actualizado_en': LibroDB.actualizado_en,
+}
+LIMITE_MAXIMO_CATALOGO = 500
+
+
+def libro_agrupado_to_dict(
+    libro: LibroDB,
+    stock_total: Optional[int],
+    cantidad_disponible_total: Optional[int],
+    cantidad_prestado_total: Optional[int],
+    campos: Optional[tuple[str, ...]] = None,
+) -> Dict[str, Any]:
+    esquema = ESQUEMA_LIBRO.proyectar(campos) if campos else ESQUEMA_LIBRO
+    item = esquema(libro)
+    # Los totales del grupo reemplazan las cantidades de la copia representativa
+    if 'stock' in item:
+        item['stock'] = int(stock_total or 0)
+    if 'cantidad_disponible' in item:
+        item['cantidad_disponible'] = int(cantidad_disponible_total or 0)
+    if 'cantidad_prestado' in item:
+        item['cantidad_prestado'] = int(cantidad_prestado_total or 0)
+    return item
+
+
+@app.get('/api/libros')
+def libros_listar():
+    """
+    Listar libros. Si hay múltiples copias del mismo libro, agruparlos por código_inventario o título/autor/ISBN.
+    Los grupos y sus totales se leen de libro_grupo, unidos a la copia representativa de cada grupo.
+
+    Parámetros opcionales:
+    - categoria, subcategoria, estado_elemento: filtros exactos sobre la copia representativa
+    - disponible=true|false: grupos con (o sin) unidades disponibles
+    - sort: titulo, creado_en o actualizado_en; prefijo '-' para orden descendente
+    - fields: lista separada por comas de campos a devolver (id siempre se incluye)
+    - limit / cursor: paginación keyset. Con limit la respuesta es {items, next_cursor}
+      Sin limit se devuelve el arreglo completo, enviado en streaming por lotes
+    """
+    campos = None
+    fields_arg = (request.args.get('fields') or '').strip()
+    if fields_arg:
+        solicitados = [f.strip() for f in fields_arg.split(',') if f.strip()]
+        invalidos = [f for f in solicitados if f not in CAMPOS_LIBRO_LISTADO]
+        if invalidos:
+            return jsonify({"ok": False, "error": f"Campos no válidos: {', '.join(invalidos)}"}), 400
+        campos = tuple(['id'] + [f for f in CAMPOS_LIBRO_LISTADO if f in solicitados and f != 'id'])
+
+    sort_arg = (request.args.get('sort') or 'creado_en').strip()
+    descendente = sort_arg.startswith('-')
+    sort_campo = sort_arg.lstrip('-')
+    if sort_campo not in ORDENES_CATALOGO:
+        return jsonify({"ok": False, "error": f"Orden no válido: {sort_arg}"}), 400
+    columna_orden = ORDENES_CATALOGO[sort_campo]
+
+    limite = None
+    if request.args.get('limit'):
+        try:
+            limite = int(request.args.get('limit'))
+        except ValueError:
+            return jsonify({"ok": False, "error": "limit debe ser un número entero"}), 400
+        if limite < 1 or limite > LIMITE_MAXIMO_CATALOGO:
+            return jsonify({"ok": False, "error": f"limit debe estar entre 1 y {LIMITE_MAXIMO_CATALOGO}"}), 400
+
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decodificar_cursor(request.args['cursor'], es_fecha=sort_campo != 'titulo')
+        if cursor is None:
+            return jsonify({"ok": False, "error": "cursor no válido"}), 400
+
+    db = SessionLocal()
+    try:
+        version = leer_version(db, VERSION_CATALOGO)
+        clave_cache = clave_cache_request()
+        cacheado = cache_catalogo.obtener(version, clave_cache)
+        if cacheado is not None:
+            return respuesta_json_cacheada(cacheado, 'HIT')
+
+        # "libros.id || ''" en la condición: SQLite no puede usar la clave primaria de libros para el join y
+        # recorre libros en el orden del índice (con LIMIT) en vez de leer todos los grupos y ordenarlos
+        q = (
+            db.query(LibroDB, LibroGrupoDB.stock, LibroGrupoDB.cantidad_disponible, LibroGrupoDB.cantidad_prestado)
+            .join(LibroGrupoDB, LibroGrupoDB.id_representativo == LibroDB.id + '')
+        )
+        for campo in ('categoria', 'subcategoria', 'estado_elemento'):
+            valor = (request.args.get(campo) or '').strip()
+            if valor:
+                q = q.filter(getattr(LibroDB, campo) == valor)
+        disponible = arg_bool('disponible')
+        if disponible is True:
+            q = q.filter(LibroGrupoDB.cantidad_disponible > 0)
+        elif disponible is False:
+            q = q.filter(LibroGrupoDB.cantidad_disponible <= 0)
+        if campos is not None:
+            columnas = {'id', 'creado_en', sort_campo} | {c for c in campos if c not in CAMPOS_LIBRO_TOTALES}
+            q = q.options(load_only(*[getattr(LibroDB, c) for c in columnas]))
+        if cursor is not None:
+            valor, ultimo_id = cursor
+            if descendente:
+                q = q.filter(or_(columna_orden < valor, and_(columna_orden == valor, LibroDB.id < ultimo_id)))
+            else:
+                q = q.filter(or_(columna_orden > valor, and_(columna_orden == valor, LibroDB.id > ultimo_id)))
+        if descendente:
+            q = q.order_by(columna_orden.desc(), LibroDB.id.desc())
+        else:
+            q = q.order_by(columna_orden.asc(), LibroDB.id.asc())
+        if limite is None:
+            # Catálogo completo: se envía en streaming y se guarda en caché si no es demasiado grande
+            respuesta = respuesta_json_stream(
+                lambda db_stream: q.with_session(db_stream),
+                lambda db_stream, filas: [
+                    libro_agrupado_to_dict(libro_base, stock_total, disp_total, prest_total, campos)
+                    for libro_base, stock_total, disp_total, prest_total in filas
+                ],
+                guardar=lambda contenido: cache_catalogo.guardar(version, clave_cache, contenido),
+            )
+            respuesta.headers['X-Cache'] = 'MISS'
+            return respuesta
+
+        rows = q.limit(limite + 1).all()
+
+        next_cursor = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            ultimo = rows[-1][0]
+            next_cursor = codificar_cursor(getattr(ultimo, sort_campo), ultimo.id)
+
+        items = [
+            libro_agrupado_to_dict(libro_base, stock_total, cantidad_disponible_total, cantidad_prestado_total, campos)
+            for libro_base, stock_total, cantidad_disponible_total, cantidad_prestado_total in rows
+        ]
+        contenido = json_bytes({"items": items, "next_cursor": next_cursor})
+        cache_catalogo.guardar(version, clave_cache, contenido)
+        return respuesta_json_cacheada(contenido, 'MISS')
+    finally:
+        db.close()
+
+
+@app.post('/api/libros')
+def libros_crear():
+    data = request.form.to_dict() if request.form else (request.get_json(silent=True) or {})
+    
+    # Debug: mostrar datos recibidos
+    print("=" * 60)
+    print("DATOS RECIBIDOS EN /api/libros:")
+    print(f"Tipo de request: {type(request.form)}")
+    print(f"Datos recibidos: {data}")
+    print(f"Campos en request.form: {list(request.form.keys()) if request.form else 'No hay form'}")
+    print("=" * 60)
+    
+    db = SessionLocal()
+    try:
+        # Validar campos requeridos
+        titulo = data.get('titulo', '').strip()
+        if not titulo:
+            return jsonify({"ok": False, "error": "El título es requerido"}), 400
+        
+        # Validar categoría
+        categoria = data.get('categoria', '').strip()
+        if not categoria:
+            return jsonify({"ok": False, "error": "La categoría es requerida"}), 400
+        
+        # Validar que para libros se tenga autor
+        es_equipo = 'equipo' in categoria.lower() or 'informático' in categoria.lower()
+        if not es_equipo:
+            autor = data.get('autor', '').strip()
+            if not autor:
+                return jsonify({"ok": False, "error": "El autor es requerido para libros"}), 400
+        # Para equipos, asegurar que autor sea cadena vacía si no está presente
+        elif es_equipo:
+            autor = data.get('autor', '').strip()
+            if not autor:
+                data['autor'] = ''  # Asegurar cadena vacía para equipos
+        
+        libro = libro_from_request_db(data)
+        
+        # Asegurar que todos los campos requeridos por la BD tengan valores
+        if not libro.titulo:
+            return jsonify({"ok": False, "error": "El título es requerido"}), 400
         if not libro.categoria:
             return jsonify({"ok": False, "error": "La categoría es requerida"}), 400
         if libro.stock is None:
@@ -967,7 +2351,11 @@ def libros_crear():
             libro.imagen = f"uploads/{stored_name}"
         
         print(f"Libro a crear: titulo={libro.titulo}, categoria={libro.categoria}, autor={libro.autor}")
+        libro.clave_grupo = clave_grupo(libro)
         db.add(libro)
+        recalcular_grupos(db, [libro.clave_grupo])
+        indexar_libros(db, [libro])
+        incrementar_version(db, VERSION_CATALOGO)
         db.commit()
         return jsonify({"ok": True, "id": libro.id}), 201
     except Exception as e:
@@ -992,62 +2380,222 @@ def libros_obtener(libro_id: str):
         if not r:
             return ("No encontrado", 404)
 
-        # Calcular información agregada para todas las copias relacionadas
-        if r.codigo_inventario and r.codigo_inventario.strip():
-            copias_relacionadas = db.query(LibroDB).filter(
-                LibroDB.codigo_inventario == r.codigo_inventario
-            ).all()
-        else:
-            titulo_norm = (r.titulo or '').strip()
-            autor_norm = (r.autor or '').strip()
-            isbn_norm = (r.isbn or '').strip()
-            copias_relacionadas = db.query(LibroDB).filter(
-                LibroDB.titulo == titulo_norm,
-                LibroDB.autor == autor_norm,
-                LibroDB.isbn == isbn_norm,
-                ((LibroDB.codigo_inventario == None) | (LibroDB.codigo_inventario == ''))
-            ).all()
-
-        if copias_relacionadas:
-            stock_total = sum(c.stock or 0 for c in copias_relacionadas)
-            cantidad_disponible_total = sum(c.cantidad_disponible or 0 for c in copias_relacionadas)
-            cantidad_prestado_total = sum(c.cantidad_prestado or 0 for c in copias_relacionadas)
+        # Información agregada de todas las copias relacionadas (materializada en libro_grupo)
+        clave = r.clave_grupo or clave_grupo(r)
+        grupo = db.get(LibroGrupoDB, clave)
+        copias_relacionadas = [
+            copia_id for (copia_id,) in db.query(LibroDB.id).filter(LibroDB.clave_grupo == clave).order_by(LibroDB.id.asc())
+        ]
+        if grupo:
+            stock_total = grupo.stock
+            cantidad_disponible_total = grupo.cantidad_disponible
+            cantidad_prestado_total = grupo.cantidad_prestado
         else:
             stock_total = r.stock or 0
             cantidad_disponible_total = r.cantidad_disponible or 0
             cantidad_prestado_total = r.cantidad_prestado or 0
 
         item = {
-            **{k: getattr(r, k) for k in [
-                'id',
-                'titulo',
-                'autor',
-                'isbn',
-                'editorial',
-                'anio_publicacion',
-                'categoria',
-                'subcategoria',
-                'descripcion',
-                'estado_disponibilidad',
-                'estado_elemento',
-                'stock',
-                'cantidad_disponible',
-                'cantidad_prestado',
-                'imagen',
-                'codigo_inventario',
-            ]},
-            'creado_en': r.creado_en.isoformat()+'Z',
-            'actualizado_en': r.actualizado_en.isoformat()+'Z',
+            **ESQUEMA_LIBRO(r),
             'stock_total': stock_total,
             'cantidad_disponible_total': cantidad_disponible_total,
             'cantidad_prestado_total': cantidad_prestado_total,
-            'copias_relacionadas': [c.id for c in copias_relacionadas] if copias_relacionadas else [r.id],
+            'copias_relacionadas': copias_relacionadas or [r.id],
         }
         return jsonify(item)
     finally:
         db.close()
 
 
+# -------------------------------
+# Búsqueda de texto completo en el catálogo
+# -------------------------------
+# SQLite usa una tabla virtual FTS5 (libros_fts) y PostgreSQL una tabla libro_busqueda con un
+# tsvector indexado con GIN. En ambos casos el texto se guarda sin tildes (plegar_texto) para que
+# "Cien años" y "cien anos" coincidan.
+
+CAMPOS_BUSQUEDA = ('titulo', 'autor', 'editorial', 'isbn', 'descripcion', 'codigo_inventario')
+# Peso de cada campo en el ranking (mismo orden que CAMPOS_BUSQUEDA)
+PESOS_BUSQUEDA_FTS5 = (10.0, 6.0, 2.0, 8.0, 1.0, 8.0)
+PESOS_BUSQUEDA_PG = ('A', 'A', 'C', 'B', 'D', 'B')
+LIMITE_MAXIMO_BUSQUEDA = 100
+
+
+def es_postgres() -> bool:
+    return engine.dialect.name == 'postgresql'
+
+
+def plegar_texto(valor: Optional[str]) -> str:
+    """Minúsculas y sin tildes/diacríticos: 'Cien Años' -> 'cien anos'."""
+    descompuesto = unicodedata.normalize('NFKD', valor or '')
+    return ''.join(c for c in descompuesto if not unicodedata.combining(c)).lower()
+
+
+def terminos_busqueda(consulta: str) -> List[str]:
+    """Separar la consulta en términos alfanuméricos ya plegados (máximo 10)."""
+    return re.findall(r'\w+', plegar_texto(consulta))[:10]
+
+
+def crear_indice_busqueda(db) -> None:
+    """Crear las estructuras del índice de búsqueda según el motor de base de datos."""
+    if es_postgres():
+        db.execute(text("""
+            CREATE TABLE IF NOT EXISTS libro_busqueda (
+                id VARCHAR(64) PRIMARY KEY,
+                documento TSVECTOR NOT NULL
+            )
+        """))
+        db.execute(text("CREATE INDEX IF NOT EXISTS idx_libro_busqueda_documento ON libro_busqueda USING GIN (documento)"))
+    else:
+        columnas = ", ".join(CAMPOS_BUSQUEDA)
+        db.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS libros_fts USING fts5("
+            f"id UNINDEXED, {columnas}, tokenize='unicode61 remove_diacritics 2')"
+        ))
+
+
+def desindexar_libros(db, ids: Iterable[str]) -> None:
+    """Quitar libros del índice de búsqueda (dentro de la transacción actual)."""
+    ids = list({i for i in ids if i})
+    tabla = 'libro_busqueda' if es_postgres() else 'libros_fts'
+    for i in range(0, len(ids), 500):
+        lote = ids[i:i + 500]
+        marcadores = ", ".join(f":id{n}" for n in range(len(lote)))
+        db.execute(text(f"DELETE FROM {tabla} WHERE id IN ({marcadores})"), {f"id{n}": v for n, v in enumerate(lote)})
+
+
+def indexar_libros(db, libros: Iterable[LibroDB]) -> None:
+    """Insertar o reemplazar libros en el índice de búsqueda (dentro de la transacción actual)."""
+    filas = [
+        {'id': libro.id, **{campo: plegar_texto(getattr(libro, campo)) for campo in CAMPOS_BUSQUEDA}}
+        for libro in libros
+    ]
+    if not filas:
+        return
+    desindexar_libros(db, [f['id'] for f in filas])
+    if es_postgres():
+        documento = " || ".join(
+            f"setweight(to_tsvector('simple', :{campo}), '{peso}')"
+            for campo, peso in zip(CAMPOS_BUSQUEDA, PESOS_BUSQUEDA_PG)
+        )
+        db.execute(text(f"INSERT INTO libro_busqueda (id, documento) VALUES (:id, {documento})"), filas)
+    else:
+        columnas = ", ".join(CAMPOS_BUSQUEDA)
+        valores = ", ".join(f":{campo}" for campo in CAMPOS_BUSQUEDA)
+        db.execute(text(f"INSERT INTO libros_fts (id, {columnas}) VALUES (:id, {valores})"), filas)
+
+
+def reconstruir_indice_busqueda(db, *, lote: int = 1000) -> int:
+    """Regenerar el índice de búsqueda completo a partir de la tabla libros. Retorna los libros indexados."""
+    crear_indice_busqueda(db)
+    db.execute(text("DELETE FROM libro_busqueda" if es_postgres() else "DELETE FROM libros_fts"))
+    total = 0
+    ultimo_id = ''
+    while True:
+        libros = (
+            db.query(LibroDB)
+            .options(load_only(LibroDB.id, *[getattr(LibroDB, c) for c in CAMPOS_BUSQUEDA]))
+            .filter(LibroDB.id > ultimo_id)
+            .order_by(LibroDB.id.asc())
+            .limit(lote)
+            .all()
+        )
+        if not libros:
+            break
+        indexar_libros(db, libros)
+        total += len(libros)
+        ultimo_id = libros[-1].id
+        db.expunge_all()
+    return total
+
+
+def _consulta_rangos_busqueda(terminos: List[str]) -> tuple[str, Dict[str, Any]]:
+    """SQL que devuelve (clave_grupo, rango) por grupo coincidente; mayor rango = más relevante."""
+    if es_postgres():
+        consulta = " & ".join(f"{t}:*" for t in terminos)
+        sql = """
+            SELECT l.clave_grupo AS clave, MAX(ts_rank(b.documento, to_tsquery('simple', :consulta))) AS rango
+            FROM libro_busqueda b JOIN libros l ON l.id = b.id
+            WHERE b.documento @@ to_tsquery('simple', :consulta)
+            GROUP BY l.clave_grupo
+        """
+    else:
+        consulta = " ".join(f'"{t}"*' for t in terminos)
+        pesos = ", ".join(str(p) for p in PESOS_BUSQUEDA_FTS5)
+        # bm25 es menor cuanto más relevante: se invierte el signo para ordenar igual que en PostgreSQL.
+        # 'LIMIT -1' evita que SQLite aplane la subconsulta (bm25 no se puede usar dentro de un agregado).
+        sql = f"""
+            SELECT clave, MAX(rango) AS rango FROM (
+                SELECT l.clave_grupo AS clave, -bm25(libros_fts, 0.0, {pesos}) AS rango
+                FROM libros_fts JOIN libros l ON l.id = libros_fts.id
+                WHERE libros_fts MATCH :consulta
+                LIMIT -1
+            ) coincidencias
+            GROUP BY clave
+        """
+    return sql, {'consulta': consulta}
+
+
+@app.get('/api/libros/buscar')
+def libros_buscar():
+    """
+    Búsqueda de texto completo sobre título, autor, editorial, ISBN, descripción y código de inventario.
+    Ignora tildes y mayúsculas, admite prefijos ('soled' encuentra 'Soledad') y exige todos los términos.
+    Devuelve grupos de copias (como /api/libros) ordenados por relevancia.
+    Parámetros: q (requerido), limit (por defecto 20), page (desde 1), fields.
+    """
+    terminos = terminos_busqueda(request.args.get('q') or '')
+    if not terminos:
+        return jsonify({"ok": False, "error": "El parámetro q es requerido"}), 400
+    try:
+        limite = int(request.args.get('limit') or 20)
+        pagina = int(request.args.get('page') or 1)
+    except ValueError:
+        return jsonify({"ok": False, "error": "limit y page deben ser números enteros"}), 400
+    if limite < 1 or limite > LIMITE_MAXIMO_BUSQUEDA or pagina < 1:
+        return jsonify({"ok": False, "error": f"limit debe estar entre 1 y {LIMITE_MAXIMO_BUSQUEDA} y page ser mayor a 0"}), 400
+
+    campos = None
+    fields_arg = (request.args.get('fields') or '').strip()
+    if fields_arg:
+        solicitados = [f.strip() for f in fields_arg.split(',') if f.strip()]
+        invalidos = [f for f in solicitados if f not in CAMPOS_LIBRO_LISTADO]
+        if invalidos:
+            return jsonify({"ok": False, "error": f"Campos no válidos: {', '.join(invalidos)}"}), 400
+        campos = tuple(['id'] + [f for f in CAMPOS_LIBRO_LISTADO if f in solicitados and f != 'id'])
+
+    db = SessionLocal()
+    try:
+        sql, params = _consulta_rangos_busqueda(terminos)
+        params.update({'limite': limite + 1, 'desplazamiento': (pagina - 1) * limite})
+        rangos = db.execute(
+            text(f"{sql} ORDER BY rango DESC, clave ASC LIMIT :limite OFFSET :desplazamiento"), params
+        ).all()
+        hay_mas = len(rangos) > limite
+        rangos = rangos[:limite]
+
+        items = []
+        if rangos:
+            claves = [r.clave for r in rangos]
+            filas = (
+                db.query(LibroGrupoDB, LibroDB)
+                .join(LibroDB, LibroDB.id == LibroGrupoDB.id_representativo)
+                .filter(LibroGrupoDB.clave.in_(claves))
+                .all()
+            )
+            por_clave = {grupo.clave: (grupo, libro) for grupo, libro in filas}
+            for r in rangos:
+                if r.clave not in por_clave:
+                    continue
+                grupo, libro = por_clave[r.clave]
+                item = libro_agrupado_to_dict(libro, grupo.stock, grupo.cantidad_disponible, grupo.cantidad_prestado, campos)
+                item['relevancia'] = round(float(r.rango or 0), 6)
+                items.append(item)
+        return jsonify({"items": items, "page": pagina, "limit": limite, "has_more": hay_mas})
+    finally:
+        db.close()
+
+
 # -------------------------------
 # Préstamos
 # -------------------------------
@@ -1103,12 +2651,12 @@ def crear_prestamo():
         if not es_libro and not id_usuario_final:
             return jsonify({"ok": False, "error": "id_usuario es requerido para préstamos de equipos"}), 400
 
-        # Validar disponibilidad; si no hay, crear espera
-        if (elemento.cantidad_disponible or 0) <= 0:
+        # Validar disponibilidad; si no hay (y el usuario no tiene una reserva vigente), crear espera
+        if (elemento.cantidad_disponible or 0) <= 0 and not tiene_reserva(db, id_elemento_real, id_usuario_final, datetime.utcnow()):
             # Crear entrada en waitlist si el cliente lo solicita
             contacto = data.get('contacto') or id_usuario_final
             noww = datetime.utcnow()
-            w = WaitlistDB(id=str(uuid.uuid4()), id_elemento=id_elemento_real, id_usuario=id_usuario_final, contacto=contacto, estado='pendiente', creado_en=noww, actualizado_en=noww)
+            w = WaitlistDB(id=str(uuid.uuid4()), id_elemento=id_elemento_real, id_usuario=id_usuario_final, usuario_original=id_usuario_raw, contacto=contacto, estado='pendiente', creado_en=noww, actualizado_en=noww)
             db.add(w)
             db.commit()
             return jsonify({"ok": False, "error": "Elemento no disponible. Te agregamos a la lista de espera.", "waitlist_id": w.id}), 202
@@ -1128,6 +2676,7 @@ def crear_prestamo():
             id=str(uuid.uuid4()),
             id_elemento=id_elemento_real,  # Usar ID real del elemento, no el del formulario
             id_usuario=id_usuario_final,  # Usar ID real del usuario
+            usuario_original=id_usuario_raw,
             fecha_prestamo=fecha_prestamo,
             fecha_devolucion=fecha_devolucion,
             observaciones=observaciones,
@@ -1137,95 +2686,145 @@ def crear_prestamo():
         )
 
         db.add(prestamo)
+        acumular_estadistica_prestamos(db, [(prestamo, elemento.categoria, None, 'pendiente')])
         db.commit()
         return jsonify({"ok": True, "id": prestamo.id}), 201
     finally:
         db.close()
 
+
+def enriquecer_prestamos(db, rows: List[PrestamoDB]) -> List[Dict[str, Any]]:
+    """
+    Serializar un lote de préstamos con datos de usuario y elemento.
+    Usuarios y elementos se resuelven con una consulta IN cada uno para todo el lote.
+    """
+    elemento_ids = {r.id_elemento for r in rows if r.id_elemento}
+
+    # mapa_usuarios también resuelve referencias sin normalizar (documento o username)
+    usuarios_map = mapa_usuarios(db, {r.id_usuario for r in rows if r.id_usuario})
+
+    elementos_map = {}
+    if elemento_ids:
+        elementos = db.query(LibroDB).options(
+            load_only(LibroDB.id, LibroDB.titulo, LibroDB.autor, LibroDB.categoria, LibroDB.codigo_inventario)
+        ).filter(LibroDB.id.in_(elemento_ids)).all()
+        elementos_map = {e.id: e for e in elementos}
+
+    items = []
+    for r in rows:
+        usuario_data = None
+        user = usuarios_map.get(r.id_usuario) if r.id_usuario else None
+        if user:
+            usuario_data = {
+                'id': user.id,
+                'nombre': user.nombre,
+                'documento': user.documento,
+                'numero_ficha': getattr(user, 'numero_ficha', None),
+                'correo': getattr(user, 'correo', None),
+            }
+
+        elemento_data = None
+        elemento = elementos_map.get(r.id_elemento)
+        if elemento:
+            elemento_data = {
+                'titulo': elemento.titulo,
+                'autor': elemento.autor,
+                'categoria': elemento.categoria,
+                'codigo_inventario': elemento.codigo_inventario,
+            }
+
+        item = ESQUEMA_PRESTAMO(r)
+        item['usuario'] = usuario_data
+        item['elemento'] = elemento_data
+        items.append(item)
+    return items
+
+
+LIMITE_MAXIMO_PRESTAMOS = 500
+
+
 @app.get('/prestamos')
 def listar_prestamos():
+    """
+    Listar préstamos del más reciente al más antiguo, con datos de usuario y elemento.
+
+    Parámetros opcionales:
+    - estado, usuario (ID, documento o username), id: filtros
+    - limit / cursor: paginación keyset sobre (creado_en, id). Con limit la respuesta es {items, next_cursor}
+      Sin limit se devuelve el arreglo completo, enviado en streaming por lotes
+    - counts=true: agrega 'counts' con el total por estado (aplica usuario e id, no estado).
+      Sin limit la respuesta es solo {counts, total}
+    """
     estado = request.args.get('estado')
     usuario = request.args.get('usuario')  # ID, documento o username del usuario
     prestamo_id = request.args.get('id')  # Búsqueda por ID de préstamo
-    db = SessionLocal()
-    try:
-        q = db.query(PrestamoDB)
-        
+    con_totales = arg_bool('counts') is True
+
+    limite = None
+    if request.args.get('limit'):
+        try:
+            limite = int(request.args.get('limit'))
+        except ValueError:
+            return jsonify({"ok": False, "error": "limit debe ser un número entero"}), 400
+        if limite < 1 or limite > LIMITE_MAXIMO_PRESTAMOS:
+            return jsonify({"ok": False, "error": f"limit debe estar entre 1 y {LIMITE_MAXIMO_PRESTAMOS}"}), 400
+
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decodificar_cursor(request.args['cursor'], es_fecha=True)
+        if cursor is None:
+            return jsonify({"ok": False, "error": "cursor no válido"}), 400
+
+    def filtrar(q, db, *, por_estado: bool = True):
         # Búsqueda por ID de préstamo
         if prestamo_id:
             q = q.filter(PrestamoDB.id == prestamo_id)
-        
-        if estado:
+
+        if estado and por_estado:
             q = q.filter(PrestamoDB.estado == estado)
-            
+
         if usuario:
-            # Filtrar por usuario (buscar por ID, documento o username)
-            # Primero intentar encontrar el usuario
-            user_match = db.query(UserDB).filter(
-                (UserDB.id == usuario) | (UserDB.documento == usuario) | (UserDB.username == usuario)
-            ).first()
-            if user_match:
-                # Usar el ID encontrado - BUSCAR POR ID O DOCUMENTO EN EL PRÉSTAMO
-                q = q.filter(
-                    (PrestamoDB.id_usuario == user_match.id) | 
-                    (PrestamoDB.id_usuario == user_match.documento)
-                )
-            else:
-                # Si no se encuentra, buscar directamente por ID o documento en préstamos
-                q = q.filter(
-                    (PrestamoDB.id_usuario == usuario) | 
-                    (PrestamoDB.id_usuario.like(f'%{usuario}%'))
-                )
-        
-        rows = q.order_by(PrestamoDB.creado_en.desc()).all()
-        
-        # Enriquecer con datos de usuario y elemento
-        items = []
-        for r in rows:
-            # Obtener datos del usuario
-            usuario_data = None
-            if r.id_usuario:
-                user = db.query(UserDB).filter(
-                    (UserDB.id == r.id_usuario) | (UserDB.documento == r.id_usuario) | (UserDB.username == r.id_usuario)
-                ).first()
-                if user:
-                    usuario_data = {
-                        'id': user.id,
-                        'nombre': user.nombre,
-                        'documento': user.documento,
-                        'numero_ficha': getattr(user, 'numero_ficha', None),
-                        'correo': getattr(user, 'correo', None),
-                    }
-            
-            # Obtener datos del elemento
-            elemento_data = None
-            elemento = db.get(LibroDB, r.id_elemento)
-            if elemento:
-                elemento_data = {
-                    'titulo': elemento.titulo,
-                    'autor': elemento.autor,
-                    'categoria': elemento.categoria,
-                    'codigo_inventario': elemento.codigo_inventario,
-                }
-            
-            items.append({
-                'id': r.id,
-                'id_elemento': r.id_elemento,
-                'id_usuario': r.id_usuario,
-                'fecha_prestamo': r.fecha_prestamo.isoformat()+'Z',
-                'fecha_devolucion': r.fecha_devolucion.isoformat()+'Z' if r.fecha_devolucion else None,
-                'observaciones': r.observaciones,
-                'estado': r.estado,
-                'creado_en': r.creado_en.isoformat()+'Z',
-                'actualizado_en': r.actualizado_en.isoformat()+'Z',
-                'usuario': usuario_data,
-                'elemento': elemento_data,
-            })
-        
-        return jsonify(items)
+            # Filtrar por usuario (ID, documento o username): id_usuario guarda el UserDB.id
+            q = q.filter(PrestamoDB.id_usuario == id_usuario_canonico(db, usuario))
+        return q
+
+    def consulta(db):
+        return filtrar(db.query(PrestamoDB), db).order_by(PrestamoDB.creado_en.desc(), PrestamoDB.id.desc())
+
+    if limite is None and not con_totales:
+        # Enriquecer con datos de usuario y elemento, lote por lote
+        return respuesta_json_stream(consulta, enriquecer_prestamos)
+
+    db = SessionLocal()
+    try:
+        respuesta: Dict[str, Any] = {}
+        if limite is not None:
+            q = consulta(db)
+            if cursor is not None:
+                valor, ultimo_id = cursor
+                q = q.filter(or_(
+                    PrestamoDB.creado_en < valor,
+                    and_(PrestamoDB.creado_en == valor, PrestamoDB.id < ultimo_id),
+                ))
+            rows = q.limit(limite + 1).all()
+            next_cursor = None
+            if len(rows) > limite:
+                rows = rows[:limite]
+                next_cursor = codificar_cursor(rows[-1].creado_en, rows[-1].id)
+            respuesta['items'] = enriquecer_prestamos(db, rows)
+            respuesta['next_cursor'] = next_cursor
+        if con_totales:
+            # Totales por estado en un solo GROUP BY
+            totales = filtrar(db.query(PrestamoDB.estado, func.count(PrestamoDB.id)), db, por_estado=False)
+            counts = {e: int(n) for e, n in totales.group_by(PrestamoDB.estado).all()}
+            respuesta['counts'] = counts
+            if limite is None:
+                respuesta['total'] = sum(counts.values())
+        return jsonify(respuesta)
     finally:
         db.close()
 
+
 @app.post('/prestamos/manual')
 def crear_prestamo_manual():
     data = request.get_json(silent=True) or request.form.to_dict()
@@ -1239,15 +2838,15 @@ def crear_prestamo_manual():
         elemento = db.get(LibroDB, id_elemento)
         if not elemento:
             return jsonify({"ok": False, "error": "Elemento no encontrado"}), 404
-        if (elemento.cantidad_disponible or 0) <= 0:
-            return jsonify({"ok": False, "error": "Elemento no disponible"}), 409
         now = datetime.utcnow()
-        p = PrestamoDB(id=str(uuid.uuid4()), id_elemento=id_elemento, id_usuario=documento, fecha_prestamo=now, fecha_devolucion=None, observaciones=observaciones, estado='aprobado', creado_en=now, actualizado_en=now)
-        elemento.cantidad_disponible = int((elemento.cantidad_disponible or 0) - 1)
-        elemento.cantidad_prestado = int((elemento.cantidad_prestado or 0) + 1)
-        elemento.estado_disponibilidad = 'Prestado' if elemento.cantidad_disponible == 0 else 'Disponible'
-        elemento.actualizado_en = now
+        id_usuario = id_usuario_canonico(db, documento)
+        if not prestar_con_reserva(db, elemento, id_usuario, now):
+            db.rollback()
+            return jsonify({"ok": False, "error": "Elemento no disponible"}), 409
+        p = PrestamoDB(id=str(uuid.uuid4()), id_elemento=id_elemento, id_usuario=id_usuario, usuario_original=documento, fecha_prestamo=now, fecha_devolucion=None, observaciones=observaciones, estado='aprobado', creado_en=now, actualizado_en=now)
+        incrementar_version(db, VERSION_CATALOGO)
         db.add(p)
+        acumular_estadistica_prestamos(db, [(p, elemento.categoria, None, 'aprobado')])
         db.commit()
         return jsonify({"ok": True, "id": p.id}), 201
     except Exception as e:
@@ -1272,15 +2871,17 @@ def aprobar_prestamo(prestamo_id: str):
         es_libro = categoria == 'libros'
         if not es_libro and not p.id_usuario:
             return jsonify({"ok": False, "error": "id_usuario es requerido para equipos"}), 400
-        if (elemento.cantidad_disponible or 0) <= 0:
+        now = datetime.utcnow()
+        # Otra solicitud pudo aprobarlo (o rechazarlo) después de leerlo
+        if not cambiar_estado_prestamo(db, p.id, 'pendiente', 'aprobado', now):
+            db.rollback()
+            return jsonify({"ok": False, "error": "Solo se pueden aprobar préstamos pendientes"}), 409
+        # Aplicar impacto de stock al aprobar (usa la reserva de lista de espera del usuario si la tiene)
+        if not prestar_con_reserva(db, elemento, p.id_usuario, now):
+            db.rollback()
             return jsonify({"ok": False, "error": "Elemento no disponible"}), 409
-        # Aplicar impacto de stock al aprobar
-        elemento.cantidad_disponible = int((elemento.cantidad_disponible or 0) - 1)
-        elemento.cantidad_prestado = int((elemento.cantidad_prestado or 0) + 1)
-        elemento.estado_disponibilidad = 'Prestado' if elemento.cantidad_disponible == 0 else 'Disponible'
-        elemento.actualizado_en = datetime.utcnow()
-        p.estado = 'aprobado'
-        p.actualizado_en = datetime.utcnow()
+        acumular_estadistica_prestamos(db, [(p, elemento.categoria, 'pendiente', 'aprobado')])
+        incrementar_version(db, VERSION_CATALOGO)
         db.commit()
         return jsonify({"ok": True})
     except Exception as e:
@@ -1298,10 +2899,18 @@ def rechazar_prestamo(prestamo_id: str):
             return ("No encontrado", 404)
         if p.estado != 'pendiente':
             return jsonify({"ok": False, "error": "Solo se pueden rechazar préstamos pendientes"}), 400
-        p.estado = 'rechazado'
-        p.actualizado_en = datetime.utcnow()
+        elemento = db.get(LibroDB, p.id_elemento)
+        # Otra solicitud pudo aprobarlo (o rechazarlo) después de leerlo: no pisar su estado ni su stock
+        if not cambiar_estado_prestamo(db, p.id, 'pendiente', 'rechazado', datetime.utcnow()):
+            db.rollback()
+            return jsonify({"ok": False, "error": "Solo se pueden rechazar préstamos pendientes"}), 409
+        # El rollup se mueve solo tras ganar el UPDATE condicional (ver acumular_estadistica_prestamos)
+        acumular_estadistica_prestamos(db, [(p, elemento.categoria if elemento else None, 'pendiente', 'rechazado')])
         db.commit()
         return jsonify({"ok": True})
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": f"Error al rechazar préstamo: {str(e)}"}), 500
     finally:
         db.close()
 
@@ -1317,61 +2926,709 @@ def devolver_prestamo(prestamo_id: str):
         elemento = db.get(LibroDB, p.id_elemento)
         if not elemento:
             return jsonify({"ok": False, "error": "Elemento no encontrado"}), 404
-        # Incrementar cantidad disponible y decrementar cantidad prestado
-        elemento.cantidad_disponible = int((elemento.cantidad_disponible or 0) + 1)
-        elemento.cantidad_prestado = int((elemento.cantidad_prestado or 0) - 1) if (elemento.cantidad_prestado or 0) > 0 else 0
-        # Actualizar estado de disponibilidad basado en stock disponible
-        elemento.estado_disponibilidad = 'Disponible' if (elemento.cantidad_disponible or 0) > 0 else 'Agotado'
-        elemento.actualizado_en = datetime.utcnow()
-        p.estado = 'devuelto'
-        p.fecha_devolucion = datetime.utcnow()
-        p.actualizado_en = datetime.utcnow()
+        now = datetime.utcnow()
+        if not cambiar_estado_prestamo(db, p.id, 'aprobado', 'devuelto', now, fecha_devolucion=now):
+            db.rollback()
+            return jsonify({"ok": False, "error": "Solo se pueden devolver préstamos aprobados"}), 409
+        # Reintegrar la unidad; si hay lista de espera queda reservada para la primera solicitud
+        reservadas = devolver_y_promover(db, elemento, now)
+        acumular_estadistica_prestamos(db, [(p, elemento.categoria, 'aprobado', 'devuelto')])
+        incrementar_version(db, VERSION_CATALOGO)
         db.commit()
-        # Notificar lista de espera (marcar primer pendiente como notificado)
-        try:
-            w = db.query(WaitlistDB).filter(WaitlistDB.id_elemento == p.id_elemento, WaitlistDB.estado == 'pendiente').order_by(WaitlistDB.creado_en.asc()).first()
-            if w:
-                w.estado = 'notificado'
-                w.actualizado_en = datetime.utcnow()
-                db.commit()
-        except Exception:
-            pass  # Si hay error al notificar waitlist, no es crítico
-        return jsonify({"ok": True})
+        return jsonify({"ok": True, "reservada_para_espera": bool(reservadas)})
     except Exception as e:
         db.rollback()
         return jsonify({"ok": False, "error": f"Error al devolver préstamo: {str(e)}"}), 500
     finally:
         db.close()
 
+ACCIONES_LOTE_PRESTAMOS = {
+    # acción: (estado requerido, estado final)
+    'aprobar': ('pendiente', 'aprobado'),
+    'rechazar': ('pendiente', 'rechazado'),
+    'devolver': ('aprobado', 'devuelto'),
+}
+LIMITE_LOTE_PRESTAMOS = 500
+
+
+@app.post('/prestamos/lote')
+def prestamos_lote():
+    """
+    Aprobar, rechazar o devolver varios préstamos en una sola transacción.
+    Body: {"accion": "aprobar|rechazar|devolver", "ids": [...]}
+    Aplica las mismas reglas que las rutas individuales; las cantidades se actualizan con un UPDATE
+    por elemento. Responde 200 con el resultado de cada id (los fallos no impiden procesar el resto).
+    """
+    data = request.get_json(silent=True) or {}
+    accion = (data.get('accion') or '').strip().lower()
+    if accion not in ACCIONES_LOTE_PRESTAMOS:
+        return jsonify({"ok": False, "error": f"accion debe ser una de: {', '.join(ACCIONES_LOTE_PRESTAMOS)}"}), 400
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, str) and i for i in ids):
+        return jsonify({"ok": False, "error": "ids debe ser una lista de IDs de préstamo"}), 400
+    ids = list(dict.fromkeys(ids))  # sin duplicados, conservando el orden
+    if len(ids) > LIMITE_LOTE_PRESTAMOS:
+        return jsonify({"ok": False, "error": f"Máximo {LIMITE_LOTE_PRESTAMOS} préstamos por lote"}), 400
+
+    desde, hacia = ACCIONES_LOTE_PRESTAMOS[accion]
+    resultados: Dict[str, Dict[str, Any]] = {}
+
+    def fallo(prestamo_id: str, codigo: int, error: str) -> None:
+        resultados[prestamo_id] = {"id": prestamo_id, "ok": False, "codigo": codigo, "error": error}
+
+    db = SessionLocal()
+    try:
+        prestamos_map = {p.id: p for p in db.query(PrestamoDB).filter(PrestamoDB.id.in_(ids)).all()}
+        elemento_ids = {p.id_elemento for p in prestamos_map.values()}
+        elementos_map = {e.id: e for e in db.query(LibroDB).filter(LibroDB.id.in_(elemento_ids)).all()} if elemento_ids else {}
+        now = datetime.utcnow()
+
+        # Reglas de negocio y reclamo del préstamo (UPDATE condicional sobre su estado)
+        reclamados: Dict[str, List[PrestamoDB]] = {}
+        for prestamo_id in ids:
+            p = prestamos_map.get(prestamo_id)
+            if not p:
+                fallo(prestamo_id, 404, "No encontrado")
+                continue
+            if p.estado != desde:
+                fallo(prestamo_id, 400, f"Solo se pueden {accion} préstamos {desde}s")
+                continue
+            elemento = elementos_map.get(p.id_elemento)
+            if accion != 'rechazar':
+                if not elemento:
+                    fallo(prestamo_id, 404, "Elemento no encontrado")
+                    continue
+                es_libro = (elemento.categoria or '').strip().lower() == 'libros'
+                if accion == 'aprobar' and not es_libro and not p.id_usuario:
+                    fallo(prestamo_id, 400, "id_usuario es requerido para equipos")
+                    continue
+            valores = {'fecha_devolucion': now} if accion == 'devolver' else {}
+            if not cambiar_estado_prestamo(db, p.id, desde, hacia, now, **valores):
+                fallo(prestamo_id, 409, f"Solo se pueden {accion} préstamos {desde}s")
+                continue
+            reclamados.setdefault(p.id_elemento, []).append(p)
+
+        # Cantidades: un UPDATE por elemento para todos sus préstamos del lote
+        catalogo_cambiado = False
+        cambios = []
+        for id_elemento, lista in reclamados.items():
+            elemento = elementos_map.get(id_elemento)
+            if accion == 'aprobar':
+                # Primero los usuarios con reserva de lista de espera, luego las solicitudes más antiguas
+                con_reserva = [p for p in lista if consumir_reserva(db, id_elemento, p.id_usuario, now)]
+                if con_reserva:
+                    ajustar_grupo(db, elemento, cantidad_prestado=len(con_reserva))
+                resto = sorted((p for p in lista if p not in con_reserva), key=lambda p: p.creado_en)
+                concedidas = prestar_hasta(db, id_elemento, now, len(resto))
+                for p in resto[concedidas:]:
+                    # Sin unidades: el préstamo vuelve a quedar pendiente
+                    cambiar_estado_prestamo(db, p.id, hacia, desde, p.actualizado_en)
+                    fallo(p.id, 409, "Elemento no disponible")
+                lista = con_reserva + resto[:concedidas]
+                if concedidas:
+                    ajustar_grupo(db, elemento, cantidad_disponible=-concedidas, cantidad_prestado=concedidas)
+                catalogo_cambiado = catalogo_cambiado or bool(lista)
+            elif accion == 'devolver':
+                # Las unidades devueltas se reservan primero para la lista de espera del elemento
+                devolver_y_promover(db, elemento, now, len(lista))
+                catalogo_cambiado = True
+            for p in lista:
+                resultados[p.id] = {"id": p.id, "ok": True, "estado": hacia}
+                cambios.append((p, elemento.categoria if elemento else None, desde, hacia))
+
+        acumular_estadistica_prestamos(db, cambios)
+        if catalogo_cambiado:
+            incrementar_version(db, VERSION_CATALOGO)
+        db.commit()
+
+        items = [resultados[i] for i in ids]
+        procesados = sum(1 for r in items if r["ok"])
+        return jsonify({
+            "ok": True,
+            "accion": accion,
+            "procesados": procesados,
+            "fallidos": len(items) - procesados,
+            "resultados": items,
+        })
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": f"Error al procesar el lote: {str(e)}"}), 500
+    finally:
+        db.close()
+
+
 # Inventario resumen y espera
+@app.get('/api/estadisticas/prestamos')
+def estadisticas_prestamos():
+    """
+    Préstamos por periodo desde el rollup diario (no recorre la tabla prestamos).
+    Parámetros: desde, hasta (YYYY-MM-DD, por defecto el año en curso), agrupar (dia|mes|anio), categoria
+    """
+    hoy = datetime.utcnow().date()
+    agrupar = (request.args.get('agrupar') or 'mes').strip().lower()
+    if agrupar not in AGRUPACIONES_ESTADISTICA:
+        return jsonify({"ok": False, "error": f"agrupar debe ser uno de: {', '.join(AGRUPACIONES_ESTADISTICA)}"}), 400
+    fechas = {}
+    for nombre, defecto in (('desde', date(hoy.year, 1, 1)), ('hasta', hoy)):
+        valor = parse_iso_datetime(request.args.get(nombre))
+        if request.args.get(nombre) and valor is None:
+            return jsonify({"ok": False, "error": f"{nombre} debe tener formato YYYY-MM-DD"}), 400
+        fechas[nombre] = valor.date() if valor else defecto
+    db = SessionLocal()
+    try:
+        periodos = resumen_estadistica_prestamos(
+            db, fechas['desde'], fechas['hasta'], agrupar=agrupar, categoria=request.args.get('categoria') or None
+        )
+        return jsonify({
+            'desde': fechas['desde'].isoformat(),
+            'hasta': fechas['hasta'].isoformat(),
+            'agrupar': agrupar,
+            'periodos': periodos,
+        })
+    finally:
+        db.close()
+
+# Agregado del catálogo por (categoria, subcategoria), compartido por las facetas y el resumen de inventario.
+# Se calcula con un solo GROUP BY y se conserva en el worker mientras no cambie la versión del catálogo.
+_agregado_categorias: Optional[tuple[int, List[tuple]]] = None
+_agregado_categorias_lock = threading.Lock()
+
+
+def agregado_categorias(db, version: int) -> List[tuple]:
+    """Filas (categoria, subcategoria, copias, total, disponible, prestado) de la versión indicada"""
+    global _agregado_categorias
+    with _agregado_categorias_lock:
+        if _agregado_categorias is None or _agregado_categorias[0] != version:
+            filas = db.query(
+                LibroDB.categoria,
+                LibroDB.subcategoria,
+                func.count(LibroDB.id),
+                func.coalesce(func.sum(LibroDB.stock), 0),
+                func.coalesce(func.sum(LibroDB.cantidad_disponible), 0),
+                func.coalesce(func.sum(LibroDB.cantidad_prestado), 0),
+            ).group_by(LibroDB.categoria, LibroDB.subcategoria).all()
+            _agregado_categorias = (version, [tuple(f) for f in filas])
+        return _agregado_categorias[1]
+
+
+def _contadores_faceta() -> Dict[str, int]:
+    return {'copias': 0, 'total': 0, 'disponible': 0, 'prestado': 0}
+
+
+def _sumar_faceta(destino: Dict[str, Any], copias: int, total: int, disponible: int, prestado: int) -> None:
+    destino['copias'] += int(copias)
+    destino['total'] += int(total)
+    destino['disponible'] += int(disponible)
+    destino['prestado'] += int(prestado)
+
+
+@app.get('/api/maestros/categorias')
+def maestros_categorias():
+    """
+    Facetas del catálogo: árbol categoria -> subcategoria con copias y unidades totales, disponibles
+    y prestadas. 'codigo' es el valor exacto para filtrar (vacío si el elemento no tiene categoría).
+    """
+    db = SessionLocal()
+    try:
+        version = leer_version(db, VERSION_CATALOGO)
+        clave = '#facetas'
+        cacheado = cache_catalogo.obtener(version, clave)
+        if cacheado is not None:
+            return respuesta_json_cacheada(cacheado, 'HIT')
+        categorias: Dict[str, Dict[str, Any]] = {}
+        for categoria, subcategoria, copias, total, disponible, prestado in agregado_categorias(db, version):
+            codigo = categoria or ''
+            item = categorias.get(codigo)
+            if item is None:
+                item = categorias[codigo] = {
+                    'codigo': codigo, 'descripcion': categoria or 'Sin categoría', **_contadores_faceta(), 'subcategorias': [],
+                }
+            _sumar_faceta(item, copias, total, disponible, prestado)
+            sub = {'codigo': subcategoria or '', 'descripcion': subcategoria or 'Sin subcategoría', **_contadores_faceta()}
+            _sumar_faceta(sub, copias, total, disponible, prestado)
+            item['subcategorias'].append(sub)
+        items = sorted(categorias.values(), key=lambda c: (not c['codigo'], c['descripcion'].lower()))
+        for item in items:
+            item['subcategorias'].sort(key=lambda c: (not c['codigo'], c['descripcion'].lower()))
+        contenido = json_bytes(items)
+        cache_catalogo.guardar(version, clave, contenido)
+        return respuesta_json_cacheada(contenido, 'MISS')
+    finally:
+        db.close()
+
+
 @app.get('/inventario/resumen')
 def inventario_resumen():
+    """Unidades totales, disponibles y prestadas por categoría (desde el agregado del catálogo)"""
     db = SessionLocal()
     try:
-        rows = db.query(LibroDB).all()
+        version = leer_version(db, VERSION_CATALOGO)
+        clave = '#inventario'
+        cacheado = cache_catalogo.obtener(version, clave)
+        if cacheado is not None:
+            return respuesta_json_cacheada(cacheado, 'HIT')
         resumen: Dict[str, Dict[str, int]] = {}
-        for r in rows:
-            cat = (r.categoria or 'Sin categoría')
+        for categoria, _, _, total, disponible, prestado in agregado_categorias(db, version):
+            cat = (categoria or 'Sin categoría')
             if cat not in resumen:
                 resumen[cat] = { 'total': 0, 'disponible': 0, 'prestado': 0 }
-            resumen[cat]['total'] += (r.stock or 0)
-            resumen[cat]['disponible'] += (r.cantidad_disponible or 0)
-            resumen[cat]['prestado'] += (r.cantidad_prestado or 0)
-        return jsonify(resumen)
+            resumen[cat]['total'] += int(total)
+            resumen[cat]['disponible'] += int(disponible)
+            resumen[cat]['prestado'] += int(prestado)
+        contenido = json_bytes(resumen)
+        cache_catalogo.guardar(version, clave, contenido)
+        return respuesta_json_cacheada(contenido, 'MISS')
     finally:
         db.close()
 
 @app.get('/espera')
 def listar_espera():
+    """
+    Lista de espera con la posición de cada solicitud pendiente en la cola de su elemento.
+    Filtros opcionales: id_elemento, estado
+    """
+    id_elemento = request.args.get('id_elemento')
+    estado = request.args.get('estado')
+
+    def consulta(db):
+        posicion = func.row_number().over(
+            partition_by=(WaitlistDB.id_elemento, WaitlistDB.estado),
+            order_by=(WaitlistDB.creado_en, WaitlistDB.id),
+        )
+        q = db.query(WaitlistDB, case((WaitlistDB.estado == 'pendiente', posicion), else_=None))
+        if id_elemento:
+            q = q.filter(WaitlistDB.id_elemento == id_elemento)
+        if estado:
+            q = q.filter(WaitlistDB.estado == estado)
+        return q.order_by(WaitlistDB.creado_en, WaitlistDB.id)
+
+    def serializar(db, filas):
+        items = []
+        for w, posicion in filas:
+            item = ESQUEMA_ESPERA(w)
+            item['posicion'] = posicion
+            items.append(item)
+        return items
+
+    return respuesta_json_stream(consulta, serializar)
+
+# -------------------------------
+# Portadas en segundo plano
+# -------------------------------
+# Las importaciones guardan los libros con imagen = PORTADA_PENDIENTE y responden al confirmar.
+# Un hilo por worker reclama las pendientes por lotes con un UPDATE condicional a una marca propia
+# (PORTADA_EN_CURSO + hora + dueño), las dibuja en un pool de procesos (Pillow no libera el GIL al
+# dibujar) y guarda las rutas solo donde la imagen sigue siendo su marca: si un usuario la cambió,
+# la portada generada se descarta. Las marcas de más de PORTADAS_RECLAMO_SEGUNDOS (worker caído,
+# portada que falló al dibujarse) vuelven a pendientes en el siguiente barrido.
+
+PORTADAS_PROCESOS = int(os.environ.get('PORTADAS_PROCESOS', str(min(4, os.cpu_count() or 1))))
+PORTADAS_LOTE = int(os.environ.get('PORTADAS_LOTE', '200'))
+SEGUNDOS_BARRIDO_PORTADAS = int(os.environ.get('PORTADAS_BARRIDO_SEGUNDOS', '600'))  # 0 desactiva el barrido
+PORTADAS_RECLAMO_SEGUNDOS = int(os.environ.get('PORTADAS_RECLAMO_SEGUNDOS', '900'))
+
+_portadas_lock = threading.Lock()
+_portadas_hilo: Optional[threading.Thread] = None
+_portadas_otra_vez = threading.Event()
+
+
+def _portada_en_proceso(libro: tuple[str, str, str]) -> tuple[str, Optional[str]]:
+    """Ejecutada en el pool: (id, titulo, autor) -> (id, ruta o None si falló)"""
+    id_libro, titulo, autor = libro
+    try:
+        return id_libro, generar_portada(titulo, autor or '')
+    except Exception:
+        return id_libro, None
+
+
+def _borrar_portada(ruta: str) -> None:
+    try:
+        os.remove(os.path.join(app.root_path, ruta))
+    except OSError:
+        pass
+
+
+def liberar_portadas_abandonadas(db, ahora: datetime) -> int:
+    """Devolver a pendientes las marcas de lote más viejas que PORTADAS_RECLAMO_SEGUNDOS"""
+    limite = PORTADA_EN_CURSO + (ahora - timedelta(seconds=PORTADAS_RECLAMO_SEGUNDOS)).strftime('%Y%m%d%H%M%S')
+    resultado = db.execute(
+        update(LibroDB.__table__)
+        .where(text(CONDICION_PORTADA_PENDIENTE), LibroDB.imagen >= PORTADA_EN_CURSO, LibroDB.imagen < limite)
+        .values(imagen=PORTADA_PENDIENTE)
+    )
+    db.commit()
+    return resultado.rowcount or 0
+
+
+def reclamar_portadas(db, lote: int, ahora: datetime) -> tuple[str, list]:
+    """
+    Marcar hasta 'lote' portadas pendientes como de este worker. Retorna (marca, [(id, titulo, autor)]).
+    El UPDATE solo toma filas que siguen pendientes, así que dos workers nunca dibujan la misma; en
+    PostgreSQL SKIP LOCKED además evita que uno espere las filas que otro está reclamando.
+    """
+    marca = f"{PORTADA_EN_CURSO}{ahora:%Y%m%d%H%M%S}-{uuid.uuid4().hex[:12]}"
+    candidatas = (
+        select(LibroDB.id)
+        .where(text(CONDICION_PORTADA_PENDIENTE), LibroDB.imagen == PORTADA_PENDIENTE)
+        .order_by(LibroDB.id)
+        .limit(lote)
+        .with_for_update(skip_locked=True)
+    )
+    db.execute(
+        update(LibroDB.__table__)
+        .where(LibroDB.id.in_(candidatas.scalar_subquery()), LibroDB.imagen == PORTADA_PENDIENTE)
+        .values(imagen=marca)
+    )
+    db.commit()
+    reclamadas = db.execute(
+        select(LibroDB.id, LibroDB.titulo, LibroDB.autor)
+        .where(text(CONDICION_PORTADA_PENDIENTE), LibroDB.imagen == marca)
+    ).all()
+    return marca, [tuple(fila) for fila in reclamadas]
+
+
+def renderizar_portadas_pendientes(*, lote: Optional[int] = None, procesos: Optional[int] = None) -> int:
+    """Generar todas las portadas pendientes. Retorna cuántas se guardaron."""
+    lote = lote or PORTADAS_LOTE
+    tabla = LibroDB.__table__
+    guardadas = 0
     db = SessionLocal()
     try:
-        rows = db.query(WaitlistDB).all()
-        return jsonify([
-            { 'id': w.id, 'id_elemento': w.id_elemento, 'id_usuario': w.id_usuario, 'contacto': w.contacto, 'estado': w.estado, 'creado_en': w.creado_en.isoformat()+'Z' }
-            for w in rows
-        ])
+        liberar_portadas_abandonadas(db, datetime.utcnow())
     finally:
         db.close()
+    # spawn: los procesos hijos no heredan el estado (hilos, conexiones) del worker
+    contexto = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=procesos or PORTADAS_PROCESOS, mp_context=contexto) as pool:
+        while True:
+            db = SessionLocal()
+            try:
+                marca, reclamadas = reclamar_portadas(db, lote, datetime.utcnow())
+            finally:
+                db.close()
+            if not reclamadas:
+                return guardadas
+            # Las que fallen al dibujarse conservan la marca: se reintentan cuando caduque
+            rutas = dict(pool.map(_portada_en_proceso, reclamadas, chunksize=8))
+
+            db = SessionLocal()
+            try:
+                now = datetime.utcnow()
+                generadas = [{'b_id': id_libro, 'b_imagen': ruta} for id_libro, ruta in rutas.items() if ruta]
+                if generadas:
+                    db.execute(
+                        update(tabla)
+                        .where(tabla.c.id == bindparam('b_id'), tabla.c.imagen == marca)
+                        .values(imagen=bindparam('b_imagen'), actualizado_en=now),
+                        generadas,
+                    )
+                actuales = dict(db.execute(select(LibroDB.id, LibroDB.imagen).where(LibroDB.id.in_(list(rutas)))).all())
+                incrementar_version(db, VERSION_CATALOGO)
+                db.commit()
+            except Exception:
+                db.rollback()
+                for ruta in rutas.values():
+                    if ruta:
+                        _borrar_portada(ruta)
+                raise
+            finally:
+                db.close()
+            for id_libro, ruta in rutas.items():
+                if not ruta:
+                    continue
+                if actuales.get(id_libro) == ruta:
+                    guardadas += 1
+                else:
+                    _borrar_portada(ruta)
+
+
+def _hilo_portadas() -> None:
+    global _portadas_hilo
+    while True:
+        _portadas_otra_vez.clear()
+        try:
+            guardadas = renderizar_portadas_pendientes()
+            if guardadas:
+                print(f"✓ Portadas generadas: {guardadas}")
+        except Exception as e:
+            print(f"Error generando portadas: {e}")
+        with _portadas_lock:
+            # Si llegó otra importación mientras se dibujaba, repetir; si no, terminar el hilo
+            if not _portadas_otra_vez.is_set():
+                _portadas_hilo = None
+                return
+
+
+def programar_portadas(db=None) -> None:
+    """Arrancar (sin esperar) la generación de portadas pendientes en este worker"""
+    global _portadas_hilo
+    with _portadas_lock:
+        _portadas_otra_vez.set()
+        if _portadas_hilo is None:
+            _portadas_hilo = threading.Thread(target=_hilo_portadas, name='portadas', daemon=True)
+            _portadas_hilo.start()
+
+
+# Recoge las portadas que quedaron pendientes (reinicios, importaciones en otros workers)
+registrar_tarea_periodica('portadas-pendientes', SEGUNDOS_BARRIDO_PORTADAS, programar_portadas)
+
+
+# Importación CSV: el archivo se lee en streaming (decodificación incremental) y se confirma cada
+# IMPORTACION_CSV_LOTE filas. El progreso queda en importacion_csv; si la importación falla, volver a
+# subir el mismo archivo continúa desde la última fila confirmada (reiniciar=true empieza de cero).
+IMPORTACION_CSV_LOTE = int(os.environ.get('IMPORTACION_CSV_LOTE', '2000'))
+MAXIMO_LOTE_IMPORTACION = 10000
+BLOQUE_MUESTRA_CSV = 64 * 1024
+DELIMITADORES_CSV = ';,\t|'
+
+# Mapeo de cabeceras Aleph -> campos internos
+MAPA_CABECERAS_ALEPH = {
+    'isbn': 'isbn',
+    'autor': 'autor',
+    'título': 'titulo',
+    'titulo': 'titulo',
+    'subtítulo': 'subtitulo',
+    'subtitulo': 'subtitulo',
+    'editor': 'editorial',
+    'fecha': 'anio_publicacion',
+    'descripción': 'descripcion',
+    'descripcion': 'descripcion',
+    'código de barras': 'codigo_barras',
+    'codigo de barras': 'codigo_barras',
+}
+
+
+def detectar_codificacion_csv(muestra: bytes) -> str:
+    """
+    UTF-8 si la muestra trae BOM, es ASCII puro o se decodifica como UTF-8; latin-1 solo si la muestra
+    no es UTF-8 válido (exportaciones de Aleph/Excel en Windows). Una muestra ASCII no distingue ambas,
+    y los acentos que aparezcan después suelen ser UTF-8; la lectura usa errors='replace' por si no.
+    El final de la muestra puede cortar un carácter, por eso se decodifica de forma incremental.
+    """
+    if muestra.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if muestra.isascii():
+        return 'utf-8'
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(muestra, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+
+def detectar_delimitador_csv(muestra: str) -> str:
+    """Delimitador con csv.Sniffer sobre las líneas completas de la muestra; si duda, el más frecuente en la cabecera"""
+    completas = muestra[:muestra.rfind('\n')] if '\n' in muestra else muestra
+    try:
+        return csv.Sniffer().sniff(completas, delimiters=DELIMITADORES_CSV).delimiter
+    except csv.Error:
+        cabecera = completas.splitlines()[0] if completas else ''
+        return ';' if cabecera.count(';') > cabecera.count(',') else ','
+
+
+def datos_fila_aleph(keys: Dict[str, Any]) -> Dict[str, Any]:
+    """Campos de un libro a partir de una fila Aleph (claves ya normalizadas a minúsculas)"""
+    data: Dict[str, Any] = {}
+    for k_src, k_dst in MAPA_CABECERAS_ALEPH.items():
+        if k_src in keys:
+            data[k_dst] = (keys.get(k_src) or '').strip()
+    # Construir título con subtítulo si existe
+    titulo = data.get('titulo') or ''
+    subt = data.get('subtitulo') or ''
+    if subt:
+        titulo = f"{titulo}: {subt}"
+    # Año desde 'Fecha' (puede venir como '2012' o similar)
+    anio = 0
+    try:
+        anio = int(''.join([c for c in (data.get('anio_publicacion') or '') if c.isdigit()])[:4] or 0)
+    except Exception:
+        anio = 0
+    return {
+        'titulo': titulo,
+        'autor': data.get('autor') or '',
+        'editorial': data.get('editorial') or '',
+        'isbn': data.get('isbn') or '',
+        'anio_publicacion': anio,
+        'descripcion': data.get('descripcion') or '',
+    }
+
+
+def sentencia_upsert_libros():
+    """
+    INSERT ... ON CONFLICT (id) DO UPDATE que crea libros nuevos o suma copias a los existentes
+    (stock y cantidad_disponible del valor insertado se suman). None si el motor no lo soporta.
+    """
+    tabla = LibroDB.__table__
+    stmt = insert_dialecto(tabla)
+    if stmt is None:
+        return None
+    return stmt.on_conflict_do_update(
+        index_elements=[tabla.c.id],
+        set_={
+            'stock': func.coalesce(tabla.c.stock, 0) + stmt.excluded.stock,
+            'cantidad_disponible': func.coalesce(tabla.c.cantidad_disponible, 0) + stmt.excluded.cantidad_disponible,
+            'imagen': func.coalesce(func.nullif(tabla.c.imagen, ''), stmt.excluded.imagen),
+            'actualizado_en': stmt.excluded.actualizado_en,
+        },
+    )
+
+
+class ImportacionAleph:
+    """
+    Importación de filas Aleph sin una consulta por fila. Las claves (isbn, titulo, editorial) del
+    catálogo se precargan una vez en diccionarios; las filas repetidas del archivo se acumulan en memoria
+    y escribir() envía el lote con un solo upsert (o inserción + actualización masiva si no hay upsert).
+    Cada fila Aleph es un ejemplar: se agrupa por ISBN+titulo+editorial (sin ISBN, por titulo+editorial).
+    """
+
+    def __init__(self, db, *, lote: int = 5000):
+        # clave -> [id, clave_grupo, tiene_imagen]; el primer libro encontrado gana, como con .first()
+        self.por_isbn: Dict[tuple, list] = {}
+        self.por_titulo: Dict[tuple, list] = {}
+        # Libros nuevos del lote (id -> LibroDB sin agregar a la sesión) y copias para libros existentes
+        # (id -> fila con las columnas de libros; el upsert solo usa stock, cantidad_disponible e imagen)
+        self.nuevos: Dict[str, LibroDB] = {}
+        self.copias: Dict[str, Dict[str, Any]] = {}
+        self.columnas = [c.name for c in LibroDB.__table__.columns]
+        consulta = select(
+            LibroDB.id, LibroDB.isbn, LibroDB.titulo, LibroDB.editorial, LibroDB.imagen, LibroDB.clave_grupo,
+        ).order_by(LibroDB.id).execution_options(yield_per=lote)
+        for id_libro, isbn, titulo, editorial, imagen, clave in db.execute(consulta):
+            self._registrar(id_libro, isbn, titulo, editorial, clave, bool(imagen))
+
+    def _registrar(self, id_libro: str, isbn: Optional[str], titulo: str, editorial: Optional[str],
+                   clave: Optional[str], tiene_imagen: bool) -> list:
+        entrada = [id_libro, clave, tiene_imagen]
+        if isbn:
+            self.por_isbn.setdefault((isbn, titulo, editorial), entrada)
+        return self.por_titulo.setdefault((titulo, editorial), entrada)
+
+    def agregar(self, keys: Dict[str, Any], nuevos: List[LibroDB], claves_afectadas: set[str]) -> bool:
+        """Acumular una fila. Retorna True si crea un libro, False si suma una copia."""
+        datos = datos_fila_aleph(keys)
+        titulo, autor, editorial, isbn = datos['titulo'], datos['autor'], datos['editorial'], datos['isbn']
+        if isbn:
+            entrada = self.por_isbn.get((isbn, titulo, editorial))
+        else:
+            entrada = self.por_titulo.get((titulo, editorial))
+        now = datetime.utcnow()
+        if entrada is not None:
+            id_libro, clave, tiene_imagen = entrada
+            libro = self.nuevos.get(id_libro)
+            if libro is not None:
+                # Copia repetida de un libro nuevo de este mismo lote
+                libro.stock += 1
+                libro.cantidad_disponible += 1
+                return False
+            copia = self.copias.get(id_libro)
+            if copia is None:
+                # Copia de un libro que ya está en la tabla: el upsert suma stock y cantidad_disponible
+                copia = self.copias[id_libro] = dict.fromkeys(self.columnas)
+                copia.update(id=id_libro, titulo=titulo, stock=0, cantidad_disponible=0, cantidad_prestado=0,
+                             clave_grupo=clave, creado_en=now)
+            copia['stock'] += 1
+            copia['cantidad_disponible'] += 1
+            copia['actualizado_en'] = now
+            if not tiene_imagen:
+                copia['imagen'] = PORTADA_PENDIENTE
+                entrada[2] = True
+            claves_afectadas.add(clave or clave_grupo(LibroDB(titulo=titulo, autor=autor, isbn=isbn)))
+            return False
+
+        nuevo = LibroDB(
+            id=str(uuid.uuid4()),
+            titulo=titulo,
+            autor=autor,
+            isbn=isbn,
+            editorial=editorial,
+            anio_publicacion=datos['anio_publicacion'],
+            categoria='Libros',
+            subcategoria=None,
+            descripcion=datos['descripcion'],
+            estado_disponibilidad='Disponible',
+            estado_elemento='Buen estado',
+            stock=1,
+            cantidad_disponible=1,
+            cantidad_prestado=0,
+            imagen=None,
+            codigo_inventario=None,
+            creado_en=now,
+            actualizado_en=now,
+        )
+        nuevo.clave_grupo = clave_grupo(nuevo)
+        nuevo.imagen = PORTADA_PENDIENTE
+        self._registrar(nuevo.id, isbn, titulo, editorial, nuevo.clave_grupo, True)
+        self.nuevos[nuevo.id] = nuevo
+        nuevos.append(nuevo)
+        claves_afectadas.add(nuevo.clave_grupo)
+        return True
+
+    def escribir(self, db) -> None:
+        """Enviar los libros acumulados dentro de la transacción actual"""
+        nuevas = [{c: getattr(libro, c) for c in self.columnas} for libro in self.nuevos.values()]
+        copias = list(self.copias.values())
+        self.nuevos = {}
+        self.copias = {}
+        upsert = sentencia_upsert_libros()
+        if upsert is not None:
+            if nuevas or copias:
+                db.execute(upsert, nuevas + copias)
+            return
+        if nuevas:
+            db.execute(insert(LibroDB.__table__), nuevas)
+        copias = [
+            {'b_id': fila['id'], 'b_n': fila['stock'], 'b_imagen': fila['imagen'], 'b_ahora': fila['actualizado_en']}
+            for fila in copias
+        ]
+        if copias:
+            tabla = LibroDB.__table__
+            db.execute(
+                update(tabla)
+                .where(tabla.c.id == bindparam('b_id'))
+                .values(
+                    stock=func.coalesce(tabla.c.stock, 0) + bindparam('b_n'),
+                    cantidad_disponible=func.coalesce(tabla.c.cantidad_disponible, 0) + bindparam('b_n'),
+                    imagen=func.coalesce(func.nullif(tabla.c.imagen, ''), bindparam('b_imagen')),
+                    actualizado_en=bindparam('b_ahora'),
+                ),
+                copias,
+            )
+
+
+def es_cabecera_aleph(cabeceras: Optional[Iterable[str]]) -> bool:
+    return any((k or '').strip().lower() in MAPA_CABECERAS_ALEPH for k in (cabeceras or ()))
+
+
+def importar_fila_csv(db, row: Dict[str, Any], nuevos: List[LibroDB], claves_afectadas: set[str],
+                      aleph: Optional[ImportacionAleph] = None) -> bool:
+    """
+    Importar una fila. Las filas Aleph se acumulan en 'aleph' (hay que llamar a aleph.escribir antes de
+    confirmar); las de formato propio se agregan a la sesión. Retorna True si creó un libro, False si sumó una copia.
+    """
+    def norm(s: str) -> str:
+        return (s or '').strip()
+
+    # Normalizar claves
+    keys = { (k or '').strip().lower(): v for k, v in row.items() }
+
+    if aleph is not None:
+        # Formato Aleph (decidido por la cabecera, ver es_cabecera_aleph)
+        return aleph.agregar(keys, nuevos, claves_afectadas)
+
+    # Formato propio (minúsculas)
+    data = {k: norm(v) for k, v in keys.items()}
+    item = libro_from_request_db(data, portada_diferida=True)
+    try:
+        item.stock = int(data.get('stock') or 0)
+        item.cantidad_disponible = int(data.get('cantidad_disponible') or item.stock)
+    except Exception:
+        item.stock = item.stock or 0
+        item.cantidad_disponible = item.cantidad_disponible or 0
+    db.add(item)
+    nuevos.append(item)
+    claves_afectadas.add(item.clave_grupo)
+    return True
+
 
 @app.post('/import/csv')
 def import_csv():
@@ -1379,152 +3636,147 @@ def import_csv():
     Soporta dos formatos:
     - Formato propio (cabeceras en minúsculas: titulo, autor, isbn, editorial, anio_publicacion, categoria, subcategoria, descripcion, stock, cantidad_disponible, codigo_inventario)
     - Formato Aleph (cabeceras en español con ';' como separador: ISBN;Autor;Título;Subtítulo;Edición;Lugar;Editor;Fecha;Descripción;Adquisición;Código de barras;...)
+    Campos opcionales del formulario: lote (filas por transacción) y reiniciar=true (no reanudar).
     """
     if 'file' not in request.files:
         return jsonify({"ok": False, "error": "Archivo CSV requerido (campo 'file')"}), 400
     file = request.files['file']
+    try:
+        lote = int(request.form.get('lote') or IMPORTACION_CSV_LOTE)
+    except ValueError:
+        return jsonify({"ok": False, "error": "lote debe ser un entero"}), 400
+    lote = max(1, min(lote, MAXIMO_LOTE_IMPORTACION))
+    reiniciar = (request.form.get('reiniciar') or '').strip().lower() in ('1', 'true', 'si', 'sí')
+
+    # Muestra inicial: codificación, delimitador e identificador de la importación (para reanudar)
+    stream = file.stream
+    muestra = stream.read(BLOQUE_MUESTRA_CSV)
+    stream.seek(0, io.SEEK_END)
+    tamano = stream.tell()
+    stream.seek(0)
+    codificacion = detectar_codificacion_csv(muestra)
+    delimiter = detectar_delimitador_csv(muestra.decode(codificacion, errors='ignore'))
+    id_importacion = hashlib.sha1(muestra + str(tamano).encode('ascii')).hexdigest()
+
     db = SessionLocal()
-    creados = 0
-    actualizados = 0
-    try:
-        # Leer primeras bytes para detectar delimitador y encoding probable
-        raw = file.read()
-        # Intentar latin-1 primero por caracteres acentuados del archivo proporcionado
-        text = None
-        for enc in ['latin-1', 'utf-8']:
-            try:
-                text = raw.decode(enc)
-                break
-            except Exception:
-                continue
-        if text is None:
-            return jsonify({"ok": False, "error": "No se pudo decodificar el archivo (utf-8/latin-1)"}), 400
-
-        # Determinar delimitador: si hay muchos ';' en la cabecera, usar ';'
-        first_line = text.splitlines()[0] if text.splitlines() else ''
-        delimiter = ';' if first_line.count(';') > first_line.count(',') else ','
-
-        reader = csv.DictReader(text.splitlines(), delimiter=delimiter)
-
-        def norm(s: str) -> str:
-            return (s or '').strip()
-
-        # Mapeo de cabeceras Aleph -> campos internos
-        aleph_map = {
-            'isbn': 'isbn',
-            'autor': 'autor',
-            'título': 'titulo',
-            'titulo': 'titulo',
-            'subtítulo': 'subtitulo',
-            'subtitulo': 'subtitulo',
-            'editor': 'editorial',
-            'fecha': 'anio_publicacion',
-            'descripción': 'descripcion',
-            'descripcion': 'descripcion',
-            'código de barras': 'codigo_barras',
-            'codigo de barras': 'codigo_barras',
-        }
+    progreso = None
+    try:
+        now = datetime.utcnow()
+        progreso = db.get(ImportacionCSVDB, id_importacion)
+        if progreso is None:
+            progreso = ImportacionCSVDB(id=id_importacion, filas_confirmadas=0, creados=0, actualizados=0, creado_en=now)
+            db.add(progreso)
+        elif progreso.estado == 'completa' or reiniciar:
+            progreso.filas_confirmadas = 0
+            progreso.creados = 0
+            progreso.actualizados = 0
+        progreso.nombre_archivo = (file.filename or '')[:255]
+        progreso.estado = 'en_curso'
+        progreso.error = None
+        progreso.actualizado_en = now
+        db.commit()
+        inicio = progreso.filas_confirmadas
+
+        texto = io.TextIOWrapper(stream, encoding=codificacion, errors='replace', newline='')
+        reader = csv.DictReader(texto, delimiter=delimiter)
+        # Aleph: claves del catálogo precargadas y escritura por lotes (ver ImportacionAleph)
+        aleph = ImportacionAleph(db) if es_cabecera_aleph(reader.fieldnames) else None
+        filas = inicio
+        creados = progreso.creados
+        actualizados = progreso.actualizados
+        claves_afectadas: set[str] = set()
+        nuevos: List[LibroDB] = []
+
+        def confirmar() -> None:
+            if aleph is not None:
+                aleph.escribir(db)
+            recalcular_grupos(db, claves_afectadas)
+            indexar_libros(db, nuevos)
+            incrementar_version(db, VERSION_CATALOGO)
+            progreso.filas_confirmadas = filas
+            progreso.creados = creados
+            progreso.actualizados = actualizados
+            progreso.actualizado_en = datetime.utcnow()
+            db.commit()
+            claves_afectadas.clear()
+            nuevos.clear()
 
-        for row in reader:
-            # Normalizar claves
-            keys = { (k or '').strip().lower(): v for k, v in row.items() }
-
-            if any(k in keys for k in aleph_map.keys()):
-                # Formato Aleph
-                data: Dict[str, Any] = {}
-                for k_src, k_dst in aleph_map.items():
-                    if k_src in keys:
-                        data[k_dst] = norm(keys.get(k_src))
-                # Construir título con subtítulo si existe
-                titulo = data.get('titulo') or ''
-                subt = data.get('subtitulo') or ''
-                if subt:
-                    titulo = f"{titulo}: {subt}"
-                autor = data.get('autor') or ''
-                editorial = data.get('editorial') or ''
-                isbn = data.get('isbn') or ''
-                # Año desde 'Fecha' (puede venir como '2012' o similar)
-                anio = 0
-                try:
-                    anio = int(''.join([c for c in (data.get('anio_publicacion') or '') if c.isdigit()])[:4] or 0)
-                except Exception:
-                    anio = 0
-                descripcion = data.get('descripcion') or ''
-                # Para Aleph, cada fila suele representar un ejemplar (código de barras). Agrupamos por ISBN+titulo+editorial
-                q = db.query(LibroDB)
-                if isbn:
-                    q = q.filter(LibroDB.isbn == isbn)
-                q = q.filter(LibroDB.titulo == (titulo or ''), LibroDB.editorial == (editorial or ''))
-                existente = q.first()
-                now = datetime.utcnow()
-                if existente:
-                    existente.stock = int((existente.stock or 0) + 1)
-                    existente.cantidad_disponible = int((existente.cantidad_disponible or 0) + 1)
-                    existente.actualizado_en = now
-                    if not existente.imagen:
-                        try:
-                            existente.imagen = generar_portada(titulo, autor)
-                        except Exception:
-                            pass
-                    actualizados += 1
-                else:
-                    nuevo = LibroDB(
-                        id=str(uuid.uuid4()),
-                        titulo=titulo,
-                        autor=autor,
-                        isbn=isbn,
-                        editorial=editorial,
-                        anio_publicacion=anio,
-                        categoria='Libros',
-                        subcategoria=None,
-                        descripcion=descripcion,
-                        estado_disponibilidad='Disponible',
-                        estado_elemento='Buen estado',
-                        stock=1,
-                        cantidad_disponible=1,
-                        cantidad_prestado=0,
-                        imagen=None,
-                        codigo_inventario=None,
-                        creado_en=now,
-                        actualizado_en=now,
-                    )
-                    try:
-                        nuevo.imagen = generar_portada(titulo, autor)
-                    except Exception:
-                        nuevo.imagen = None
-                    db.add(nuevo)
-                    creados += 1
-            else:
-                # Formato propio (minúsculas)
-                data = {k: norm(v) for k, v in keys.items()}
-                item = libro_from_request_db(data)
-                try:
-                    item.stock = int(data.get('stock') or 0)
-                    item.cantidad_disponible = int(data.get('cantidad_disponible') or item.stock)
-                except Exception:
-                    item.stock = item.stock or 0
-                    item.cantidad_disponible = item.cantidad_disponible or 0
-                db.add(item)
+        for row in islice(reader, inicio, None):
+            if importar_fila_csv(db, row, nuevos, claves_afectadas, aleph):
                 creados += 1
-
-        db.commit()
-        return jsonify({"ok": True, "creados": creados, "actualizados": actualizados})
+            else:
+                actualizados += 1
+            filas += 1
+            if filas - progreso.filas_confirmadas >= lote:
+                confirmar()
+
+        progreso.estado = 'completa'
+        confirmar()
+        programar_portadas()
+        return jsonify({
+            "ok": True,
+            "creados": creados,
+            "actualizados": actualizados,
+            "filas": filas,
+            "reanudada_desde": inicio,
+            "importacion": id_importacion,
+        })
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 400
+        db.rollback()
+        programar_portadas()  # Portadas de los lotes ya confirmados
+        confirmadas = 0
+        try:
+            progreso = db.get(ImportacionCSVDB, id_importacion)
+            if progreso is not None:
+                progreso.estado = 'error'
+                progreso.error = str(e)[:1000]
+                progreso.actualizado_en = datetime.utcnow()
+                confirmadas = progreso.filas_confirmadas or 0
+                db.commit()
+        except Exception:
+            db.rollback()
+        mensaje = str(e)
+        if confirmadas:
+            mensaje += f" (se confirmaron {confirmadas} filas; sube el mismo archivo para continuar desde la fila {confirmadas + 1})"
+        return jsonify({
+            "ok": False,
+            "error": mensaje,
+            "filas_confirmadas": confirmadas,
+            "importacion": id_importacion,
+        }), 400
     finally:
         db.close()
 
 @app.put('/espera/<espera_id>/notificar')
 def marcar_notificado(espera_id: str):
+    """Notificar a mano una solicitud pendiente: se le aparta una unidad por HORAS_RESERVA_ESPERA (409 si no hay)"""
     db = SessionLocal()
     try:
         w = db.get(WaitlistDB, espera_id)
         if not w:
             return ("No encontrado", 404)
-        w.estado = 'notificado'
-        w.actualizado_en = datetime.utcnow()
+        ahora = datetime.utcnow()
+        if w.estado == 'notificado' and w.reservado_hasta and w.reservado_hasta > ahora:
+            return jsonify({"ok": True, "reservado_hasta": w.reservado_hasta})
+        if w.estado != 'pendiente':
+            return jsonify({"ok": False, "error": f"La solicitud está en estado '{w.estado}'"}), 409
+        elemento = db.get(LibroDB, w.id_elemento)
+        if not elemento:
+            return jsonify({"ok": False, "error": "Elemento no encontrado"}), 404
+        reservada = reservar_solicitud(db, w.id, elemento.id, ahora)
+        if not reservada:
+            db.rollback()
+            if reservada is None:
+                return jsonify({"ok": False, "error": "La solicitud ya fue atendida"}), 409
+            return jsonify({"ok": False, "error": "No hay unidades disponibles para reservar"}), 409
+        ajustar_grupo(db, elemento, cantidad_disponible=-1)
+        incrementar_version(db, VERSION_CATALOGO)
         db.commit()
-        return jsonify({"ok": True})
+        db.refresh(w)
+        return jsonify({"ok": True, "reservado_hasta": w.reservado_hasta})
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": f"Error al notificar: {str(e)}"}), 500
     finally:
         db.close()
 
@@ -1543,9 +3795,8 @@ def listar_favoritos_api():
         return jsonify([])
     db = SessionLocal()
     try:
-        rows = db.query(FavoritoDB).filter(FavoritoDB.id_usuario == usuario).all()
-        items = [ { 'id': r.id, 'id_usuario': r.id_usuario, 'id_elemento': r.id_elemento, 'creado_en': r.creado_en.isoformat()+'Z' } for r in rows ]
-        return jsonify(items)
+        rows = db.query(FavoritoDB).filter(FavoritoDB.id_usuario == id_usuario_canonico(db, usuario)).all()
+        return jsonify([ESQUEMA_FAVORITO(r) for r in rows])
     finally:
         db.close()
 
@@ -1566,12 +3817,13 @@ def crear_favorito_api():
         return jsonify({'ok': False, 'error': 'id_elemento e id_usuario son requeridos'}), 400
     db = SessionLocal()
     try:
+        id_canonico = id_usuario_canonico(db, id_usuario)
         # evitar duplicados
-        exists = db.query(FavoritoDB).filter(FavoritoDB.id_usuario == id_usuario, FavoritoDB.id_elemento == id_elemento).first()
+        exists = db.query(FavoritoDB).filter(FavoritoDB.id_usuario == id_canonico, FavoritoDB.id_elemento == id_elemento).first()
         if exists:
             return jsonify({'ok': True, 'id': exists.id}), 200
         now = datetime.utcnow()
-        f = FavoritoDB(id=str(uuid.uuid4()), id_usuario=id_usuario, id_elemento=id_elemento, creado_en=now, actualizado_en=now)
+        f = FavoritoDB(id=str(uuid.uuid4()), id_usuario=id_canonico, usuario_original=id_usuario, id_elemento=id_elemento, creado_en=now, actualizado_en=now)
         db.add(f)
         db.commit()
         return jsonify({'ok': True, 'id': f.id}), 201
@@ -1593,7 +3845,9 @@ def eliminar_favorito_api(id_elemento: str):
         return jsonify({'ok': False, 'error': 'usuario requerido'}), 400
     db = SessionLocal()
     try:
-        f = db.query(FavoritoDB).filter(FavoritoDB.id_usuario == usuario, FavoritoDB.id_elemento == id_elemento).first()
+        f = db.query(FavoritoDB).filter(
+            FavoritoDB.id_usuario == id_usuario_canonico(db, usuario), FavoritoDB.id_elemento == id_elemento
+        ).first()
         if not f:
             return ("No encontrado", 404)
         db.delete(f)
@@ -1611,6 +3865,7 @@ def libros_actualizar(libro_id: str):
         if not r:
             return ("No encontrado", 404)
         data = request.get_json(silent=True) or request.form.to_dict()
+        clave_anterior = r.clave_grupo
         for field in ['titulo','autor','isbn','editorial','anio_publicacion','categoria','subcategoria','descripcion','estado_disponibilidad','estado_elemento','stock','cantidad_disponible','cantidad_prestado']:
             if field in data:
                 value = data[field]
@@ -1621,6 +3876,10 @@ def libros_actualizar(libro_id: str):
                         value = 0
                 setattr(r, field, value)
         r.actualizado_en = datetime.utcnow()
+        r.clave_grupo = clave_grupo(r)
+        recalcular_grupos(db, [clave_anterior, r.clave_grupo])
+        indexar_libros(db, [r])
+        incrementar_version(db, VERSION_CATALOGO)
         db.commit()
         return ("", 204)
     finally:
@@ -1641,25 +3900,13 @@ def libros_eliminar(libro_id: str):
         if not libro_original:
             return jsonify({"ok": False, "error": "Libro no encontrado"}), 404
         
-        # Determinar criterio de búsqueda
         codigo_inventario = libro_original.codigo_inventario
-        titulo = libro_original.titulo or ''
-        autor = libro_original.autor or ''
-        isbn = libro_original.isbn or ''
         
-        # Buscar TODOS los registros relacionados
-        if codigo_inventario:
-            # Si tiene código_inventario, buscar todas las copias con ese código
-            registros_relacionados = db.query(LibroDB).filter(
-                LibroDB.codigo_inventario == codigo_inventario
-            ).all()
-        else:
-            # Si no tiene código, buscar por título+autor+ISBN (libros idénticos)
-            registros_relacionados = db.query(LibroDB).filter(
-                LibroDB.titulo == titulo,
-                LibroDB.autor == autor,
-                LibroDB.isbn == isbn
-            ).all()
+        # Buscar TODOS los registros relacionados (misma clave de agrupación: código_inventario o título+autor+ISBN)
+        clave = libro_original.clave_grupo or clave_grupo(libro_original)
+        registros_relacionados = db.query(LibroDB).filter(
+            LibroDB.clave_grupo == clave
+        ).order_by(LibroDB.id.asc()).all() or [libro_original]
         
         if not registros_relacionados:
             return jsonify({"ok": False, "error": "No se encontraron registros relacionados"}), 404
@@ -1726,6 +3973,9 @@ def libros_eliminar(libro_id: str):
         # Eliminar TODOS los registros relacionados
         for registro in registros_relacionados:
             db.delete(registro)
+        recalcular_grupos(db, [clave])
+        desindexar_libros(db, ids_a_eliminar)
+        incrementar_version(db, VERSION_CATALOGO)
         
         db.commit()
         
@@ -1765,8 +4015,10 @@ def crear_mensaje():
         now = datetime.utcnow()
         mensaje = MensajeDB(
             id=str(uuid.uuid4()),
-            id_remitente=id_remitente,
-            id_destinatario=id_destinatario,
+            id_remitente=id_usuario_canonico(db, id_remitente),
+            id_destinatario=id_usuario_canonico(db, id_destinatario),
+            remitente_original=id_remitente,
+            destinatario_original=id_destinatario,
             asunto=asunto,
             contenido=contenido,
             leido=0,
@@ -1786,35 +4038,19 @@ def listar_mensajes():
     """Listar mensajes para un usuario o admin"""
     id_usuario = request.args.get('usuario')  # ID del usuario
     es_admin = request.args.get('admin') == 'true'
-    
-    db = SessionLocal()
-    try:
+
+    def consulta(db):
         q = db.query(MensajeDB)
         if es_admin:
             # Admin ve todos los mensajes donde es destinatario o remitente
             q = q.filter((MensajeDB.id_destinatario == 'admin') | (MensajeDB.id_remitente == 'admin'))
         else:
             # Usuario ve sus mensajes enviados y recibidos
-            q = q.filter((MensajeDB.id_remitente == id_usuario) | (MensajeDB.id_destinatario == id_usuario))
-        
-        rows = q.order_by(MensajeDB.creado_en.desc()).all()
-        items = [
-            {
-                'id': m.id,
-                'id_remitente': m.id_remitente,
-                'id_destinatario': m.id_destinatario,
-                'asunto': m.asunto,
-                'contenido': m.contenido,
-                'leido': m.leido,
-                'relacionado_con': m.relacionado_con,
-                'tipo': m.tipo,
-                'creado_en': m.creado_en.isoformat() + 'Z'
-            }
-            for m in rows
-        ]
-        return jsonify(items)
-    finally:
-        db.close()
+            id_canonico = id_usuario_canonico(db, id_usuario)
+            q = q.filter((MensajeDB.id_remitente == id_canonico) | (MensajeDB.id_destinatario == id_canonico))
+        return q.order_by(MensajeDB.creado_en.desc())
+
+    return respuesta_json_stream(consulta, serializar_con(ESQUEMA_MENSAJE))
 
 @app.put('/api/mensajes/<mensaje_id>/leer')
 def marcar_leido(mensaje_id: str):
@@ -1871,6 +4107,8 @@ def conectar_usuarios():
             id=str(uuid.uuid4()),
             id_remitente='admin',
             id_destinatario=id_usuario1,
+            remitente_original='admin',
+            destinatario_original=id_usuario1_raw,
             asunto='Conexión iniciada',
             contenido=f"Has sido conectado con {user2.nombre} (ID: {user2.documento}). {mensaje_inicial}",
             leido=0,
@@ -1883,6 +4121,8 @@ def conectar_usuarios():
             id=str(uuid.uuid4()),
             id_remitente='admin',
             id_destinatario=id_usuario2,
+            remitente_original='admin',
+            destinatario_original=id_usuario2_raw,
             asunto='Conexión iniciada',
             contenido=f"Has sido conectado con {user1.nombre} (ID: {user1.documento}). {mensaje_inicial}",
             leido=0,
@@ -1897,6 +4137,8 @@ def conectar_usuarios():
             id=str(uuid.uuid4()),
             id_remitente=id_usuario1,
             id_destinatario=id_usuario2,
+            remitente_original=id_usuario1_raw,
+            destinatario_original=id_usuario2_raw,
             asunto='Conexión establecida',
             contenido=f"Hola {user2.nombre}, el administrador nos ha conectado. Puedes responderme aquí.",
             leido=0,
@@ -1909,6 +4151,8 @@ def conectar_usuarios():
             id=str(uuid.uuid4()),
             id_remitente=id_usuario2,
             id_destinatario=id_usuario1,
+            remitente_original=id_usuario2_raw,
+            destinatario_original=id_usuario1_raw,
             asunto='Conexión establecida',
             contenido=f"Hola {user1.nombre}, el administrador nos ha conectado. Puedes responderme aquí.",
             leido=0,
@@ -1993,17 +4237,7 @@ def sancion_tipos_listar():
     db = SessionLocal()
     try:
         tipos = db.query(SancionTipoDB).order_by(SancionTipoDB.codigo).all()
-        items = []
-        for t in tipos:
-            items.append({
-                'id': t.id,
-                'codigo': t.codigo,
-                'descripcion': t.descripcion,
-                'usuario_creacion': t.usuario_creacion,
-                'creado_en': t.creado_en.isoformat() + 'Z',
-                'actualizado_en': t.actualizado_en.isoformat() + 'Z'
-            })
-        return jsonify(items)
+        return jsonify([ESQUEMA_SANCION_TIPO(t) for t in tipos])
     finally:
         db.close()
 
@@ -2016,14 +4250,7 @@ def sancion_tipo_obtener(tipo_id: str):
         tipo = db.get(SancionTipoDB, tipo_id)
         if not tipo:
             return jsonify({"error": "Tipo de sanción no encontrado"}), 404
-        return jsonify({
-            'id': tipo.id,
-            'codigo': tipo.codigo,
-            'descripcion': tipo.descripcion,
-            'usuario_creacion': tipo.usuario_creacion,
-            'creado_en': tipo.creado_en.isoformat() + 'Z',
-            'actualizado_en': tipo.actualizado_en.isoformat() + 'Z'
-        })
+        return jsonify(ESQUEMA_SANCION_TIPO(tipo))
     finally:
         db.close()
 
@@ -2057,6 +4284,7 @@ def sancion_tipo_crear():
         )
         
         db.add(tipo)
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         
         return jsonify({
@@ -2097,6 +4325,7 @@ def sancion_tipo_actualizar(tipo_id: str):
         tipo.descripcion = descripcion_validada
         tipo.actualizado_en = datetime.utcnow()
         
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         
         return jsonify({
@@ -2123,6 +4352,7 @@ def sancion_tipo_eliminar(tipo_id: str):
             return jsonify({"ok": False, "error": "Tipo de sanción no encontrado"}), 404
         
         db.delete(tipo)
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         
         return jsonify({"ok": True, "mensaje": "Tipo de sanción eliminado correctamente"}), 200
@@ -2184,6 +4414,15 @@ def validar_sancion_causa(data: Dict[str, Any], db, *, excluir_id: Optional[str]
     return errores, tipo, nombre, descripcion_final
 
 
+def sancion_causa_to_dict(causa: SancionCausaDB) -> Dict[str, Any]:
+    item = ESQUEMA_SANCION_CAUSA(causa)
+    item.update({
+        "nombre": ("_".join((causa.nombre or '').split()).upper()) if causa.nombre else None,
+        "nombre_legible": (causa.nombre or '').replace('_', ' ').title() if causa.nombre else None,
+    })
+    return item
+
+
 @app.get('/api/sancion-causas')
 def sancion_causas_listar():
     db = SessionLocal()
@@ -2193,18 +4432,7 @@ def sancion_causas_listar():
         if tipo_id:
             query = query.filter(SancionCausaDB.tipo_id == tipo_id)
         causas = query.order_by(SancionCausaDB.nombre.asc()).all()
-        return jsonify([
-            {
-                "id": causa.id,
-                "tipo_id": causa.tipo_id,
-                "nombre": ("_".join((causa.nombre or '').split()).upper()) if causa.nombre else None,
-                "nombre_legible": (causa.nombre or '').replace('_', ' ').title() if causa.nombre else None,
-                "descripcion": causa.descripcion,
-                "creado_en": causa.creado_en.isoformat() + 'Z',
-                "actualizado_en": causa.actualizado_en.isoformat() + 'Z'
-            }
-            for causa in causas
-        ])
+        return jsonify([sancion_causa_to_dict(causa) for causa in causas])
     finally:
         db.close()
 
@@ -2216,16 +4444,7 @@ def sancion_causa_obtener(causa_id: str):
         causa = db.get(SancionCausaDB, causa_id)
         if not causa:
             return jsonify({"error": "Causa no encontrada"}), 404
-        nombre_normalizado = ("_".join((causa.nombre or '').split()).upper()) if causa.nombre else None
-        return jsonify({
-            "id": causa.id,
-            "tipo_id": causa.tipo_id,
-            "nombre": nombre_normalizado,
-            "nombre_legible": (causa.nombre or '').replace('_', ' ').title() if causa.nombre else None,
-            "descripcion": causa.descripcion,
-            "creado_en": causa.creado_en.isoformat() + 'Z',
-            "actualizado_en": causa.actualizado_en.isoformat() + 'Z'
-        })
+        return jsonify(sancion_causa_to_dict(causa))
     finally:
         db.close()
 
@@ -2249,21 +4468,10 @@ def sancion_causa_crear():
             actualizado_en=now
         )
         db.add(causa)
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         db.refresh(causa)
-        nombre_normalizado = ("_".join((causa.nombre or '').split()).upper()) if causa.nombre else None
-        return jsonify({
-            "ok": True,
-            "causa": {
-                "id": causa.id,
-                "tipo_id": causa.tipo_id,
-                "nombre": nombre_normalizado,
-                "nombre_legible": (causa.nombre or '').replace('_', ' ').title() if causa.nombre else None,
-                "descripcion": causa.descripcion,
-                "creado_en": causa.creado_en.isoformat() + 'Z',
-                "actualizado_en": causa.actualizado_en.isoformat() + 'Z'
-            }
-        }), 201
+        return jsonify({"ok": True, "causa": sancion_causa_to_dict(causa)}), 201
     except Exception as e:
         db.rollback()
         return jsonify({"ok": False, "error": f"Error al crear causa: {str(e)}"}), 500
@@ -2289,22 +4497,11 @@ def sancion_causa_actualizar(causa_id: str):
         causa.descripcion = descripcion
         causa.actualizado_en = datetime.utcnow()
 
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         db.refresh(causa)
 
-        nombre_normalizado = ("_".join((causa.nombre or '').split()).upper()) if causa.nombre else None
-        return jsonify({
-            "ok": True,
-            "causa": {
-                "id": causa.id,
-                "tipo_id": causa.tipo_id,
-                "nombre": nombre_normalizado,
-                "nombre_legible": (causa.nombre or '').replace('_', ' ').title() if causa.nombre else None,
-                "descripcion": causa.descripcion,
-                "creado_en": causa.creado_en.isoformat() + 'Z',
-                "actualizado_en": causa.actualizado_en.isoformat() + 'Z'
-            }
-        })
+        return jsonify({"ok": True, "causa": sancion_causa_to_dict(causa)})
     except Exception as e:
         db.rollback()
         return jsonify({"ok": False, "error": f"Error al actualizar causa: {str(e)}"}), 500
@@ -2326,6 +4523,7 @@ def sancion_causa_eliminar(causa_id: str):
             return jsonify({"ok": False, "error": "No puedes eliminar la causa porque está asociada a sanciones registradas"}), 400
 
         db.delete(causa)
+        incrementar_version(db, VERSION_REPORTES)
         db.commit()
         return jsonify({"ok": True, "mensaje": "Causa eliminada correctamente"})
     except Exception as e:
@@ -2349,12 +4547,8 @@ def sancion_to_dict(
     prestamo: Optional[PrestamoDB] = None,
     causa: Optional[SancionCausaDB] = None,
 ) -> Dict[str, Any]:
-    return {
-        "id": sancion.id,
-        "tipo_id": sancion.tipo_id,
-        "id_usuario": sancion.id_usuario,
-        "id_prestamo": sancion.id_prestamo,
-        "causa_id": sancion.causa_id,
+    item = ESQUEMA_SANCION(sancion)
+    item.update({
         "causa": causa.nombre if causa else sancion.causa,
         "causa_nombre": causa.nombre if causa else sancion.causa,
         "causa_legible": (
@@ -2363,21 +4557,14 @@ def sancion_to_dict(
             else ((sancion.causa or "").replace('_', ' ').title() if sancion.causa else None)
         ),
         "causa_descripcion": causa.descripcion if causa else None,
-        "observaciones": sancion.observaciones,
-        "estado": sancion.estado,
-        "fecha_inicio": sancion.fecha_inicio.isoformat() + 'Z' if sancion.fecha_inicio else None,
-        "fecha_fin": sancion.fecha_fin.isoformat() + 'Z' if sancion.fecha_fin else None,
-        "resuelto_en": sancion.resuelto_en.isoformat() + 'Z' if sancion.resuelto_en else None,
-        "usuario_registro": sancion.usuario_registro,
-        "creado_en": sancion.creado_en.isoformat() + 'Z' if sancion.creado_en else None,
-        "actualizado_en": sancion.actualizado_en.isoformat() + 'Z' if sancion.actualizado_en else None,
         "tipo_codigo": tipo.codigo if tipo else None,
         "tipo_descripcion": tipo.descripcion if tipo else None,
         "usuario_nombre": usuario.nombre if usuario else None,
         "usuario_documento": usuario.documento if usuario else None,
         "prestamo_estado": prestamo.estado if prestamo else None,
         "prestamo_id": prestamo.id if prestamo else sancion.id_prestamo,
-    }
+    })
+    return item
 
 
 def validar_sancion_payload(data: Dict[str, Any], db, *, existente: Optional[SancionDB] = None) -> tuple[list[str], Dict[str, Any]]:
@@ -2459,212 +4646,1454 @@ def validar_sancion_payload(data: Dict[str, Any], db, *, existente: Optional[San
     sanitized['fecha_inicio'] = fecha_inicio
     sanitized['fecha_fin'] = fecha_fin
 
-    usuario_registro = (data.get('usuario_registro') or '').strip() or None
-    sanitized['usuario_registro'] = usuario_registro
+    usuario_registro = (data.get('usuario_registro') or '').strip() or None
+    sanitized['usuario_registro'] = usuario_registro
+
+    if sanitized.get('estado') == 'resuelta' and not fecha_fin:
+        # Si se marca como resuelta y no hay fecha_fin, usar la actual
+        sanitized['fecha_fin'] = datetime.utcnow()
+
+    if 'tipo_id' not in sanitized or not sanitized['tipo_id']:
+        errores.append("El tipo de sanción es obligatorio")
+
+    return errores, sanitized
+
+
+@app.get('/api/sanciones')
+def sanciones_listar():
+    db = SessionLocal()
+    try:
+        query = db.query(SancionDB)
+        id_usuario = request.args.get('id_usuario')
+        estado = request.args.get('estado')
+        if id_usuario:
+            query = query.filter(SancionDB.id_usuario == id_usuario)
+        if estado:
+            query = query.filter(SancionDB.estado == estado.lower())
+        sanciones = query.order_by(SancionDB.creado_en.desc()).all()
+
+        tipo_ids = {s.tipo_id for s in sanciones if s.tipo_id}
+        usuario_ids = {s.id_usuario for s in sanciones if s.id_usuario}
+        prestamo_ids = {s.id_prestamo for s in sanciones if s.id_prestamo}
+        causa_ids = {s.causa_id for s in sanciones if s.causa_id}
+
+        tipos_map = {}
+        if tipo_ids:
+            tipos = db.query(SancionTipoDB).filter(SancionTipoDB.id.in_(tipo_ids)).all()
+            tipos_map = {t.id: t for t in tipos}
+
+        usuarios_map = {}
+        if usuario_ids:
+            usuarios = db.query(UserDB).filter(UserDB.id.in_(usuario_ids)).all()
+            usuarios_map = {u.id: u for u in usuarios}
+
+        prestamos_map = {}
+        if prestamo_ids:
+            prestamos = db.query(PrestamoDB).filter(PrestamoDB.id.in_(prestamo_ids)).all()
+            prestamos_map = {p.id: p for p in prestamos}
+
+        causas_map = {}
+        if causa_ids:
+            causas = db.query(SancionCausaDB).filter(SancionCausaDB.id.in_(causa_ids)).all()
+            causas_map = {c.id: c for c in causas}
+
+        resultado = [
+            sancion_to_dict(
+                s,
+                tipo=tipos_map.get(s.tipo_id),
+                usuario=usuarios_map.get(s.id_usuario),
+                prestamo=prestamos_map.get(s.id_prestamo),
+                causa=causas_map.get(s.causa_id)
+            )
+            for s in sanciones
+        ]
+
+        q = (request.args.get('q') or '').strip().lower()
+        if q:
+            filtrado = []
+            for item in resultado:
+                texto = " ".join(str(item.get(k) or '') for k in ['tipo_codigo', 'tipo_descripcion', 'usuario_nombre', 'usuario_documento', 'causa', 'estado'])
+                if q in texto.lower():
+                    filtrado.append(item)
+            resultado = filtrado
+
+        return jsonify(resultado)
+    except Exception as e:
+        return jsonify({"error": f"Error al listar sanciones: {str(e)}"}), 500
+    finally:
+        db.close()
+
+
+@app.get('/api/sanciones/<sancion_id>')
+def sancion_obtener(sancion_id: str):
+    db = SessionLocal()
+    try:
+        sancion = db.get(SancionDB, sancion_id)
+        if not sancion:
+            return jsonify({"error": "Sanción no encontrada"}), 404
+        tipo = db.get(SancionTipoDB, sancion.tipo_id) if sancion.tipo_id else None
+        usuario = db.get(UserDB, sancion.id_usuario) if sancion.id_usuario else None
+        prestamo = db.get(PrestamoDB, sancion.id_prestamo) if sancion.id_prestamo else None
+        causa = db.get(SancionCausaDB, sancion.causa_id) if sancion.causa_id else None
+        return jsonify(sancion_to_dict(sancion, tipo=tipo, usuario=usuario, prestamo=prestamo, causa=causa))
+    finally:
+        db.close()
+
+
+@app.post('/api/sanciones')
+def sancion_crear():
+    data = request.get_json(force=True, silent=True) or {}
+    db = SessionLocal()
+    try:
+        errores, sanitized = validar_sancion_payload(data, db)
+        if errores:
+            return jsonify({"ok": False, "errores": errores}), 400
+
+        now = datetime.utcnow()
+        sancion = SancionDB(
+            id=str(uuid.uuid4()),
+            tipo_id=sanitized['tipo_id'],
+            id_usuario=sanitized['id_usuario'],
+            id_prestamo=sanitized.get('id_prestamo'),
+            causa_id=sanitized.get('causa_id'),
+            causa=sanitized.get('causa_texto', ''),
+            observaciones=sanitized.get('observaciones'),
+            estado=sanitized['estado'],
+            fecha_inicio=sanitized['fecha_inicio'] or now,
+            fecha_fin=sanitized.get('fecha_fin'),
+            resuelto_en=now if sanitized['estado'] == 'resuelta' else None,
+            usuario_registro=sanitized.get('usuario_registro'),
+            creado_en=now,
+            actualizado_en=now,
+        )
+        db.add(sancion)
+        incrementar_version(db, VERSION_REPORTES)
+        db.commit()
+        db.refresh(sancion)
+        return jsonify({
+            "ok": True,
+            "sancion": sancion_to_dict(sancion, tipo=sanitized.get('tipo'), usuario=sanitized.get('usuario'),
+                                       prestamo=sanitized.get('prestamo'),
+                                       causa=sanitized.get('causa_obj'))
+        }), 201
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": f"Error al crear sanción: {str(e)}"}), 500
+    finally:
+        db.close()
+
+
+@app.put('/api/sanciones/<sancion_id>')
+def sancion_actualizar(sancion_id: str):
+    data = request.get_json(force=True, silent=True) or {}
+    db = SessionLocal()
+    try:
+        sancion = db.get(SancionDB, sancion_id)
+        if not sancion:
+            return jsonify({"ok": False, "error": "Sanción no encontrada"}), 404
+
+        errores, sanitized = validar_sancion_payload(data, db, existente=sancion)
+        if errores:
+            return jsonify({"ok": False, "errores": errores}), 400
+
+        sancion.tipo_id = sanitized['tipo_id']
+        sancion.id_usuario = sanitized['id_usuario']
+        sancion.id_prestamo = sanitized.get('id_prestamo')
+        sancion.causa_id = sanitized.get('causa_id')
+        sancion.causa = sanitized.get('causa_texto', sancion.causa)
+        sancion.observaciones = sanitized.get('observaciones')
+        sancion.estado = sanitized['estado']
+        sancion.fecha_inicio = sanitized['fecha_inicio'] or sancion.fecha_inicio
+        sancion.fecha_fin = sanitized.get('fecha_fin')
+        if sancion.estado == 'resuelta' and not sancion.resuelto_en:
+            sancion.resuelto_en = datetime.utcnow()
+        elif sancion.estado != 'resuelta':
+            sancion.resuelto_en = None
+        sancion.usuario_registro = sanitized.get('usuario_registro') or sancion.usuario_registro
+        sancion.actualizado_en = datetime.utcnow()
+
+        incrementar_version(db, VERSION_REPORTES)
+        db.commit()
+        db.refresh(sancion)
+
+        return jsonify({
+            "ok": True,
+            "sancion": sancion_to_dict(
+                sancion,
+                tipo=sanitized.get('tipo') or db.get(SancionTipoDB, sancion.tipo_id),
+                usuario=sanitized.get('usuario') or db.get(UserDB, sancion.id_usuario),
+                prestamo=sanitized.get('prestamo') or (db.get(PrestamoDB, sancion.id_prestamo) if sancion.id_prestamo else None),
+                causa=sanitized.get('causa_obj') or (db.get(SancionCausaDB, sancion.causa_id) if sancion.causa_id else None)
+            )
+        })
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": f"Error al actualizar sanción: {str(e)}"}), 500
+    finally:
+        db.close()
+
+
+@app.delete('/api/sanciones/<sancion_id>')
+def sancion_eliminar(sancion_id: str):
+    db = SessionLocal()
+    try:
+        sancion = db.get(SancionDB, sancion_id)
+        if not sancion:
+            return jsonify({"ok": False, "error": "Sanción no encontrada"}), 404
+        db.delete(sancion)
+        incrementar_version(db, VERSION_REPORTES)
+        db.commit()
+        return jsonify({"ok": True, "mensaje": "Sanción eliminada correctamente"})
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": f"Error al eliminar sanción: {str(e)}"}), 500
+    finally:
+        db.close()
+
+
+# -------------------------------
+# Préstamos vencidos
+# -------------------------------
+# revisar_prestamos_vencidos() busca préstamos aprobados cuya fecha_devolucion ya pasó, desde la última
+# marca de agua, y los registra en prestamo_vencido. Si VENCIDOS_SANCION_CAUSA indica una causa de
+# sanción (ID o nombre), crea además una sanción por préstamo a los usuarios registrados.
+# Se ejecuta en cada worker cada VENCIDOS_REVISION_SEGUNDOS, con POST /prestamos/vencidos/revisar
+# o con revisar_vencidos.py. Varias revisiones a la vez no chocan: prestamo_vencido se inserta con
+# ON CONFLICT DO NOTHING (solo se sanciona lo que entró) y la marca de agua se guarda con un upsert.
+
+MARCA_VENCIDOS = 'prestamos_vencidos'
+SEGUNDOS_REVISION_VENCIDOS = int(os.environ.get('VENCIDOS_REVISION_SEGUNDOS', '900'))  # 0 desactiva la revisión
+CAUSA_SANCION_VENCIDOS = os.environ.get('VENCIDOS_SANCION_CAUSA', '').strip()
+DIAS_SANCION_VENCIDOS = int(os.environ.get('VENCIDOS_SANCION_DIAS', '0'))  # 0: sin fecha de fin
+LOTE_VENCIDOS = 500
+
+
+def guardar_marca(db, nombre: str, marca: datetime) -> None:
+    """Avanzar la marca de agua (upsert; nunca retrocede si otro worker guardó una posterior)"""
+    tabla = MarcaProcesoDB.__table__
+    valores = dict(nombre=nombre, marca=marca, actualizado_en=datetime.utcnow())
+    insertar = insert_dialecto(tabla)
+    if insertar is not None:
+        stmt = insertar.values(**valores)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[tabla.c.nombre],
+            set_={'marca': stmt.excluded.marca, 'actualizado_en': stmt.excluded.actualizado_en},
+            where=tabla.c.marca < stmt.excluded.marca,
+        ))
+        return
+    existente = db.get(MarcaProcesoDB, nombre)
+    if existente is None:
+        db.add(MarcaProcesoDB(**valores))
+    elif existente.marca < marca:
+        existente.marca = marca
+        existente.actualizado_en = valores['actualizado_en']
+
+
+def causa_sancion_vencidos(db) -> Optional[SancionCausaDB]:
+    if not CAUSA_SANCION_VENCIDOS:
+        return None
+    causa = db.get(SancionCausaDB, CAUSA_SANCION_VENCIDOS)
+    if causa is None:
+        causa = db.query(SancionCausaDB).filter(SancionCausaDB.nombre == CAUSA_SANCION_VENCIDOS).first()
+    return causa
+
+
+def _registrar_vencidos(db, filas: list, causa: Optional[SancionCausaDB], ahora: datetime) -> tuple[int, int]:
+    """
+    Insertar en bloque los préstamos vencidos del lote (y sus sanciones). Retorna (vencidos, sanciones).
+    Con INSERT ... ON CONFLICT DO NOTHING ... RETURNING: si otro worker revisa a la vez, cada préstamo
+    lo registra (y lo sanciona) solo la transacción cuyo INSERT entró.
+    """
+    ids = [f.id for f in filas]
+    ya_registrados = set(db.execute(
+        select(PrestamoVencidoDB.id_prestamo).where(PrestamoVencidoDB.id_prestamo.in_(ids))
+    ).scalars())
+    nuevos = [f for f in filas if f.id not in ya_registrados]
+    if not nuevos:
+        return 0, 0
+
+    sanciones = []
+    sancion_por_prestamo: Dict[str, str] = {}
+    if causa is not None:
+        usuarios = set(db.execute(
+            select(UserDB.id).where(UserDB.id.in_({f.id_usuario for f in nuevos if f.id_usuario}))
+        ).scalars())
+        ya_sancionados = set(db.execute(
+            select(SancionDB.id_prestamo).where(
+                SancionDB.id_prestamo.in_([f.id for f in nuevos]), SancionDB.causa_id == causa.id
+            )
+        ).scalars())
+        fecha_fin = ahora + timedelta(days=DIAS_SANCION_VENCIDOS) if DIAS_SANCION_VENCIDOS > 0 else None
+        for f in nuevos:
+            if f.id_usuario not in usuarios or f.id in ya_sancionados:
+                continue
+            sancion_id = str(uuid.uuid4())
+            sancion_por_prestamo[f.id] = sancion_id
+            sanciones.append(dict(
+                id=sancion_id, tipo_id=causa.tipo_id, id_usuario=f.id_usuario, id_prestamo=f.id,
+                causa_id=causa.id, causa=causa.nombre,
+                observaciones=f"Préstamo vencido el {f.fecha_devolucion:%Y-%m-%d}",
+                estado='activa', fecha_inicio=ahora, fecha_fin=fecha_fin, resuelto_en=None,
+                usuario_registro='sistema', creado_en=ahora, actualizado_en=ahora,
+            ))
+
+    valores = [
+        dict(id_prestamo=f.id, id_usuario=f.id_usuario, id_elemento=f.id_elemento,
+             fecha_devolucion=f.fecha_devolucion, id_sancion=sancion_por_prestamo.get(f.id), detectado_en=ahora)
+        for f in nuevos
+    ]
+    insertar = insert_dialecto(PrestamoVencidoDB.__table__)
+    if insertar is not None and engine.dialect.insert_returning:
+        registrados = set(db.execute(
+            insertar.on_conflict_do_nothing(index_elements=['id_prestamo']).returning(PrestamoVencidoDB.id_prestamo),
+            valores,
+        ).scalars())
+        sanciones = [sancion for sancion in sanciones if sancion['id_prestamo'] in registrados]
+    else:
+        db.execute(insert(PrestamoVencidoDB), valores)
+        registrados = {f.id for f in nuevos}
+    if sanciones:
+        db.execute(insert(SancionDB), sanciones)
+        incrementar_version(db, VERSION_REPORTES)
+    return len(registrados), len(sanciones)
+
+
+def revisar_prestamos_vencidos(db, *, ahora: Optional[datetime] = None, lote: int = LOTE_VENCIDOS) -> Dict[str, int]:
+    """
+    Registrar los préstamos que vencieron desde la última revisión (confirma cada lote) y quitar de
+    prestamo_vencido los que ya no están aprobados. Retorna contadores de la revisión.
+    """
+    ahora = ahora or datetime.utcnow()
+    marca = db.get(MarcaProcesoDB, MARCA_VENCIDOS)
+    desde = marca.marca if marca else None
+    causa = causa_sancion_vencidos(db)
+    columnas = (PrestamoDB.id, PrestamoDB.id_usuario, PrestamoDB.id_elemento, PrestamoDB.fecha_devolucion)
+    vencidos = sanciones = 0
+
+    # Vencidos desde la marca: rango sobre el índice (estado, fecha_devolucion), paginado por (fecha, id)
+    ultimo = None
+    while True:
+        q = select(*columnas).where(
+            PrestamoDB.estado == 'aprobado',
+            PrestamoDB.fecha_devolucion <= ahora,
+        )
+        if desde is not None:
+            q = q.where(PrestamoDB.fecha_devolucion > desde)
+        if ultimo is not None:
+            q = q.where(or_(
+                PrestamoDB.fecha_devolucion > ultimo[0],
+                and_(PrestamoDB.fecha_devolucion == ultimo[0], PrestamoDB.id > ultimo[1]),
+            ))
+        filas = db.execute(q.order_by(PrestamoDB.fecha_devolucion, PrestamoDB.id).limit(lote)).all()
+        if not filas:
+            break
+        v, s_ = _registrar_vencidos(db, filas, causa, ahora)
+        db.commit()
+        vencidos += v
+        sanciones += s_
+        ultimo = (filas[-1].fecha_devolucion, filas[-1].id)
+
+    # Préstamos aprobados después de la marca con una fecha de devolución anterior a ella
+    if desde is not None:
+        ultimo_id = ''
+        while True:
+            filas = db.execute(
+                select(*columnas).where(
+                    PrestamoDB.estado == 'aprobado',
+                    PrestamoDB.fecha_devolucion <= desde,
+                    PrestamoDB.actualizado_en > desde,
+                    PrestamoDB.id > ultimo_id,
+                ).order_by(PrestamoDB.id).limit(lote)
+            ).all()
+            if not filas:
+                break
+            v, s_ = _registrar_vencidos(db, filas, causa, ahora)
+            db.commit()
+            vencidos += v
+            sanciones += s_
+            ultimo_id = filas[-1].id
+
+    # Quitar los que ya se devolvieron (o cambiaron de estado)
+    resueltos = db.execute(
+        delete(PrestamoVencidoDB).where(~select(PrestamoDB.id).where(
+            PrestamoDB.id == PrestamoVencidoDB.id_prestamo, PrestamoDB.estado == 'aprobado'
+        ).exists())
+    ).rowcount
+
+    guardar_marca(db, MARCA_VENCIDOS, ahora)
+    db.commit()
+    return {'vencidos': vencidos, 'sanciones': sanciones, 'resueltos': resueltos}
+
+
+registrar_tarea_periodica(
+    'revision-vencidos', SEGUNDOS_REVISION_VENCIDOS,
+    lambda db: {k: v for k, v in revisar_prestamos_vencidos(db).items() if v},
+)
+
+
+@app.get('/prestamos/vencidos')
+def listar_prestamos_vencidos():
+    """
+    Préstamos vencidos según la última revisión (tabla prestamo_vencido), del más antiguo al más reciente.
+    Cada préstamo incluye dias_vencido e id_sancion; el encabezado X-Revisado-Hasta indica la marca de la revisión.
+    """
+    db = SessionLocal()
+    try:
+        marca = db.get(MarcaProcesoDB, MARCA_VENCIDOS)
+        revisado_hasta = marca.marca if marca else None
+    finally:
+        db.close()
+
+    def consulta(db):
+        return (
+            db.query(PrestamoDB, PrestamoVencidoDB)
+            .join(PrestamoVencidoDB, PrestamoVencidoDB.id_prestamo == PrestamoDB.id)
+            .filter(PrestamoDB.estado == 'aprobado')
+            .order_by(PrestamoVencidoDB.fecha_devolucion, PrestamoVencidoDB.id_prestamo)
+        )
+
+    def serializar(db, filas):
+        ahora = datetime.utcnow()
+        items = enriquecer_prestamos(db, [p for p, _ in filas])
+        for item, (_, vencido) in zip(items, filas):
+            item['dias_vencido'] = (ahora - vencido.fecha_devolucion).days
+            item['id_sancion'] = vencido.id_sancion
+            item['detectado_en'] = vencido.detectado_en
+        return items
+
+    respuesta = respuesta_json_stream(consulta, serializar)
+    if revisado_hasta:
+        respuesta.headers['X-Revisado-Hasta'] = revisado_hasta.isoformat() + 'Z'
+    return respuesta
+
+
+@app.post('/prestamos/vencidos/revisar')
+def revisar_prestamos_vencidos_api():
+    """Ejecutar la revisión de préstamos vencidos ahora"""
+    db = SessionLocal()
+    try:
+        return jsonify({"ok": True, **revisar_prestamos_vencidos(db)})
+    except Exception as e:
+        db.rollback()
+        return jsonify({"ok": False, "error": f"Error al revisar préstamos vencidos: {str(e)}"}), 500
+    finally:
+        db.close()
+
+
+# -------------------------------
+# Reportes
+# -------------------------------
+# Los reportes salen del rollup diario de préstamos o de consultas por rango sobre columnas indexadas
+# (creado_en, (estado, fecha_devolucion)). El resultado ya serializado se guarda en cache_reportes con
+# la clave (reporte, parámetros) y pertenece a la versión de datos actual: catálogo + reportes, que se
+# incrementan en la misma transacción que los cambios de libros, préstamos, sanciones y usuarios.
+
+cache_reportes = registrar_cache(VERSION_REPORTES, max_entradas=int(os.environ.get('CACHE_REPORTES_ENTRADAS', '64')))
+PERIODOS_REPORTE = ('semana', 'mes', 'año')
+ESTADO_ELEMENTO_DANADO = 'Dañado'
+TOP_ELEMENTOS_REPORTE = 10
+
+
+def version_reportes(db) -> int:
+    """Suma de las versiones de las que dependen los reportes (ambas solo crecen)"""
+    total = db.query(func.sum(VersionDatosDB.valor)).filter(
+        VersionDatosDB.nombre.in_((VERSION_CATALOGO, VERSION_REPORTES))
+    ).scalar()
+    return int(total or 0)
+
+
+def responder_reporte(nombre: str, construir: Callable[[Any], Any], *,
+                      clave_extra: Union[str, Callable[[int], str]] = '') -> Response:
+    """
+    Responder un reporte desde cache_reportes o construirlo con construir(db).
+    construir lanza ValueError si los parámetros no son válidos (responde 400).
+    clave_extra puede ser una función de la versión de datos.
+    """
+    db = SessionLocal()
+    try:
+        version = version_reportes(db)
+        if callable(clave_extra):
+            clave_extra = clave_extra(version)
+        clave = f"{nombre}?{clave_cache_request()}{clave_extra}"
+        contenido = cache_reportes.obtener(version, clave)
+        if contenido is not None:
+            return respuesta_json_cacheada(contenido, 'HIT')
+        try:
+            contenido = json_bytes(construir(db))
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        cache_reportes.guardar(version, clave, contenido)
+        return respuesta_json_cacheada(contenido, 'MISS')
+    finally:
+        db.close()
+
+
+def rango_fechas_reporte() -> tuple[Optional[datetime], Optional[datetime]]:
+    """fecha_desde / fecha_hasta (YYYY-MM-DD, ambas inclusive) como [desde, hasta) en datetime"""
+    rango = []
+    for nombre in ('fecha_desde', 'fecha_hasta'):
+        texto = (request.args.get(nombre) or '').strip()
+        if not texto:
+            rango.append(None)
+            continue
+        try:
+            dia = date.fromisoformat(texto[:10])
+        except ValueError:
+            raise ValueError(f"{nombre} debe tener formato YYYY-MM-DD")
+        inicio = datetime(dia.year, dia.month, dia.day)
+        rango.append(inicio + timedelta(days=1) if nombre == 'fecha_hasta' else inicio)
+    return rango[0], rango[1]
+
+
+def filtrar_rango(q, columna, desde: Optional[datetime], hasta: Optional[datetime]):
+    if desde is not None:
+        q = q.filter(columna >= desde)
+    if hasta is not None:
+        q = q.filter(columna < hasta)
+    return q
+
+
+def contar_prestamos_rollup(db, desde: date, hasta: date) -> int:
+    """Préstamos creados entre desde y hasta (inclusive), sin solicitudes rechazadas, leyendo solo el rollup diario"""
+    total = db.query(func.sum(EstadisticaPrestamoDiaDB.cantidad)).filter(
+        EstadisticaPrestamoDiaDB.fecha >= desde, EstadisticaPrestamoDiaDB.fecha <= hasta,
+        EstadisticaPrestamoDiaDB.estado != 'rechazado',
+    ).scalar()
+    return int(total or 0)
+
+
+def contar_devoluciones(db, desde: datetime, hasta: datetime) -> int:
+    """Devoluciones en [desde, hasta): rango sobre el índice (estado, fecha_devolucion)"""
+    return db.query(func.count(PrestamoDB.id)).filter(
+        PrestamoDB.estado == 'devuelto', PrestamoDB.fecha_devolucion >= desde, PrestamoDB.fecha_devolucion < hasta
+    ).scalar() or 0
+
+
+def contar_sanciones(db, desde: datetime, hasta: datetime) -> Dict[str, int]:
+    """Sanciones registradas en [desde, hasta), separando las de tipo advertencia"""
+    es_advertencia = or_(SancionTipoDB.codigo.ilike('%advert%'), SancionTipoDB.descripcion.ilike('%advert%'))
+    clase = case((es_advertencia, 'advertencias'), else_='sanciones')
+    filas = db.query(clase, func.count(SancionDB.id)).outerjoin(
+        SancionTipoDB, SancionTipoDB.id == SancionDB.tipo_id
+    ).filter(SancionDB.creado_en >= desde, SancionDB.creado_en < hasta).group_by(clase).all()
+    conteo = {'sanciones': 0, 'advertencias': 0}
+    conteo.update({clase: int(n) for clase, n in filas})
+    return conteo
+
+
+def resumen_periodo(db, desde: date, hasta: date) -> Dict[str, int]:
+    """Préstamos, devoluciones y sanciones de un periodo de días [desde, hasta]"""
+    inicio = datetime(desde.year, desde.month, desde.day)
+    fin = datetime(hasta.year, hasta.month, hasta.day) + timedelta(days=1)
+    sanciones = contar_sanciones(db, inicio, fin)
+    return {
+        'prestamos': contar_prestamos_rollup(db, desde, hasta),
+        'devoluciones': contar_devoluciones(db, inicio, fin),
+        'sanciones': sanciones['sanciones'] + sanciones['advertencias'],
+    }
+
+
+@app.get('/api/reportes/general')
+def reporte_general():
+    """Resumen del periodo en curso (semana: últimos 7 días, mes o año calendario)"""
+    hoy = datetime.utcnow().date()
+
+    def construir(db):
+        periodo = (request.args.get('periodo') or 'mes').strip().lower()
+        if periodo not in PERIODOS_REPORTE:
+            raise ValueError(f"periodo debe ser uno de: {', '.join(PERIODOS_REPORTE)}")
+        if periodo == 'semana':
+            desde = hoy - timedelta(days=6)
+        elif periodo == 'mes':
+            desde = hoy.replace(day=1)
+        else:
+            desde = hoy.replace(month=1, day=1)
+        inicio = datetime(desde.year, desde.month, desde.day)
+        fin = datetime(hoy.year, hoy.month, hoy.day) + timedelta(days=1)
+        sanciones = contar_sanciones(db, inicio, fin)
+
+        # Elementos más prestados: agregado sobre el rango de creado_en, unido a libros solo para el top
+        veces = func.count(PrestamoDB.id).label('veces')
+        top = db.query(PrestamoDB.id_elemento, veces).filter(
+            PrestamoDB.creado_en >= inicio, PrestamoDB.creado_en < fin, PrestamoDB.estado != 'rechazado'
+        ).group_by(PrestamoDB.id_elemento).order_by(veces.desc()).limit(TOP_ELEMENTOS_REPORTE).subquery()
+        frecuentes = db.query(top.c.id_elemento, LibroDB.titulo, top.c.veces).outerjoin(
+            LibroDB, LibroDB.id == top.c.id_elemento
+        ).order_by(top.c.veces.desc(), top.c.id_elemento).all()
+
+        return {
+            'periodo': periodo,
+            'desde': desde.isoformat(),
+            'hasta': hoy.isoformat(),
+            'cantidad_prestamos': contar_prestamos_rollup(db, desde, hoy),
+            'cantidad_sanciones': sanciones['sanciones'],
+            'cantidad_advertencias': sanciones['advertencias'],
+            'cantidad_elementos_danados': db.query(func.count(LibroDB.id)).filter(
+                LibroDB.estado_elemento == ESTADO_ELEMENTO_DANADO
+            ).scalar() or 0,
+            'elementos_prestados_frecuentes': [
+                {'id_elemento': id_elemento, 'titulo': titulo or id_elemento, 'veces_prestado': int(n)}
+                for id_elemento, titulo, n in frecuentes
+            ],
+        }
+
+    # Los periodos son relativos a hoy: el día forma parte de la clave
+    return responder_reporte('general', construir, clave_extra=f"#{hoy.isoformat()}")
+
+
+@app.get('/api/reportes/usuarios')
+def reporte_usuarios():
+    """Usuarios registrados en el rango fecha_desde / fecha_hasta"""
+    def construir(db):
+        desde, hasta = rango_fechas_reporte()
+        q = filtrar_rango(db.query(UserDB), UserDB.creado_en, desde, hasta)
+        return [ESQUEMA_USUARIO(u) for u in q.order_by(UserDB.creado_en, UserDB.id)]
+    return responder_reporte('usuarios', construir)
+
+
+@app.get('/api/reportes/elementos')
+def reporte_elementos():
+    """Elementos registrados en el rango fecha_desde / fecha_hasta, opcionalmente de una categoría"""
+    def construir(db):
+        desde, hasta = rango_fechas_reporte()
+        q = filtrar_rango(db.query(LibroDB), LibroDB.creado_en, desde, hasta)
+        categoria = (request.args.get('categoria') or '').strip()
+        if categoria:
+            q = q.filter(LibroDB.categoria == categoria)
+        return [ESQUEMA_LIBRO(l) for l in q.order_by(LibroDB.creado_en, LibroDB.id)]
+    return responder_reporte('elementos', construir)
+
+
+@app.get('/api/reportes/prestamos')
+def reporte_prestamos():
+    """Préstamos creados en el rango fecha_desde / fecha_hasta, opcionalmente de un estado"""
+    def construir(db):
+        desde, hasta = rango_fechas_reporte()
+        q = filtrar_rango(db.query(PrestamoDB), PrestamoDB.creado_en, desde, hasta)
+        estado = (request.args.get('estado') or '').strip()
+        if estado:
+            q = q.filter(PrestamoDB.estado == estado)
+        return [ESQUEMA_PRESTAMO(p) for p in q.order_by(PrestamoDB.creado_en, PrestamoDB.id)]
+    return responder_reporte('prestamos', construir)
+
+
+@app.get('/api/reportes/devoluciones')
+def reporte_devoluciones():
+    """Préstamos devueltos en el rango fecha_desde / fecha_hasta (por fecha de devolución)"""
+    def construir(db):
+        desde, hasta = rango_fechas_reporte()
+        q = filtrar_rango(
+            db.query(PrestamoDB).filter(PrestamoDB.estado == 'devuelto'), PrestamoDB.fecha_devolucion, desde, hasta
+        )
+        return [ESQUEMA_PRESTAMO(p) for p in q.order_by(PrestamoDB.fecha_devolucion, PrestamoDB.id)]
+    return responder_reporte('devoluciones', construir)
+
+
+@app.get('/api/reportes/sanciones')
+def reporte_sanciones():
+    """Sanciones registradas en el rango fecha_desde / fecha_hasta, opcionalmente de un usuario"""
+    def construir(db):
+        desde, hasta = rango_fechas_reporte()
+        q = filtrar_rango(db.query(SancionDB), SancionDB.creado_en, desde, hasta)
+        id_usuario = (request.args.get('id_usuario') or '').strip()
+        if id_usuario:
+            q = q.filter(SancionDB.id_usuario == id_usuario_canonico(db, id_usuario))
+        sanciones = q.order_by(SancionDB.creado_en, SancionDB.id).all()
+
+        tipo_ids = {s.tipo_id for s in sanciones if s.tipo_id}
+        causa_ids = {s.causa_id for s in sanciones if s.causa_id}
+        tipos_map = {t.id: t for t in db.query(SancionTipoDB).filter(SancionTipoDB.id.in_(tipo_ids))} if tipo_ids else {}
+        causas_map = {c.id: c for c in db.query(SancionCausaDB).filter(SancionCausaDB.id.in_(causa_ids))} if causa_ids else {}
+
+        items = []
+        for consecutivo, s in enumerate(sanciones, start=1):
+            tipo = tipos_map.get(s.tipo_id)
+            causa = causas_map.get(s.causa_id)
+            item = ESQUEMA_SANCION(s)
+            item.update({
+                'consecutivo': consecutivo,
+                'fecha_registro': s.creado_en,
+                'codigo_causa': causa.nombre if causa else s.causa,
+                'codigo_tipo': tipo.codigo if tipo else None,
+            })
+            items.append(item)
+        return items
+    return responder_reporte('sanciones', construir)
+
+
+@app.get('/api/reportes/mensual')
+def reporte_mensual():
+    """Préstamos, devoluciones y sanciones de un mes (mes=YYYY-MM)"""
+    def construir(db):
+        texto = (request.args.get('mes') or '').strip() or datetime.utcnow().strftime('%Y-%m')
+        try:
+            inicio = datetime.strptime(texto, '%Y-%m').date()
+        except ValueError:
+            raise ValueError("mes debe tener formato YYYY-MM")
+        siguiente = (inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return {'mes': texto, **resumen_periodo(db, inicio, siguiente - timedelta(days=1))}
+    return responder_reporte('mensual', construir)
+
+
+@app.get('/api/reportes/anual')
+def reporte_anual():
+    """Totales de un año (año=YYYY o anio=YYYY)"""
+    def construir(db):
+        texto = (request.args.get('año') or request.args.get('anio') or '').strip() or str(datetime.utcnow().year)
+        if not texto.isdigit() or not 1 <= int(texto) <= 9999:
+            raise ValueError("año debe ser un número (YYYY)")
+        anio = int(texto)
+        totales = resumen_periodo(db, date(anio, 1, 1), date(anio, 12, 31))
+        return {
+            'año': anio,
+            'total_prestamos': totales['prestamos'],
+            'total_devoluciones': totales['devoluciones'],
+            'total_sanciones': totales['sanciones'],
+        }
+    return responder_reporte('anual', construir)
+
+
+# -------------------------------
+# Analítica (NumPy)
+# -------------------------------
+# Las columnas necesarias de prestamos y libros se cargan una vez por versión de datos en arreglos
+# NumPy, leyendo la consulta por bloques. Las estadísticas (percentiles de duración, rotación por
+# título, utilización por categoría, horas pico) se calculan con operaciones vectorizadas sobre esos
+# arreglos; el resultado serializado queda además en cache_reportes (ver responder_reporte).
+# Cuando la versión cambia (cualquier préstamo la cambia) no se bloquea a nadie: se siguen usando los
+# arreglos anteriores mientras un hilo los recarga, como mucho una vez cada ANALITICA_ANTIGUEDAD_SEGUNDOS.
+
+LOTE_ANALITICA = int(os.environ.get('ANALITICA_LOTE', '50000'))
+ZONA_HORARIA_HORAS = float(os.environ.get('ZONA_HORARIA_HORAS', '-5'))  # Colombia (UTC-5) para horas pico
+PERCENTILES_DURACION = (50, 75, 90, 95, 99)
+ESTADOS_ANALITICA = ('pendiente', 'aprobado', 'rechazado', 'devuelto')
+SEGUNDOS_DIA = 86400
+ANTIGUEDAD_MAXIMA_ANALITICA = int(os.environ.get('ANALITICA_ANTIGUEDAD_SEGUNDOS', '300'))
+
+
+@dataclass
+class DatosAnalitica:
+    version: int
+    # Libros (una posición por copia; la última posición es un centinela para elementos inexistentes)
+    libro_categoria: Any
+    libro_grupo: Any
+    libro_stock: Any
+    libro_prestado: Any
+    categorias: List[str]
+    grupo_titulo: List[str]
+    # Préstamos
+    elemento: Any
+    estado: Any
+    creado_en: Any
+    fecha_prestamo: Any
+    fecha_devolucion: Any
+
+
+_datos_analitica: Optional[DatosAnalitica] = None
+_datos_analitica_cargados_en = 0.0  # time.monotonic() de la última carga
+_recarga_analitica: Optional[threading.Thread] = None
+_datos_analitica_lock = threading.Lock()
+
+
+def _columnas_por_bloques(db, consulta, lote: int) -> Iterator[tuple]:
+    """Recorrer una consulta por bloques de filas, devolviendo cada bloque como tupla de columnas"""
+    resultado = db.execute(consulta.execution_options(yield_per=lote))
+    for filas in resultado.partitions(lote):
+        yield tuple(zip(*filas))
+
+
+def _fechas(columna: tuple) -> Any:
+    return np.array(columna, dtype='datetime64[s]')  # None -> NaT
+
+
+def cargar_datos_analitica(db, version: int, *, lote: Optional[int] = None) -> DatosAnalitica:
+    lote = lote or LOTE_ANALITICA
+    posicion_libro: Dict[str, int] = {}
+    categorias: Dict[str, int] = {}
+    grupos: Dict[str, int] = {}
+    grupo_titulo: List[str] = []
+    libro_categoria, libro_grupo, libro_stock, libro_prestado = [], [], [], []
+    consulta_libros = select(
+        LibroDB.id, LibroDB.categoria, LibroDB.clave_grupo, LibroDB.titulo, LibroDB.stock, LibroDB.cantidad_prestado
+    ).order_by(LibroDB.id)
+    for ids, cats, claves, titulos, stocks, prestados in _columnas_por_bloques(db, consulta_libros, lote):
+        inicio = len(posicion_libro)
+        posicion_libro.update((id_libro, inicio + i) for i, id_libro in enumerate(ids))
+        libro_categoria.append(np.fromiter(
+            (categorias.setdefault(categoria_estadistica(c), len(categorias)) for c in cats), dtype=np.int32, count=len(ids)
+        ))
+        codigos = []
+        for clave, titulo, id_libro in zip(claves, titulos, ids):
+            clave = clave or id_libro
+            codigo = grupos.get(clave)
+            if codigo is None:
+                codigo = grupos[clave] = len(grupos)
+                grupo_titulo.append(titulo)
+            codigos.append(codigo)
+        libro_grupo.append(np.array(codigos, dtype=np.int32))
+        libro_stock.append(np.array([v or 0 for v in stocks], dtype=np.int64))
+        libro_prestado.append(np.array([v or 0 for v in prestados], dtype=np.int64))
+    centinela = len(posicion_libro)
+
+    def unir(partes, dtype, relleno):
+        return np.concatenate(partes + [np.array([relleno], dtype=dtype)])
+
+    codigo_estado = {e: i for i, e in enumerate(ESTADOS_ANALITICA)}
+    elemento, estado, creado_en, fecha_prestamo, fecha_devolucion = [], [], [], [], []
+    consulta_prestamos = select(
+        PrestamoDB.id_elemento, PrestamoDB.estado, PrestamoDB.creado_en, PrestamoDB.fecha_prestamo, PrestamoDB.fecha_devolucion
+    )
+    for elementos, estados, creados, prestados, devueltos in _columnas_por_bloques(db, consulta_prestamos, lote):
+        n = len(elementos)
+        elemento.append(np.fromiter((posicion_libro.get(e, centinela) for e in elementos), dtype=np.int32, count=n))
+        estado.append(np.fromiter((codigo_estado.get(e, -1) for e in estados), dtype=np.int8, count=n))
+        creado_en.append(_fechas(creados))
+        fecha_prestamo.append(_fechas(prestados))
+        fecha_devolucion.append(_fechas(devueltos))
+
+    def concatenar(partes, dtype):
+        return np.concatenate(partes) if partes else np.array([], dtype=dtype)
+
+    return DatosAnalitica(
+        version=version,
+        libro_categoria=unir(libro_categoria, np.int32, -1),
+        libro_grupo=unir(libro_grupo, np.int32, -1),
+        libro_stock=unir(libro_stock, np.int64, 0),
+        libro_prestado=unir(libro_prestado, np.int64, 0),
+        categorias=list(categorias),
+        grupo_titulo=grupo_titulo,
+        elemento=concatenar(elemento, np.int32),
+        estado=concatenar(estado, np.int8),
+        creado_en=concatenar(creado_en, 'datetime64[s]'),
+        fecha_prestamo=concatenar(fecha_prestamo, 'datetime64[s]'),
+        fecha_devolucion=concatenar(fecha_devolucion, 'datetime64[s]'),
+    )
+
+
+def _recargar_datos_analitica(version: int) -> None:
+    global _datos_analitica, _datos_analitica_cargados_en, _recarga_analitica
+    db = SessionLocal()
+    try:
+        datos = cargar_datos_analitica(db, version)
+        with _datos_analitica_lock:
+            _datos_analitica = datos
+            _datos_analitica_cargados_en = time.monotonic()
+    except Exception as e:
+        print(f"Error recargando la analítica: {e}")
+    finally:
+        db.close()
+        with _datos_analitica_lock:
+            _recarga_analitica = None
+
+
+def datos_analitica(db) -> DatosAnalitica:
+    """
+    Arreglos para la analítica. Solo la primera carga bloquea; si la versión cambió se devuelven los
+    arreglos anteriores y se recargan en segundo plano (como mucho cada ANTIGUEDAD_MAXIMA_ANALITICA).
+    """
+    global _datos_analitica, _datos_analitica_cargados_en
+    version = version_reportes(db)
+    with _datos_analitica_lock:
+        if _datos_analitica is None:
+            _datos_analitica = cargar_datos_analitica(db, version)
+            _datos_analitica_cargados_en = time.monotonic()
+        else:
+            _programar_recarga_analitica(version)
+        return _datos_analitica
+
+
+def _programar_recarga_analitica(version: int) -> None:
+    """Con _datos_analitica_lock tomado: recargar en segundo plano si los arreglos están atrasados y ya toca"""
+    global _recarga_analitica
+    if (
+        _datos_analitica.version != version
+        and _recarga_analitica is None
+        and time.monotonic() - _datos_analitica_cargados_en >= ANTIGUEDAD_MAXIMA_ANALITICA
+    ):
+        _recarga_analitica = threading.Thread(
+            target=_recargar_datos_analitica, args=(version,), name='recarga-analitica', daemon=True
+        )
+        _recarga_analitica.start()
+
+
+def clave_datos_analitica(version: int) -> str:
+    """
+    Parte de la clave de caché: la versión de los arreglos si están atrasados respecto a 'version'.
+    También programa la recarga (una respuesta en caché no pasa por datos_analitica).
+    """
+    with _datos_analitica_lock:
+        if _datos_analitica is None or _datos_analitica.version == version:
+            return ''
+        _programar_recarga_analitica(version)
+        return f"#{_datos_analitica.version}"
+
+
+def _percentiles(valores: Any) -> Dict[str, Any]:
+    if not len(valores):
+        return {'cantidad': 0, 'promedio': None, **{f'p{p}': None for p in PERCENTILES_DURACION}}
+    calculados = np.percentile(valores, PERCENTILES_DURACION)
+    return {
+        'cantidad': int(len(valores)),
+        'promedio': round(float(valores.mean()), 2),
+        **{f'p{p}': round(float(v), 2) for p, v in zip(PERCENTILES_DURACION, calculados)},
+    }
+
+
+def calcular_analitica(datos: DatosAnalitica, *, desde: Optional[datetime] = None, hasta: Optional[datetime] = None,
+                       categoria: Optional[str] = None, top: int = 10, ahora: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Estadísticas de préstamos creados en [desde, hasta) (opcionalmente de una categoría):
+    duración en días de los devueltos, rotación por título, utilización por categoría y horas pico.
+    """
+    ahora = np.datetime64(ahora or datetime.utcnow(), 's')
+    cat_prestamo = datos.libro_categoria[datos.elemento]
+    grupo_prestamo = datos.libro_grupo[datos.elemento]
+    mascara = np.ones(len(datos.estado), dtype=bool)
+    if desde is not None:
+        mascara &= datos.creado_en >= np.datetime64(desde, 's')
+    if hasta is not None:
+        mascara &= datos.creado_en < np.datetime64(hasta, 's')
+    codigo_categoria = None
+    if categoria:
+        codigo_categoria = datos.categorias.index(categoria) if categoria in datos.categorias else -2
+        mascara &= cat_prestamo == codigo_categoria
+    rechazado = ESTADOS_ANALITICA.index('rechazado')
+    aprobado = ESTADOS_ANALITICA.index('aprobado')
+    devuelto = ESTADOS_ANALITICA.index('devuelto')
+    efectivos = mascara & (datos.estado != rechazado)
+
+    # Duración de los préstamos devueltos (días)
+    con_duracion = mascara & (datos.estado == devuelto) & ~np.isnat(datos.fecha_prestamo) & ~np.isnat(datos.fecha_devolucion)
+    duracion = (datos.fecha_devolucion[con_duracion] - datos.fecha_prestamo[con_duracion]).astype(np.int64) / SEGUNDOS_DIA
+    cat_duracion = cat_prestamo[con_duracion]
+    duracion_por_categoria = {
+        nombre: _percentiles(duracion[cat_duracion == codigo])
+        for codigo, nombre in enumerate(datos.categorias)
+        if codigo_categoria in (None, codigo)
+    }
+
+    # Rotación por título (grupo de copias): préstamos / unidades
+    n_grupos = len(datos.grupo_titulo)
+    validos = efectivos & (grupo_prestamo >= 0)
+    prestamos_grupo = np.bincount(grupo_prestamo[validos], minlength=n_grupos)
+    libros_validos = datos.libro_grupo >= 0
+    if codigo_categoria is not None:
+        libros_validos &= datos.libro_categoria == codigo_categoria
+    stock_grupo = np.bincount(datos.libro_grupo[libros_validos], weights=datos.libro_stock[libros_validos], minlength=n_grupos)
+    rotacion = np.divide(prestamos_grupo, stock_grupo, out=np.zeros(n_grupos), where=stock_grupo > 0)
+    orden = np.argsort(-rotacion, kind='stable')[:max(top, 0)]
+    rotacion_titulos = [
+        {'titulo': datos.grupo_titulo[g], 'prestamos': int(prestamos_grupo[g]), 'unidades': int(stock_grupo[g]),
+         'rotacion': round(float(rotacion[g]), 3)}
+        for g in orden if prestamos_grupo[g]
+    ]
+
+    # Utilización por categoría: unidades prestadas hoy, préstamos por unidad y ocupación en el periodo
+    n_cat = len(datos.categorias)
+    libros_cat = datos.libro_categoria >= 0
+    stock_cat = np.bincount(datos.libro_categoria[libros_cat], weights=datos.libro_stock[libros_cat], minlength=n_cat)
+    prestado_cat = np.bincount(datos.libro_categoria[libros_cat], weights=datos.libro_prestado[libros_cat], minlength=n_cat)
+    con_cat = efectivos & (cat_prestamo >= 0)
+    prestamos_cat = np.bincount(cat_prestamo[con_cat], minlength=n_cat)
+    inicio_ventana = np.datetime64(desde, 's') if desde is not None else (datos.creado_en[mascara].min() if mascara.any() else ahora)
+    fin_ventana = min(np.datetime64(hasta, 's'), ahora) if hasta is not None else ahora
+    dias_ventana = max(float((fin_ventana - inicio_ventana).astype(np.int64)) / SEGUNDOS_DIA, 1.0)
+    en_curso = con_cat & ((datos.estado == aprobado) | (datos.estado == devuelto)) & ~np.isnat(datos.fecha_prestamo)
+    fin_prestamo = np.where(datos.estado == devuelto, datos.fecha_devolucion, ahora)
+    fin_prestamo = np.where(np.isnat(fin_prestamo), ahora, fin_prestamo)
+    inicio_ocupado = np.maximum(datos.fecha_prestamo[en_curso], inicio_ventana)
+    fin_ocupado = np.minimum(fin_prestamo[en_curso], fin_ventana)
+    dias_ocupados = np.clip((fin_ocupado - inicio_ocupado).astype(np.int64), 0, None) / SEGUNDOS_DIA
+    ocupacion_cat = np.bincount(cat_prestamo[en_curso], weights=dias_ocupados, minlength=n_cat)
+    utilizacion = []
+    for codigo, nombre in enumerate(datos.categorias):
+        if codigo_categoria not in (None, codigo):
+            continue
+        unidades = float(stock_cat[codigo])
+        utilizacion.append({
+            'categoria': nombre,
+            'unidades': int(unidades),
+            'prestadas_ahora': int(prestado_cat[codigo]),
+            'utilizacion_actual': round(float(prestado_cat[codigo]) / unidades, 4) if unidades else None,
+            'prestamos': int(prestamos_cat[codigo]),
+            'prestamos_por_unidad': round(float(prestamos_cat[codigo]) / unidades, 3) if unidades else None,
+            'ocupacion_periodo': round(float(ocupacion_cat[codigo]) / (unidades * dias_ventana), 4) if unidades else None,
+        })
+
+    # Horas pico (hora local de la solicitud)
+    segundos = datos.creado_en[mascara].astype(np.int64) + int(ZONA_HORARIA_HORAS * 3600)
+    hora = (segundos // 3600) % 24
+    dia_semana = (segundos // SEGUNDOS_DIA + 3) % 7  # 1970-01-01 fue jueves; 0 = lunes
+    matriz = np.bincount(dia_semana * 24 + hora, minlength=7 * 24).reshape(7, 24)
+    por_hora = matriz.sum(axis=0)
+
+    return {
+        'prestamos': int(mascara.sum()),
+        'por_estado': {e: int(np.count_nonzero(datos.estado[mascara] == i)) for i, e in enumerate(ESTADOS_ANALITICA)},
+        'duracion_dias': {'general': _percentiles(duracion), 'por_categoria': duracion_por_categoria},
+        'rotacion_titulos': rotacion_titulos,
+        'utilizacion_categorias': utilizacion,
+        'horas_pico': {
+            'zona_horaria_horas': ZONA_HORARIA_HORAS,
+            'por_hora': por_hora.tolist(),
+            'por_dia_semana': matriz.sum(axis=1).tolist(),
+            'dia_hora': matriz.tolist(),
+            'hora_pico': int(por_hora.argmax()) if por_hora.any() else None,
+        },
+    }
+
 
-    if sanitized.get('estado') == 'resuelta' and not fecha_fin:
-        # Si se marca como resuelta y no hay fecha_fin, usar la actual
-        sanitized['fecha_fin'] = datetime.utcnow()
+@app.get('/api/reportes/analitica')
+def reporte_analitica():
+    """
+    Analítica de préstamos e inventario (NumPy). Parámetros opcionales: fecha_desde, fecha_hasta (sobre
+    la fecha de solicitud), categoria, top (títulos con mayor rotación, por defecto 10)
+    """
+    if np is None:
+        return jsonify({"ok": False, "error": "La analítica requiere numpy (pip install -r requirements.txt)"}), 501
 
-    if 'tipo_id' not in sanitized or not sanitized['tipo_id']:
-        errores.append("El tipo de sanción es obligatorio")
+    def construir(db):
+        desde, hasta = rango_fechas_reporte()
+        try:
+            top = int(request.args.get('top') or 10)
+        except ValueError:
+            raise ValueError("top debe ser un número entero")
+        if not 1 <= top <= 100:
+            raise ValueError("top debe estar entre 1 y 100")
+        datos = datos_analitica(db)
+        return calcular_analitica(datos, desde=desde, hasta=hasta, categoria=request.args.get('categoria') or None, top=top)
 
-    return errores, sanitized
+    # La ocupación de préstamos en curso depende del día actual. Un resultado calculado con arreglos
+    # atrasados lleva su versión en la clave: deja de servirse cuando termina la recarga.
+    hoy = datetime.utcnow().date().isoformat()
+    return responder_reporte('analitica', construir, clave_extra=lambda version: f"#{hoy}{clave_datos_analitica(version)}")
 
 
-@app.get('/api/sanciones')
-def sanciones_listar():
-    db = SessionLocal()
-    try:
-        query = db.query(SancionDB)
-        id_usuario = request.args.get('id_usuario')
-        estado = request.args.get('estado')
-        if id_usuario:
-            query = query.filter(SancionDB.id_usuario == id_usuario)
-        if estado:
-            query = query.filter(SancionDB.estado == estado.lower())
-        sanciones = query.order_by(SancionDB.creado_en.desc()).all()
+# -------------------------------
+# Exportaciones (CSV / XLSX)
+# -------------------------------
+# Las exportaciones recorren la consulta con yield_per (cursor del lado del servidor en PostgreSQL)
+# y nunca acumulan el resultado: el CSV se envía por lotes de filas y el XLSX se escribe con
+# openpyxl en modo write-only a un archivo temporal que luego se envía por bloques.
 
-        tipo_ids = {s.tipo_id for s in sanciones if s.tipo_id}
-        usuario_ids = {s.id_usuario for s in sanciones if s.id_usuario}
-        prestamo_ids = {s.id_prestamo for s in sanciones if s.id_prestamo}
-        causa_ids = {s.causa_id for s in sanciones if s.causa_id}
+LOTE_EXPORTACION = int(os.environ.get('EXPORTACION_LOTE', '2000'))
+BLOQUE_EXPORTACION = 64 * 1024
+FORMATOS_EXPORTACION = ('csv', 'xlsx')
 
-        tipos_map = {}
-        if tipo_ids:
-            tipos = db.query(SancionTipoDB).filter(SancionTipoDB.id.in_(tipo_ids)).all()
-            tipos_map = {t.id: t for t in tipos}
+# tabla: (modelo, columnas, columna de fecha para fecha_desde/fecha_hasta, filtros exactos permitidos)
+EXPORTACIONES = {
+    'prestamos': (PrestamoDB, ESQUEMA_PRESTAMO.campos + ('usuario_original',), 'creado_en', ('estado', 'id_usuario')),
+    'libros': (LibroDB, ESQUEMA_LIBRO.campos, 'creado_en', ('categoria', 'subcategoria', 'estado_elemento')),
+    'sanciones': (SancionDB, ESQUEMA_SANCION.campos + ('causa',), 'creado_en', ('estado', 'id_usuario')),
+    'libro_historial': (
+        LibroHistorialDB,
+        ('id', 'id_libro_original', 'titulo', 'autor', 'isbn', 'codigo_inventario', 'categoria', 'motivo_eliminacion',
+         'usuario_eliminador', 'fecha_eliminacion', 'prestamos_relacionados', 'favoritos_relacionados'),
+        'fecha_eliminacion',
+        ('categoria',),
+    ),
+}
 
-        usuarios_map = {}
-        if usuario_ids:
-            usuarios = db.query(UserDB).filter(UserDB.id.in_(usuario_ids)).all()
-            usuarios_map = {u.id: u for u in usuarios}
 
-        prestamos_map = {}
-        if prestamo_ids:
-            prestamos = db.query(PrestamoDB).filter(PrestamoDB.id.in_(prestamo_ids)).all()
-            prestamos_map = {p.id: p for p in prestamos}
+PREFIJOS_FORMULA = ('=', '+', '-', '@', '\t', '\r')
 
-        causas_map = {}
-        if causa_ids:
-            causas = db.query(SancionCausaDB).filter(SancionCausaDB.id.in_(causa_ids)).all()
-            causas_map = {c.id: c for c in causas}
 
-        resultado = [
-            sancion_to_dict(
-                s,
-                tipo=tipos_map.get(s.tipo_id),
-                usuario=usuarios_map.get(s.id_usuario),
-                prestamo=prestamos_map.get(s.id_prestamo),
-                causa=causas_map.get(s.causa_id)
-            )
-            for s in sanciones
-        ]
+def _texto_seguro(valor: Any) -> Any:
+    """Textos que Excel interpretaría como fórmula (títulos, observaciones...) se exportan con ' delante"""
+    if isinstance(valor, str) and valor.startswith(PREFIJOS_FORMULA):
+        return "'" + valor
+    return valor
 
-        q = (request.args.get('q') or '').strip().lower()
-        if q:
-            filtrado = []
-            for item in resultado:
-                texto = " ".join(str(item.get(k) or '') for k in ['tipo_codigo', 'tipo_descripcion', 'usuario_nombre', 'usuario_documento', 'causa', 'estado'])
-                if q in texto.lower():
-                    filtrado.append(item)
-            resultado = filtrado
 
-        return jsonify(resultado)
-    except Exception as e:
-        return jsonify({"error": f"Error al listar sanciones: {str(e)}"}), 500
+def _valor_csv(valor: Any) -> Any:
+    if valor is None:
+        return ''
+    if isinstance(valor, datetime):
+        return valor.isoformat() + 'Z'
+    return _texto_seguro(valor)
+
+
+def exportacion_csv(consulta_filas: Callable[[Any], Any], encabezados: tuple) -> Iterator[bytes]:
+    db = SessionLocal()
+    try:
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(encabezados)
+        yield '\ufeff'.encode('utf-8') + buffer.getvalue().encode('utf-8')  # BOM: Excel detecta UTF-8
+        filas_iter = iter(consulta_filas(db))
+        while True:
+            filas = list(islice(filas_iter, LOTE_EXPORTACION))
+            if not filas:
+                break
+            buffer.seek(0)
+            buffer.truncate()
+            escritor.writerows([_valor_csv(v) for v in fila] for fila in filas)
+            yield buffer.getvalue().encode('utf-8')
     finally:
         db.close()
 
 
-@app.get('/api/sanciones/<sancion_id>')
-def sancion_obtener(sancion_id: str):
+def exportacion_xlsx(consulta_filas: Callable[[Any], Any], encabezados: tuple, hoja: str) -> Iterator[bytes]:
     db = SessionLocal()
+    archivo = tempfile.NamedTemporaryFile(prefix='exportacion_', suffix='.xlsx', delete=False)
+    archivo.close()
     try:
-        sancion = db.get(SancionDB, sancion_id)
-        if not sancion:
-            return jsonify({"error": "Sanción no encontrada"}), 404
-        tipo = db.get(SancionTipoDB, sancion.tipo_id) if sancion.tipo_id else None
-        usuario = db.get(UserDB, sancion.id_usuario) if sancion.id_usuario else None
-        prestamo = db.get(PrestamoDB, sancion.id_prestamo) if sancion.id_prestamo else None
-        causa = db.get(SancionCausaDB, sancion.causa_id) if sancion.causa_id else None
-        return jsonify(sancion_to_dict(sancion, tipo=tipo, usuario=usuario, prestamo=prestamo, causa=causa))
+        libro = openpyxl.Workbook(write_only=True)
+        hoja_xlsx = libro.create_sheet(hoja)
+        hoja_xlsx.append(list(encabezados))
+        for fila in consulta_filas(db):
+            hoja_xlsx.append([_texto_seguro(v) for v in fila])
+        db.close()
+        libro.save(archivo.name)
+        with open(archivo.name, 'rb') as f:
+            while True:
+                bloque = f.read(BLOQUE_EXPORTACION)
+                if not bloque:
+                    break
+                yield bloque
     finally:
         db.close()
+        try:
+            os.remove(archivo.name)
+        except OSError:
+            pass
 
 
-@app.post('/api/sanciones')
-def sancion_crear():
-    data = request.get_json(force=True, silent=True) or {}
-    db = SessionLocal()
+@app.get('/api/exportar/<tabla>')
+def exportar_tabla(tabla: str):
+    """
+    Exportar prestamos, libros, sanciones o libro_historial completos en streaming.
+    Parámetros: formato (csv|xlsx, por defecto csv), fecha_desde / fecha_hasta (YYYY-MM-DD) y los filtros
+    exactos de cada tabla (prestamos: estado, id_usuario; libros: categoria, subcategoria, estado_elemento;
+    sanciones: estado, id_usuario; libro_historial: categoria)
+    """
+    if tabla not in EXPORTACIONES:
+        return jsonify({"ok": False, "error": f"tabla debe ser una de: {', '.join(EXPORTACIONES)}"}), 404
+    formato = (request.args.get('formato') or 'csv').strip().lower()
+    if formato not in FORMATOS_EXPORTACION:
+        return jsonify({"ok": False, "error": f"formato debe ser uno de: {', '.join(FORMATOS_EXPORTACION)}"}), 400
+    if formato == 'xlsx' and openpyxl is None:
+        return jsonify({"ok": False, "error": "Exportar a Excel requiere openpyxl (ver INSTALAR_OPENPYXL.md)"}), 501
     try:
-        errores, sanitized = validar_sancion_payload(data, db)
-        if errores:
-            return jsonify({"ok": False, "errores": errores}), 400
+        desde, hasta = rango_fechas_reporte()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
 
-        now = datetime.utcnow()
-        sancion = SancionDB(
-            id=str(uuid.uuid4()),
-            tipo_id=sanitized['tipo_id'],
-            id_usuario=sanitized['id_usuario'],
-            id_prestamo=sanitized.get('id_prestamo'),
-            causa_id=sanitized.get('causa_id'),
-            causa=sanitized.get('causa_texto', ''),
-            observaciones=sanitized.get('observaciones'),
-            estado=sanitized['estado'],
-            fecha_inicio=sanitized['fecha_inicio'] or now,
-            fecha_fin=sanitized.get('fecha_fin'),
-            resuelto_en=now if sanitized['estado'] == 'resuelta' else None,
-            usuario_registro=sanitized.get('usuario_registro'),
-            creado_en=now,
-            actualizado_en=now,
+    modelo, columnas, columna_fecha, filtros = EXPORTACIONES[tabla]
+    condiciones = []
+    fecha = getattr(modelo, columna_fecha)
+    if desde is not None:
+        condiciones.append(fecha >= desde)
+    if hasta is not None:
+        condiciones.append(fecha < hasta)
+    valores_filtro = {campo: request.args.get(campo) for campo in filtros if request.args.get(campo)}
+
+    def consulta_filas(db):
+        q = select(*(getattr(modelo, c) for c in columnas)).where(*condiciones)
+        for campo, valor in valores_filtro.items():
+            if campo == 'id_usuario':
+                valor = id_usuario_canonico(db, valor)
+            q = q.where(getattr(modelo, campo) == valor)
+        q = q.order_by(fecha, modelo.id).execution_options(yield_per=LOTE_EXPORTACION)
+        return db.execute(q)
+
+    nombre = f"{tabla}_{datetime.utcnow():%Y%m%d_%H%M%S}.{formato}"
+    if formato == 'csv':
+        response = Response(exportacion_csv(consulta_filas, columnas), mimetype='text/csv; charset=utf-8')
+    else:
+        response = Response(
+            exportacion_xlsx(consulta_filas, columnas, tabla),
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
         )
-        db.add(sancion)
-        db.commit()
-        db.refresh(sancion)
-        return jsonify({
-            "ok": True,
-            "sancion": sancion_to_dict(sancion, tipo=sanitized.get('tipo'), usuario=sanitized.get('usuario'),
-                                       prestamo=sanitized.get('prestamo'),
-                                       causa=sanitized.get('causa_obj'))
-        }), 201
-    except Exception as e:
-        db.rollback()
-        return jsonify({"ok": False, "error": f"Error al crear sanción: {str(e)}"}), 500
-    finally:
-        db.close()
+    response.headers['Content-Disposition'] = f'attachment; filename="{nombre}"'
+    return response
 
 
-@app.put('/api/sanciones/<sancion_id>')
-def sancion_actualizar(sancion_id: str):
-    data = request.get_json(force=True, silent=True) or {}
-    db = SessionLocal()
+# -------------------------------
+# Explorador de base de datos (/api/db/*)
+# -------------------------------
+# Respaldo de templates/explorar_db.html. Los conteos de filas son estimados (sqlite_stat1 o max(rowid)
+# en SQLite, pg_class.reltuples en PostgreSQL) y solo se cuentan exactos en tablas pequeñas; las
+# estadísticas se guardan ESTADISTICAS_BD_TTL segundos. Las consultas se ejecutan en una conexión de
+# solo lectura, con tiempo límite y tope de filas, y el resultado se envía en streaming.
+# Los endpoints están apagados salvo que EXPLORADOR_BD_HABILITADO esté activo, y solo responden a
+# administradores (token 'admin-token' o 'user-<id>' de un usuario con rol admin en Authorization).
+
+EXPLORADOR_BD_HABILITADO = os.environ.get('EXPLORADOR_BD_HABILITADO', '').strip().lower() in ('1', 'true', 'si', 'sí')
+ESTADISTICAS_BD_TTL = int(os.environ.get('ESTADISTICAS_BD_TTL', '60'))
+UMBRAL_CONTEO_EXACTO = int(os.environ.get('UMBRAL_CONTEO_EXACTO', '50000'))
+LIMITE_FILAS_CONSULTA = int(os.environ.get('LIMITE_FILAS_CONSULTA', '1000'))
+TIMEOUT_CONSULTA_S = float(os.environ.get('TIMEOUT_CONSULTA_S', '5'))
+LOTE_CONSULTA = 200
+PALABRAS_CONSULTA_LECTURA = ('select', 'with')
+# Tablas con columnas que no se muestran (contraseñas). Las consultas que las nombran se rechazan: en
+# PostgreSQL una fila completa (SELECT u FROM usuarios u, row_to_json(u)) también expone la columna.
+TABLAS_SENSIBLES = {'usuarios': ('password',)}
+_TABLA_SENSIBLE = re.compile(r'\b(' + '|'.join(TABLAS_SENSIBLES) + r')\b', re.IGNORECASE)
+# Funciones con efectos aunque la transacción sea READ ONLY (pg_terminate_backend, pg_advisory_lock,
+# set_config...) o que ejecutan SQL escrito en un texto (query_to_xml)
+_FUNCION_PROHIBIDA = re.compile(
+    r'\b(pg_\w+|set_config|dblink\w*|lo_\w+|\w*_to_xml\w*|load_extension)"?\s*\(', re.IGNORECASE
+)
+
+# La "versión" de esta caché es la ventana de tiempo actual: al cambiar de ventana se recalcula todo
+cache_estadisticas_bd = registrar_cache('estadisticas_bd', max_entradas=64)
+
+
+def _ventana_estadisticas_bd() -> int:
+    return int(time.time() // max(ESTADISTICAS_BD_TTL, 1))
+
+
+def tablas_bd() -> List[str]:
+    version = _ventana_estadisticas_bd()
+    cacheado = cache_estadisticas_bd.obtener(version, '#tablas')
+    if cacheado is not None:
+        return json.loads(cacheado)
+    tablas = sorted(inspect(engine).get_table_names())
+    cache_estadisticas_bd.guardar(version, '#tablas', json_bytes(tablas))
+    return tablas
+
+
+def _conteo_estimado(conn, tabla: str) -> tuple[Optional[int], str]:
+    """(filas estimadas, fuente) sin recorrer la tabla; (None, '') si el motor no da una estimación"""
+    if es_postgres():
+        fila = conn.execute(text(
+            "SELECT c.reltuples, s.n_live_tup FROM pg_class c "
+            "LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid WHERE c.oid = to_regclass(:tabla)"
+        ), {'tabla': tabla}).first()
+        if fila is not None and fila[0] is not None and fila[0] >= 0:
+            return int(fila[0]), 'pg_class.reltuples'
+        if fila is not None and fila[1] is not None:
+            return int(fila[1]), 'pg_stat_user_tables.n_live_tup'
+        return None, ''
+    hay_stat1 = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")).first()
+    if hay_stat1:
+        # La primera cifra de 'stat' es el número de filas de la tabla (o del índice) al último ANALYZE
+        estadisticas = conn.execute(text("SELECT stat FROM sqlite_stat1 WHERE tbl = :tabla"), {'tabla': tabla}).scalars().all()
+        conteos = [int(e.split()[0]) for e in estadisticas if e and e.split()[0].isdigit()]
+        if conteos:
+            return max(conteos), 'sqlite_stat1'
     try:
-        sancion = db.get(SancionDB, sancion_id)
-        if not sancion:
-            return jsonify({"ok": False, "error": "Sanción no encontrada"}), 404
+        # max(rowid) se resuelve con el b-tree (O(log n)); sobreestima si hubo borrados
+        maximo = conn.execute(text(f'SELECT max(rowid) FROM "{tabla}"')).scalar()
+        return int(maximo or 0), 'max(rowid)'
+    except DBAPIError:
+        return None, ''  # Tabla WITHOUT ROWID
+
+
+def estadisticas_tabla(tabla: str) -> bytes:
+    version = _ventana_estadisticas_bd()
+    cacheado = cache_estadisticas_bd.obtener(version, tabla)
+    if cacheado is not None:
+        return cacheado
+    inspector = inspect(engine)
+    with engine.connect() as conn:
+        estimado, fuente = _conteo_estimado(conn, tabla)
+        exacto = estimado is None or estimado <= UMBRAL_CONTEO_EXACTO
+        if exacto:
+            conteo = int(conn.execute(text(f'SELECT count(*) FROM "{tabla}"')).scalar() or 0)
+            fuente = 'count(*)'
+        else:
+            conteo = estimado
+        tamano = None
+        if es_postgres():
+            tamano = conn.execute(text("SELECT pg_total_relation_size(to_regclass(:tabla))"), {'tabla': tabla}).scalar()
+    datos = {
+        'tabla': tabla,
+        'count': conteo,
+        'estimado': not exacto,
+        'fuente': fuente,
+        'tamano_bytes': tamano,
+        'columnas': [{'nombre': c['name'], 'tipo': str(c['type'])} for c in inspector.get_columns(tabla)],
+        'indices': [i['name'] for i in inspector.get_indexes(tabla)],
+        'calculado_en': datetime.utcnow(),
+    }
+    contenido = json_bytes(datos)
+    cache_estadisticas_bd.guardar(version, tabla, contenido)
+    return contenido
+
+
+def _rechazo_explorador() -> Optional[tuple[Response, int]]:
+    """Respuesta de error si el explorador está apagado o quien llama no es administrador; None si puede seguir"""
+    if not EXPLORADOR_BD_HABILITADO:
+        return jsonify({"ok": False, "error": "El explorador de base de datos está deshabilitado (EXPLORADOR_BD_HABILITADO)"}), 404
+    auth = (request.headers.get('Authorization') or '').split()
+    token = auth[-1] if auth else ''
+    if token == 'admin-token':
+        return None
+    if token.startswith('user-'):
+        db = SessionLocal()
+        try:
+            user = db.get(UserDB, token[len('user-'):])
+            if user is not None and user.role == 'admin':
+                return None
+        finally:
+            db.close()
+    return jsonify({"ok": False, "error": "Solo los administradores pueden usar el explorador de base de datos"}), 403
+
+
+@app.get('/api/db/tablas')
+def db_tablas():
+    """Nombres de las tablas de la base de datos"""
+    rechazo = _rechazo_explorador()
+    if rechazo:
+        return rechazo
+    return jsonify({'tablas': tablas_bd()})
+
+
+@app.get('/api/db/stats/<tabla>')
+def db_stats(tabla: str):
+    """Filas (estimadas en tablas grandes), columnas, índices y tamaño de una tabla"""
+    rechazo = _rechazo_explorador()
+    if rechazo:
+        return rechazo
+    if tabla not in tablas_bd():
+        return jsonify({"ok": False, "error": "Tabla no encontrada"}), 404
+    try:
+        return Response(estadisticas_tabla(tabla), mimetype='application/json')
+    except DBAPIError as e:
+        return jsonify({"ok": False, "error": str(e.orig)}), 500
 
-        errores, sanitized = validar_sancion_payload(data, db, existente=sancion)
-        if errores:
-            return jsonify({"ok": False, "errores": errores}), 400
 
-        sancion.tipo_id = sanitized['tipo_id']
-        sancion.id_usuario = sanitized['id_usuario']
-        sancion.id_prestamo = sanitized.get('id_prestamo')
-        sancion.causa_id = sanitized.get('causa_id')
-        sancion.causa = sanitized.get('causa_texto', sancion.causa)
-        sancion.observaciones = sanitized.get('observaciones')
-        sancion.estado = sanitized['estado']
-        sancion.fecha_inicio = sanitized['fecha_inicio'] or sancion.fecha_inicio
-        sancion.fecha_fin = sanitized.get('fecha_fin')
-        if sancion.estado == 'resuelta' and not sancion.resuelto_en:
-            sancion.resuelto_en = datetime.utcnow()
-        elif sancion.estado != 'resuelta':
-            sancion.resuelto_en = None
-        sancion.usuario_registro = sanitized.get('usuario_registro') or sancion.usuario_registro
-        sancion.actualizado_en = datetime.utcnow()
+def _valor_consulta(valor: Any) -> Any:
+    if isinstance(valor, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(valor).hex()
+    return valor
 
-        db.commit()
-        db.refresh(sancion)
 
-        return jsonify({
-            "ok": True,
-            "sancion": sancion_to_dict(
-                sancion,
-                tipo=sanitized.get('tipo') or db.get(SancionTipoDB, sancion.tipo_id),
-                usuario=sanitized.get('usuario') or db.get(UserDB, sancion.id_usuario),
-                prestamo=sanitized.get('prestamo') or (db.get(PrestamoDB, sancion.id_prestamo) if sancion.id_prestamo else None),
-                causa=sanitized.get('causa_obj') or (db.get(SancionCausaDB, sancion.causa_id) if sancion.causa_id else None)
-            )
-        })
-    except Exception as e:
-        db.rollback()
-        return jsonify({"ok": False, "error": f"Error al actualizar sanción: {str(e)}"}), 500
-    finally:
-        db.close()
+def _abrir_conexion_lectura(timeout_s: float):
+    """
+    Conexión del pool en modo solo lectura y con tiempo límite. Devuelve (conexion, cerrar).
+    SQLite: PRAGMA query_only y un progress handler que interrumpe la consulta al vencer el plazo
+    (cubre también la lectura de filas durante el streaming). PostgreSQL: transacción READ ONLY con
+    statement_timeout, que aplica a la consulta y a cada FETCH del cursor del servidor.
+    """
+    conexion = engine.connect()
+    if es_postgres():
+        conexion.exec_driver_sql('SET TRANSACTION READ ONLY')
+        conexion.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout_s * 1000)}')
 
+        def cerrar() -> None:
+            conexion.close()  # rollback de la transacción de solo lectura
+        return conexion, cerrar
 
-@app.delete('/api/sanciones/<sancion_id>')
-def sancion_eliminar(sancion_id: str):
-    db = SessionLocal()
+    sqlite_conn = conexion.connection.driver_connection
+    vence = time.monotonic() + timeout_s
+    sqlite_conn.set_progress_handler(lambda: 1 if time.monotonic() > vence else 0, 10000)
+    conexion.exec_driver_sql('PRAGMA query_only = ON')
+
+    def cerrar() -> None:
+        try:
+            conexion.rollback()
+            conexion.exec_driver_sql('PRAGMA query_only = OFF')
+        finally:
+            sqlite_conn.set_progress_handler(None, 0)
+            conexion.close()
+    return conexion, cerrar
+
+
+def _error_consulta(e: DBAPIError, timeout_s: float) -> str:
+    mensaje = str(e.orig)
+    if 'interrupted' in mensaje or 'statement timeout' in mensaje:
+        return f"La consulta superó el tiempo límite de {timeout_s:g} s"
+    return mensaje
+
+
+@app.post('/api/db/query')
+def db_query():
+    """
+    Ejecutar una consulta SELECT (o WITH ... SELECT) de solo lectura.
+    Body: {query, limit?}. La consulta se limita a limit filas (tope LIMITE_FILAS_CONSULTA) y a
+    TIMEOUT_CONSULTA_S segundos. Respuesta en streaming: {columnas, resultados, filas, truncado[, error]};
+    'error' aparece si el tiempo límite vence después de enviar las primeras filas.
+    No se permiten consultas sobre TABLAS_SENSIBLES ni funciones con efectos (_FUNCION_PROHIBIDA).
+    """
+    rechazo = _rechazo_explorador()
+    if rechazo:
+        return rechazo
+    data = request.get_json(silent=True) or {}
+    consulta = (data.get('query') or '').strip().rstrip(';').strip()
+    if not consulta:
+        return jsonify({"ok": False, "error": "query requerida"}), 400
+    if ';' in consulta:
+        return jsonify({"ok": False, "error": "Solo se permite una sentencia por consulta"}), 400
+    if consulta.split(None, 1)[0].lower() not in PALABRAS_CONSULTA_LECTURA:
+        return jsonify({"ok": False, "error": "Solo se permiten consultas SELECT"}), 400
+    sensible = _TABLA_SENSIBLE.search(consulta)
+    if sensible:
+        tabla = sensible.group(1).lower()
+        return jsonify({
+            "ok": False,
+            "error": f"La tabla {tabla} tiene columnas protegidas ({', '.join(TABLAS_SENSIBLES[tabla])}); "
+                     f"usa /api/db/stats/{tabla} o la API de la aplicación",
+        }), 400
+    prohibida = _FUNCION_PROHIBIDA.search(consulta)
+    if prohibida:
+        return jsonify({"ok": False, "error": f"Función no permitida en el explorador: {prohibida.group(1)}"}), 400
     try:
-        sancion = db.get(SancionDB, sancion_id)
-        if not sancion:
-            return jsonify({"ok": False, "error": "Sanción no encontrada"}), 404
-        db.delete(sancion)
-        db.commit()
-        return jsonify({"ok": True, "mensaje": "Sanción eliminada correctamente"})
+        limite = int(data.get('limit') or LIMITE_FILAS_CONSULTA)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "limit debe ser un entero"}), 400
+    limite = max(1, min(limite, LIMITE_FILAS_CONSULTA))
+    timeout_s = TIMEOUT_CONSULTA_S
+
+    # El tope se aplica en la base de datos (LIMIT limite + 1 para saber si hay más filas)
+    sql = text(f"SELECT * FROM ({consulta}) AS consulta LIMIT {limite + 1}")
+    conexion, cerrar = _abrir_conexion_lectura(timeout_s)
+    try:
+        resultado = conexion.execution_options(stream_results=True, max_row_buffer=LOTE_CONSULTA).execute(sql)
+        columnas = list(resultado.keys())
+        primeras = resultado.fetchmany(LOTE_CONSULTA)
+    except DBAPIError as e:
+        cerrar()
+        return jsonify({"ok": False, "error": _error_consulta(e, timeout_s)}), 400
     except Exception as e:
-        db.rollback()
-        return jsonify({"ok": False, "error": f"Error al eliminar sanción: {str(e)}"}), 500
-    finally:
-        db.close()
+        cerrar()
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    def generar() -> Iterator[bytes]:
+        filas = 0
+        truncado = False
+        error = None
+        separador = b''
+        try:
+            yield b'{"columnas":' + json_bytes(columnas) + b',"resultados":['
+            lote = primeras
+            while lote:
+                if filas + len(lote) > limite:
+                    lote = lote[:limite - filas]
+                    truncado = True
+                if lote:
+                    yield separador + json_bytes([
+                        {c: _valor_consulta(v) for c, v in zip(columnas, fila)} for fila in lote
+                    ])[1:-1]
+                    separador = b','
+                    filas += len(lote)
+                if truncado:
+                    break
+                try:
+                    lote = resultado.fetchmany(LOTE_CONSULTA)
+                except DBAPIError as e:
+                    error = _error_consulta(e, timeout_s)
+                    truncado = True
+                    break
+            cierre = {'filas': filas, 'truncado': truncado, 'limite': limite}
+            if error:
+                cierre['error'] = error
+            yield b'],' + json_bytes(cierre)[1:]
+        finally:
+            cerrar()
+
+    return Response(generar(), mimetype='application/json')
 
 
 def create_app():
     return app
 
 
+INDICES_REEMPLAZADOS = ('idx_prestamos_id_usuario', 'idx_waitlist_elemento_estado_creado')
+
+
 def migrar_base_datos():
     """Agrega columnas faltantes y crea tablas nuevas si no existen"""
     db = SessionLocal()
@@ -2768,6 +6197,38 @@ def migrar_base_datos():
             print("   Continuando... (se usará valor por defecto para equipos)")
             db.rollback()
         
+        # Verificar y agregar clave_grupo (agrupación materializada en libro_grupo)
+        try:
+            db.execute(text("SELECT clave_grupo FROM libros LIMIT 1"))
+        except Exception:
+            db.rollback()
+            print("Agregando columna clave_grupo a la tabla libros...")
+            db.execute(text("ALTER TABLE libros ADD COLUMN clave_grupo VARCHAR(768)"))
+            db.commit()
+            print("✓ Columna clave_grupo agregada correctamente")
+
+        # Verificar y agregar reservado_hasta (reservas de lista de espera)
+        try:
+            db.execute(text("SELECT reservado_hasta FROM waitlist LIMIT 1"))
+        except Exception:
+            db.rollback()
+            print("Agregando columna reservado_hasta a la tabla waitlist...")
+            db.execute(text("ALTER TABLE waitlist ADD COLUMN reservado_hasta TIMESTAMP"))
+            db.commit()
+            print("✓ Columna reservado_hasta agregada correctamente")
+
+        # Columnas con el identificador de usuario original (id_usuario pasa a guardar el UserDB.id)
+        for modelo, _, columna_original in REFERENCIAS_USUARIO:
+            tabla = modelo.__tablename__
+            try:
+                db.execute(text(f"SELECT {columna_original} FROM {tabla} LIMIT 1"))
+            except Exception:
+                db.rollback()
+                print(f"Agregando columna {columna_original} a la tabla {tabla}...")
+                db.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna_original} VARCHAR(128)"))
+                db.commit()
+                print(f"✓ Columna {columna_original} agregada correctamente")
+        
         # Verificar y agregar columnas al modelo UserDB si no existen
         try:
             db.execute(text("SELECT tipo_documento FROM usuarios LIMIT 1"))
@@ -2883,6 +6344,80 @@ def migrar_base_datos():
                 print("✓ Tabla libro_historial creada")
             except Exception as e:
                 print(f"Error creando tabla libro_historial: {e}")
+
+        # Crear índices declarados en los modelos (create_all no los agrega a tablas existentes)
+        for tabla in Base.metadata.sorted_tables:
+            for indice in tabla.indexes:
+                try:
+                    indice.create(bind=engine, checkfirst=True)
+                except Exception as e:
+                    print(f"Error creando índice {indice.name}: {e}")
+        # Índices reemplazados por uno con más columnas (el nuevo cubre las mismas consultas)
+        for nombre in INDICES_REEMPLAZADOS:
+            try:
+                db.execute(text(f"DROP INDEX IF EXISTS {nombre}"))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"Error eliminando índice {nombre}: {e}")
+
+        # Crear el índice de búsqueda de texto completo y poblarlo si está vacío
+        try:
+            crear_indice_busqueda(db)
+            db.commit()
+            tabla_busqueda = 'libro_busqueda' if es_postgres() else 'libros_fts'
+            vacio = db.execute(text(f"SELECT 1 FROM {tabla_busqueda} LIMIT 1")).first() is None
+            if vacio and db.execute(text("SELECT 1 FROM libros LIMIT 1")).first():
+                print("Construyendo índice de búsqueda...")
+                indexados = reconstruir_indice_busqueda(db)
+                db.commit()
+                print(f"✓ Índice de búsqueda construido ({indexados} libros)")
+        except Exception as e:
+            print(f"Error creando índice de búsqueda: {e}")
+            db.rollback()
+
+        # Registrar contadores de versión para que los workers solo hagan UPDATE al incrementarlos
+        try:
+            for nombre in (VERSION_CATALOGO, VERSION_REPORTES):
+                if db.get(VersionDatosDB, nombre) is None:
+                    db.add(VersionDatosDB(nombre=nombre, valor=0, actualizado_en=datetime.utcnow()))
+            db.commit()
+        except Exception as e:
+            print(f"Error registrando versiones de datos: {e}")
+            db.rollback()
+
+        # Construir libro_grupo si hay libros sin clave de agrupación (bases de datos anteriores)
+        try:
+            pendiente = db.execute(text("SELECT 1 FROM libros WHERE clave_grupo IS NULL LIMIT 1")).first()
+            if pendiente:
+                print("Construyendo tabla libro_grupo...")
+                grupos = reconstruir_libro_grupo(db)
+                db.commit()
+                print(f"✓ libro_grupo construida ({grupos} grupos)")
+        except Exception as e:
+            print(f"Error construyendo libro_grupo: {e}")
+            db.rollback()
+
+        # Construir el rollup diario de préstamos si está vacío (bases de datos anteriores)
+        try:
+            vacio = db.execute(text("SELECT 1 FROM estadistica_prestamo_dia LIMIT 1")).first() is None
+            if vacio and db.execute(text("SELECT 1 FROM prestamos LIMIT 1")).first():
+                print("Construyendo estadísticas diarias de préstamos...")
+                filas = reconstruir_estadistica_prestamos(db)
+                db.commit()
+                print(f"✓ estadistica_prestamo_dia construida ({filas} filas)")
+        except Exception as e:
+            print(f"Error construyendo estadísticas de préstamos: {e}")
+            db.rollback()
+
+        # Normalizar referencias a usuarios que aún no tienen identificador original
+        try:
+            tratados = normalizar_referencias_usuario(db)
+            if any(tratados.values()):
+                print(f"✓ Referencias a usuarios normalizadas: {tratados}")
+        except Exception as e:
+            print(f"Error normalizando referencias a usuarios: {e}")
+            db.rollback()
     except Exception as e:
         print(f"Error en migración: {e}")
         db.rollback()
@@ -2,12 +2,91 @@
 # -*- coding: utf-8 -*-
 """
 Script simple para explorar la base de datos BIBLIOSENA
+
+Uso:
+    python explorar_db.py            menú interactivo (SQLite)
+    python explorar_db.py --advise   revisar los planes de las consultas frecuentes de app.py
+                                     (usa DATABASE_URL si está definida, si no bibliosena.db)
 """
 import sqlite3
 import os
+import re
+import sys
 
 DB_PATH = "bibliosena.db"
 
+# Consultas frecuentes de app.py (misma forma que las del ORM) y el índice que las resuelve.
+# (nombre, sql, parámetros, {tabla: índice sugerido o nota}); la primera tabla es la que define el orden.
+# Los hallazgos cuya sugerencia es una nota (no un CREATE INDEX) se muestran pero no cuentan como problema.
+CONSULTAS_FRECUENTES = [
+    (
+        "catálogo agrupado (/api/libros?limit=)",
+        "SELECT libros.id, libros.titulo, libro_grupo.stock, libro_grupo.cantidad_disponible FROM libros "
+        "JOIN libro_grupo ON libro_grupo.id_representativo = libros.id || '' "
+        "ORDER BY libros.creado_en DESC, libros.id DESC LIMIT 50",
+        {},
+        {
+            "libros": "CREATE INDEX idx_libros_creado_en_id ON libros (creado_en, id)",
+            "libro_grupo": "CREATE INDEX idx_libro_grupo_representativo ON libro_grupo (id_representativo)",
+        },
+    ),
+    (
+        "catálogo agrupado por categoría (/api/libros?categoria=)",
+        "SELECT libros.id, libros.titulo, libro_grupo.stock FROM libros "
+        "JOIN libro_grupo ON libro_grupo.id_representativo = libros.id || '' "
+        "WHERE libros.categoria = :categoria ORDER BY libros.creado_en DESC, libros.id DESC LIMIT 50",
+        {"categoria": "Libros"},
+        {
+            "libros": "CREATE INDEX idx_libros_categoria_creado_en ON libros (categoria, creado_en, id)",
+            "libro_grupo": "CREATE INDEX idx_libro_grupo_representativo ON libro_grupo (id_representativo)",
+        },
+    ),
+    (
+        "préstamos de un usuario (/prestamos?usuario=)",
+        "SELECT * FROM prestamos WHERE id_usuario = :usuario ORDER BY creado_en DESC, id DESC LIMIT 50",
+        {"usuario": "usuario"},
+        {"prestamos": "CREATE INDEX idx_prestamos_usuario_creado_en ON prestamos (id_usuario, creado_en, id)"},
+    ),
+    (
+        "préstamos por estado (/prestamos?estado=)",
+        "SELECT * FROM prestamos WHERE estado = :estado ORDER BY creado_en DESC, id DESC LIMIT 50",
+        {"estado": "pendiente"},
+        {"prestamos": "CREATE INDEX idx_prestamos_estado_creado_en ON prestamos (estado, creado_en, id)"},
+    ),
+    (
+        "préstamos vencidos (revisar_prestamos_vencidos)",
+        "SELECT id FROM prestamos WHERE estado = 'aprobado' AND fecha_devolucion < :ahora",
+        {"ahora": "2024-01-01 00:00:00"},
+        {"prestamos": "CREATE INDEX idx_prestamos_estado_fecha_devolucion ON prestamos (estado, fecha_devolucion)"},
+    ),
+    (
+        "cabeza de la lista de espera (promover_espera)",
+        "SELECT id FROM waitlist WHERE id_elemento = :elemento AND estado = 'pendiente' "
+        "ORDER BY creado_en, id LIMIT 1",
+        {"elemento": "elemento"},
+        {"waitlist": "CREATE INDEX idx_waitlist_elemento_estado_creado_id ON waitlist (id_elemento, estado, creado_en, id)"},
+    ),
+    (
+        "bandeja de mensajes (/api/mensajes?usuario=)",
+        "SELECT * FROM mensajes WHERE id_remitente = :usuario OR id_destinatario = :usuario ORDER BY creado_en DESC",
+        {"usuario": "usuario"},
+        {"mensajes": "un OR entre columnas no se ordena con un índice; el B-tree temporal solo contiene los "
+                     "mensajes del usuario (ya filtrados por índice)"},
+    ),
+    (
+        "sanciones de un usuario (/api/sanciones?id_usuario=)",
+        "SELECT * FROM sanciones WHERE id_usuario = :usuario ORDER BY creado_en DESC",
+        {"usuario": "usuario"},
+        {"sanciones": "CREATE INDEX idx_sanciones_usuario_creado_en ON sanciones (id_usuario, creado_en)"},
+    ),
+    (
+        "sanciones por estado (/api/sanciones?estado=)",
+        "SELECT * FROM sanciones WHERE estado = :estado ORDER BY creado_en DESC",
+        {"estado": "activa"},
+        {"sanciones": "CREATE INDEX idx_sanciones_estado_creado_en ON sanciones (estado, creado_en)"},
+    ),
+]
+
 def mostrar_tablas(cursor):
     """Muestra todas las tablas disponibles"""
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
@@ -18,12 +97,30 @@ def mostrar_tablas(cursor):
         print(f"{i}. {tabla}")
     return [tabla[0] for tabla in tablas]
 
+def contar_filas(cursor, nombre_tabla, umbral_exacto=50000):
+    """Filas de una tabla sin recorrerla: sqlite_stat1 (tras ANALYZE) o max(rowid); exacto si es pequeña"""
+    estimado = None
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sqlite_stat1';")
+    if cursor.fetchone():
+        cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = ?;", (nombre_tabla,))
+        conteos = [int(stat.split()[0]) for (stat,) in cursor.fetchall() if stat and stat.split()[0].isdigit()]
+        estimado = max(conteos) if conteos else None
+    if estimado is None:
+        try:
+            cursor.execute(f'SELECT max(rowid) FROM "{nombre_tabla}";')
+            estimado = cursor.fetchone()[0] or 0
+        except sqlite3.Error:
+            estimado = None
+    if estimado is not None and estimado > umbral_exacto:
+        return estimado, True
+    cursor.execute(f'SELECT COUNT(*) FROM "{nombre_tabla}";')
+    return cursor.fetchone()[0], False
+
 def mostrar_contenido_tabla(cursor, nombre_tabla, limite=10):
     """Muestra el contenido de una tabla"""
     try:
-        cursor.execute(f"SELECT COUNT(*) FROM {nombre_tabla};")
-        total = cursor.fetchone()[0]
-        print(f"\n📊 Tabla: {nombre_tabla} ({total} registros)")
+        total, estimado = contar_filas(cursor, nombre_tabla)
+        print(f"\n📊 Tabla: {nombre_tabla} ({'~' if estimado else ''}{total} registros)")
         print("-" * 80)
         
         cursor.execute(f"SELECT * FROM {nombre_tabla} LIMIT {limite};")
@@ -96,9 +193,8 @@ def menu_principal():
             print("\n📊 ESTADÍSTICAS GENERALES:")
             print("-" * 50)
             for tabla in tablas:
-                cursor.execute(f"SELECT COUNT(*) FROM {tabla};")
-                count = cursor.fetchone()[0]
-                print(f"  {tabla:30s} : {count:>5} registros")
+                count, estimado = contar_filas(cursor, tabla)
+                print(f"  {tabla:30s} : {'~' if estimado else ' '}{count:>5} registros")
         elif opcion == 'q':
             print("\n💡 Escribe tu consulta SQL (o 'cancelar' para volver):")
             query = input("SQL> ")
@@ -116,7 +212,113 @@ def menu_principal():
     
     conn.close()
 
+def indices_existentes(conn, postgres):
+    from sqlalchemy import text
+    if postgres:
+        return set(conn.execute(text("SELECT indexname FROM pg_indexes")).scalars())
+    return set(conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+
+
+def problemas_plan_sqlite(conn, sql, params):
+    """Plan de EXPLAIN QUERY PLAN y lista de (tabla o None, problema)"""
+    from sqlalchemy import text
+    lineas = [fila[3] for fila in conn.execute(text("EXPLAIN QUERY PLAN " + sql), params)]
+    filtrada = " WHERE " in sql.upper()
+    problemas = []
+    for detalle in lineas:
+        escaneo = re.match(r"SCAN (\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX (\w+))?$", detalle)
+        if escaneo and not escaneo.group(2):
+            problemas.append((escaneo.group(1), f"recorrido completo de {escaneo.group(1)}"))
+        elif escaneo and filtrada:
+            # Recorrer un índice entero es correcto para listar en orden con LIMIT, no para filtrar
+            problemas.append((escaneo.group(1), f"recorrido completo de {escaneo.group(1)} por {escaneo.group(2)} para filtrar"))
+        elif "AUTOMATIC" in detalle:
+            tabla = detalle.split()[1]
+            problemas.append((tabla, f"índice automático (temporal) sobre {tabla}"))
+        elif "USE TEMP B-TREE" in detalle:
+            problemas.append((None, detalle.replace("USE TEMP B-TREE FOR", "B-tree temporal para").lower()))
+    return lineas, problemas
+
+
+def problemas_plan_postgres(conn, sql, params):
+    """
+    Plan de EXPLAIN con enable_seqscan/enable_sort desactivados: si aun así aparece un Seq Scan o un
+    Sort es porque ningún índice sirve (en tablas pequeñas el planificador los elegiría de todos modos)
+    """
+    from sqlalchemy import text
+    with conn.begin():
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        conn.execute(text("SET LOCAL enable_sort = off"))
+        lineas = [fila[0] for fila in conn.execute(text("EXPLAIN " + sql), params)]
+    problemas = []
+    for linea in lineas:
+        escaneo = re.search(r"Seq Scan on (\w+)", linea)
+        if escaneo:
+            problemas.append((escaneo.group(1), f"recorrido completo de {escaneo.group(1)}"))
+        elif re.search(r"->\s+Sort|^Sort", linea.strip()):
+            problemas.append((None, "ordenamiento sin índice (Sort)"))
+    return lineas, problemas
+
+
+def asesorar():
+    """Revisar los planes de CONSULTAS_FRECUENTES. Retorna 1 si alguna necesita un índice."""
+    from sqlalchemy import create_engine
+
+    url = os.environ.get("DATABASE_URL", "")
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    if not url.startswith("postgresql://"):
+        if not os.path.exists(DB_PATH):
+            print(f"❌ No se encuentra la base de datos: {DB_PATH}")
+            return 1
+        url = f"sqlite:///{DB_PATH}"
+    engine = create_engine(url, future=True)
+    postgres = engine.dialect.name == "postgresql"
+    revisar = problemas_plan_postgres if postgres else problemas_plan_sqlite
+
+    print("=" * 80)
+    print(f"🔎 PLANES DE CONSULTAS FRECUENTES ({engine.dialect.name})")
+    print("=" * 80)
+    con_problemas = 0
+    with engine.connect() as conn:
+        existentes = indices_existentes(conn, postgres)
+        for nombre, sql, params, indices in CONSULTAS_FRECUENTES:
+            try:
+                lineas, problemas = revisar(conn, sql, params)
+            except Exception as e:
+                print(f"\n❌ {nombre}: {e}")
+                con_problemas += 1
+                continue
+            print(f"\n{'⚠️ ' if problemas else '✓'} {nombre}")
+            for linea in lineas:
+                print(f"     {linea}")
+            sugeridos = []
+            for tabla, problema in problemas:
+                print(f"   ⚠️  {problema}")
+                indice = indices.get(tabla) if tabla else next(iter(indices.values()))
+                if indice and indice not in sugeridos:
+                    sugeridos.append(indice)
+            # Solo cuenta si hay un índice que proponer (o uno existente que el planificador no eligió)
+            if any(indice.startswith("CREATE INDEX") for indice in sugeridos):
+                con_problemas += 1
+            for indice in sugeridos:
+                nombre_indice = re.match(r"CREATE INDEX (\w+)", indice)
+                if nombre_indice is None:
+                    print(f"   💡 {indice}")
+                elif nombre_indice.group(1) in existentes:
+                    print(f"   💡 {nombre_indice.group(1)} ya existe y el planificador no lo eligió: ejecutar ANALYZE")
+                else:
+                    print(f"   💡 {indice};")
+    print("\n" + "=" * 80)
+    if con_problemas:
+        print(f"⚠️  {con_problemas} de {len(CONSULTAS_FRECUENTES)} consultas sin un índice adecuado")
+        return 1
+    print(f"✓ Las {len(CONSULTAS_FRECUENTES)} consultas usan índices")
+    return 0
+
 if __name__ == "__main__":
+    if "--advise" in sys.argv[1:]:
+        sys.exit(asesorar())
     menu_principal()
 
 
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Script para normalizar las referencias a usuarios (préstamos, lista de espera, favoritos y mensajes)
+Reemplaza el ID, documento o username guardado por el UserDB.id y conserva el valor original en *_original
+Procesa por lotes y se puede volver a ejecutar: solo trata las filas que aún no tienen valor original
+"""
+import os
+import sys
+
+# Agregar el directorio actual al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, Base, engine, SessionLocal, normalizar_referencias_usuario
+
+def normalizar(lote=1000):
+    """Ejecutar el backfill de referencias a usuarios"""
+    with app.app_context():
+        Base.metadata.create_all(bind=engine)
+        from app import migrar_base_datos
+        migrar_base_datos()
+
+        db = SessionLocal()
+        try:
+            tratados = normalizar_referencias_usuario(db, lote=lote)
+            for columna, total in tratados.items():
+                print(f"  {columna}: {total} filas")
+            print("✅ Referencias a usuarios normalizadas")
+            return True
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Error al normalizar referencias: {e}")
+            return False
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    normalizar(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+Script para reconstruir la tabla estadistica_prestamo_dia (rollup diario de préstamos)
+Ejecutar en bases de datos existentes o si las estadísticas quedan desincronizadas con prestamos
+"""
+import os
+import sys
+
+# Agregar el directorio actual al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, Base, engine, SessionLocal, reconstruir_estadistica_prestamos
+
+def reconstruir():
+    """Recalcular las estadísticas diarias desde toda la historia de préstamos"""
+    with app.app_context():
+        Base.metadata.create_all(bind=engine)
+        from app import migrar_base_datos
+        migrar_base_datos()
+
+        db = SessionLocal()
+        try:
+            filas = reconstruir_estadistica_prestamos(db)
+            db.commit()
+            print(f"✅ estadistica_prestamo_dia reconstruida: {filas} filas")
+            return True
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Error al reconstruir estadísticas de préstamos: {e}")
+            return False
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    reconstruir()
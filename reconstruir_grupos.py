@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+Script para reconstruir la tabla libro_grupo (copias agrupadas del catálogo)
+Ejecutar en bases de datos existentes o si los totales del catálogo quedan desincronizados
+"""
+import os
+import sys
+
+# Agregar el directorio actual al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, Base, engine, SessionLocal, reconstruir_libro_grupo
+
+def reconstruir():
+    """Recalcular clave_grupo de todos los libros y regenerar libro_grupo"""
+    with app.app_context():
+        Base.metadata.create_all(bind=engine)
+        from app import migrar_base_datos
+        migrar_base_datos()
+
+        db = SessionLocal()
+        try:
+            grupos = reconstruir_libro_grupo(db)
+            db.commit()
+            print(f"✅ libro_grupo reconstruida: {grupos} grupos")
+            return True
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Error al reconstruir libro_grupo: {e}")
+            return False
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    reconstruir()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+Script para revisar préstamos vencidos (para ejecutar desde cron u otro programador de tareas)
+Registra los préstamos aprobados con fecha de devolución vencida y, si VENCIDOS_SANCION_CAUSA
+está configurada, crea las sanciones correspondientes
+"""
+import os
+import sys
+
+# Agregar el directorio actual al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, Base, engine, SessionLocal, revisar_prestamos_vencidos
+
+def revisar():
+    """Ejecutar una revisión de préstamos vencidos"""
+    with app.app_context():
+        Base.metadata.create_all(bind=engine)
+        from app import migrar_base_datos
+        migrar_base_datos()
+
+        db = SessionLocal()
+        try:
+            resultado = revisar_prestamos_vencidos(db)
+            print(f"✅ Revisión completada: {resultado['vencidos']} vencidos nuevos, "
+                  f"{resultado['sanciones']} sanciones, {resultado['resueltos']} resueltos")
+            return True
+        except Exception as e:
+            db.rollback()
+            print(f"❌ Error al revisar préstamos vencidos: {e}")
+            return False
+        finally:
+            db.close()
+
+if __name__ == "__main__":
+    revisar()
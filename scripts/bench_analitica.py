@@ -0,0 +1,151 @@
+"""
+Benchmark de la analítica vectorizada (/api/reportes/analitica) con N préstamos.
+
+Crea una base SQLite temporal con N préstamos sobre M copias y mide:
+- carga: leer las columnas de prestamos y libros por bloques a arreglos NumPy,
+- cálculo: estadísticas sobre los arreglos ya cargados (distintos filtros),
+- referencia: las mismas estadísticas básicas con bucles de Python sobre las filas,
+- endpoint: primera petición (MISS) y repetida (HIT de cache_reportes).
+Verifica que percentiles, rotación y horas pico coinciden con la referencia.
+
+Uso:
+    python scripts/bench_analitica.py [prestamos] [copias]   (por defecto: 1000000 20000)
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+_directorio = tempfile.mkdtemp(prefix='bench_analitica_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directorio, 'analitica.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+from sqlalchemy import insert, select  # noqa: E402
+
+from app import (  # noqa: E402
+    ESTADOS_ANALITICA,
+    ZONA_HORARIA_HORAS,
+    Base,
+    LibroDB,
+    PrestamoDB,
+    SessionLocal,
+    VERSION_REPORTES,
+    app,
+    calcular_analitica,
+    cargar_datos_analitica,
+    engine,
+    incrementar_version,
+    migrar_base_datos,
+)
+
+CATEGORIAS = ['Libros', 'Equipos', 'Portátiles', 'Revistas', 'Audiovisuales']
+LOTE_INSERCION = 50_000
+
+
+def poblar(n, copias):
+    rnd = random.Random(7)
+    base = datetime(2020, 1, 1)
+    db = SessionLocal()
+    try:
+        db.execute(insert(LibroDB), [
+            dict(id=f'libro-{i}', titulo=f'Título {i // 3}', autor='Autor', categoria=CATEGORIAS[i % len(CATEGORIAS)],
+                 stock=rnd.randint(1, 3), cantidad_disponible=1, cantidad_prestado=rnd.randint(0, 1),
+                 clave_grupo=f'grupo-{i // 3}', creado_en=base, actualizado_en=base)
+            for i in range(copias)
+        ])
+        for inicio in range(0, n, LOTE_INSERCION):
+            filas = []
+            for i in range(inicio, min(n, inicio + LOTE_INSERCION)):
+                creado = base + timedelta(seconds=rnd.randint(0, 5 * 365 * 86400))
+                estado = ESTADOS_ANALITICA[rnd.randint(0, 3)]
+                devuelto = creado + timedelta(seconds=rnd.randint(3600, 30 * 86400)) if estado == 'devuelto' else None
+                filas.append(dict(
+                    id=f'prestamo-{i}', id_elemento=f'libro-{rnd.randint(0, copias - 1)}', id_usuario=f'user-{i % 5000}',
+                    fecha_prestamo=creado, fecha_devolucion=devuelto, estado=estado, creado_en=creado, actualizado_en=creado,
+                ))
+            db.execute(insert(PrestamoDB), filas)
+        incrementar_version(db, VERSION_REPORTES)
+        db.commit()
+    finally:
+        db.close()
+
+
+def referencia_python(db):
+    """Duraciones, préstamos por grupo y horas pico recorriendo las filas con bucles de Python"""
+    grupos = dict(db.execute(select(LibroDB.id, LibroDB.clave_grupo)).all())
+    duraciones = []
+    por_grupo = Counter()
+    por_hora = [0] * 24
+    desfase = timedelta(hours=ZONA_HORARIA_HORAS)
+    for id_elemento, estado, creado, prestado, devuelto in db.execute(select(
+        PrestamoDB.id_elemento, PrestamoDB.estado, PrestamoDB.creado_en, PrestamoDB.fecha_prestamo,
+        PrestamoDB.fecha_devolucion,
+    ).execution_options(yield_per=50_000)):
+        if estado == 'devuelto' and devuelto:
+            duraciones.append((devuelto - prestado).total_seconds() / 86400)
+        if estado != 'rechazado' and id_elemento in grupos:
+            por_grupo[grupos[id_elemento]] += 1
+        por_hora[(creado + desfase).hour] += 1
+    duraciones.sort()
+    return duraciones, por_grupo, por_hora
+
+
+def medir(funcion, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    copias = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    Base.metadata.create_all(bind=engine)
+    migrar_base_datos()
+    print(f"Poblando {n} préstamos sobre {copias} copias...")
+    poblar(n, copias)
+
+    db = SessionLocal()
+    try:
+        datos, t_carga = medir(cargar_datos_analitica, db, 0)
+        tracemalloc.start()
+        cargar_datos_analitica(db, 0)
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        resultado, t_calculo = medir(calcular_analitica, datos, top=10)
+        _, t_filtrado = medir(calcular_analitica, datos, desde=datetime(2023, 1, 1), categoria='Equipos', top=10)
+        (duraciones, por_grupo, por_hora), t_python = medir(referencia_python, db)
+    finally:
+        db.close()
+
+    # Los resultados vectorizados deben coincidir con la referencia
+    general = resultado['duracion_dias']['general']
+    assert general['cantidad'] == len(duraciones)
+    esperado = np.percentile(np.array(duraciones), 90)
+    assert abs(general['p90'] - round(float(esperado), 2)) < 0.011, (general['p90'], esperado)
+    assert resultado['horas_pico']['por_hora'] == por_hora
+    for titulo in resultado['rotacion_titulos']:
+        assert titulo['prestamos'] == por_grupo[f"grupo-{titulo['titulo'].split()[-1]}"]
+
+    cliente = app.test_client()
+    _, t_miss = medir(cliente.get, '/api/reportes/analitica')
+    respuesta, t_hit = medir(cliente.get, '/api/reportes/analitica')
+    assert respuesta.headers['X-Cache'] == 'HIT'
+
+    print(f"{'paso':<40}{'tiempo (s)':>12}")
+    print(f"{'carga a NumPy (' + str(n) + ' filas)':<40}{t_carga:>12.2f}")
+    print(f"{'cálculo vectorizado':<40}{t_calculo:>12.3f}")
+    print(f"{'cálculo con filtros':<40}{t_filtrado:>12.3f}")
+    print(f"{'referencia con bucles de Python':<40}{t_python:>12.2f}")
+    print(f"{'endpoint (MISS: carga + cálculo)':<40}{t_miss:>12.2f}")
+    print(f"{'endpoint (HIT)':<40}{t_hit:>12.4f}")
+    print(f"memoria pico de la carga: {pico / 1024 / 1024:.1f} MB")
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+Benchmark de la importación Aleph (/import/csv) de N filas sobre un catálogo de M libros.
+
+Crea una base SQLite temporal con M libros y un CSV Aleph de N ejemplares (la mitad de copias de
+libros del catálogo, el resto de títulos nuevos repetidos varias veces) y mide:
+- importación: POST /import/csv completo (precarga de claves, acumulación y upsert por lotes),
+- referencia: la consulta por fila que hacía el importador anterior (LibroDB por isbn+titulo+editorial),
+  medida sobre las primeras filas y extrapolada a N.
+Verifica que el stock total aumenta en N y que los libros nuevos son los títulos distintos del archivo.
+Las portadas quedan pendientes (PORTADA_PENDIENTE): programar_portadas se reemplaza para no generarlas aquí.
+
+Uso:
+    python scripts/bench_importacion_aleph.py [filas] [catalogo]   (por defecto: 100000 50000)
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+_directorio = tempfile.mkdtemp(prefix='bench_importacion_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directorio, 'importacion.db')
+os.environ.setdefault('MAX_CONTENT_LENGTH', str(256 * 1024 * 1024))  # El CSV de 100k filas supera los 8 MB por defecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from datetime import datetime  # noqa: E402
+
+from sqlalchemy import func, insert  # noqa: E402
+
+import app as modulo_app  # noqa: E402
+from app import (  # noqa: E402
+    Base,
+    LibroDB,
+    SessionLocal,
+    app,
+    clave_grupo,
+    engine,
+    migrar_base_datos,
+    reconstruir_libro_grupo,
+)
+
+FILAS_REFERENCIA = 5000
+LOTE_INSERCION = 10_000
+
+
+def poblar(catalogo):
+    ahora = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        for inicio in range(0, catalogo, LOTE_INSERCION):
+            filas = []
+            for i in range(inicio, min(catalogo, inicio + LOTE_INSERCION)):
+                libro = LibroDB(
+                    id=f'libro-{i:07d}', titulo=f'Título {i}', autor=f'Autor {i % 500}', isbn=f'978{i:07d}',
+                    editorial=f'Editorial {i % 50}', categoria='Libros', stock=1, cantidad_disponible=1,
+                    cantidad_prestado=0, imagen='/uploads/portada.jpg', creado_en=ahora, actualizado_en=ahora,
+                )
+                filas.append({c.name: getattr(libro, c.name) for c in LibroDB.__table__.columns} | {'clave_grupo': clave_grupo(libro)})
+            db.execute(insert(LibroDB), filas)
+        reconstruir_libro_grupo(db)
+        db.commit()
+    finally:
+        db.close()
+
+
+def generar_csv(filas, catalogo):
+    """(bytes del CSV, títulos nuevos distintos, filas de muestra como tuplas isbn/titulo/editorial)"""
+    rnd = random.Random(11)
+    lineas = ['ISBN;Autor;Título;Subtítulo;Editor;Fecha;Descripción;Código de barras']
+    nuevos = set()
+    muestra = []
+    for n in range(filas):
+        if n % 2 == 0:
+            i = rnd.randrange(catalogo)
+            isbn, titulo, editorial = f'978{i:07d}', f'Título {i}', f'Editorial {i % 50}'
+        else:
+            j = rnd.randrange(filas // 8)
+            isbn, titulo, editorial = f'979{j:07d}', f'Nuevo título {j}', 'Editorial nueva'
+            nuevos.add(isbn)
+        lineas.append(f'{isbn};Autor {n % 300};{titulo};;{editorial};2015;Descripción {n};BC{n:08d}')
+        if len(muestra) < FILAS_REFERENCIA:
+            muestra.append((isbn, titulo, editorial))
+    return ('\r\n'.join(lineas) + '\r\n').encode('latin-1'), len(nuevos), muestra
+
+
+def referencia_por_fila(db, muestra):
+    """La búsqueda que el importador anterior hacía por cada fila Aleph"""
+    for isbn, titulo, editorial in muestra:
+        db.query(LibroDB).filter(LibroDB.isbn == isbn).filter(LibroDB.titulo == titulo, LibroDB.editorial == editorial).first()
+
+
+def main():
+    filas = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    catalogo = int(sys.argv[2]) if len(sys.argv) > 2 else 50_000
+    Base.metadata.create_all(bind=engine)
+    migrar_base_datos()
+    modulo_app.programar_portadas = lambda *args, **kwargs: None
+    print(f"Poblando catálogo de {catalogo} libros...")
+    poblar(catalogo)
+    contenido, titulos_nuevos, muestra = generar_csv(filas, catalogo)
+
+    db = SessionLocal()
+    try:
+        inicio = time.perf_counter()
+        referencia_por_fila(db, muestra)
+        t_referencia = (time.perf_counter() - inicio) * filas / len(muestra)
+        stock_antes = db.query(func.sum(LibroDB.stock)).scalar()
+    finally:
+        db.close()
+
+    cliente = app.test_client()
+    inicio = time.perf_counter()
+    respuesta = cliente.post(
+        '/import/csv', data={'file': (io.BytesIO(contenido), 'aleph.csv')}, content_type='multipart/form-data',
+    )
+    t_importacion = time.perf_counter() - inicio
+    datos = respuesta.get_json()
+    assert respuesta.status_code == 200, (respuesta.status_code, respuesta.data[:300])
+
+    db = SessionLocal()
+    try:
+        assert db.query(func.sum(LibroDB.stock)).scalar() == stock_antes + filas
+        assert db.query(LibroDB).count() == catalogo + titulos_nuevos
+    finally:
+        db.close()
+    assert datos['creados'] == titulos_nuevos and datos['creados'] + datos['actualizados'] == filas
+
+    print(f"{'paso':<52}{'tiempo (s)':>12}")
+    print(f"{'importación (' + str(filas) + ' filas, ' + str(datos['creados']) + ' libros nuevos)':<52}{t_importacion:>12.2f}")
+    print(f"{'referencia: consulta por fila (estimado para N)':<52}{t_referencia:>12.2f}")
+    print(f"filas por segundo: {filas / t_importacion:,.0f}")
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
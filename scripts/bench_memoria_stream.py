@@ -0,0 +1,120 @@
+"""
+Mide la memoria pico de los listados en streaming (/api/libros, /prestamos, /api/mensajes,
+/api/usuarios, /espera) y de las exportaciones CSV/XLSX con distintos tamaños de resultado.
+
+Crea una base SQLite temporal, inserta N filas por tabla y recorre cada respuesta sin acumularla,
+midiendo el pico con tracemalloc. Con streaming el pico debe mantenerse estable al pasar de 10k a 100k filas.
+
+Uso:
+    python scripts/bench_memoria_stream.py [filas ...]   (por defecto: 10000 100000)
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+_directorio = tempfile.mkdtemp(prefix='bench_stream_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directorio, 'bench.db')
+# Sin copia para la caché del catálogo: se mide solo el streaming
+os.environ.setdefault('MAX_BYTES_CACHE_STREAM', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import delete, insert  # noqa: E402
+
+from app import (  # noqa: E402
+    Base,
+    LibroDB,
+    LibroGrupoDB,
+    MensajeDB,
+    PrestamoDB,
+    SessionLocal,
+    UserDB,
+    VERSION_CATALOGO,
+    WaitlistDB,
+    app,
+    engine,
+    incrementar_version,
+    reconstruir_libro_grupo,
+)
+
+RUTAS = [
+    '/api/libros', '/prestamos', '/api/mensajes?admin=true', '/api/usuarios', '/espera',
+    '/api/exportar/prestamos', '/api/exportar/libros?formato=xlsx',
+]
+LOTE_INSERCION = 5000
+
+
+def poblar(n):
+    """Reemplaza el contenido de las tablas medidas por n filas cada una"""
+    base = datetime(2024, 1, 1)
+    db = SessionLocal()
+    try:
+        for modelo in (LibroGrupoDB, LibroDB, PrestamoDB, MensajeDB, UserDB, WaitlistDB):
+            db.execute(delete(modelo))
+        for inicio in range(0, n, LOTE_INSERCION):
+            libros, prestamos, mensajes, usuarios, espera = [], [], [], [], []
+            for i in range(inicio, min(n, inicio + LOTE_INSERCION)):
+                fecha = base + timedelta(seconds=i)
+                libros.append(dict(
+                    id=f'libro-{i}', titulo=f'Título {i}', autor='Autor', isbn=f'978{i:010d}', categoria='Libros',
+                    descripcion='Descripción', estado_disponibilidad='Disponible', estado_elemento='Buen estado',
+                    stock=1, cantidad_disponible=1, cantidad_prestado=0, codigo_inventario=f'INV-{i}',
+                    creado_en=fecha, actualizado_en=fecha,
+                ))
+                prestamos.append(dict(
+                    id=str(uuid.uuid4()), id_elemento=f'libro-{i}', id_usuario=f'user-{i}', fecha_prestamo=fecha,
+                    estado='devuelto', creado_en=fecha, actualizado_en=fecha,
+                ))
+                mensajes.append(dict(
+                    id=str(uuid.uuid4()), id_remitente=f'user-{i}', id_destinatario='admin', asunto='Consulta',
+                    contenido='Mensaje de prueba', leido=0, tipo='consulta', creado_en=fecha, actualizado_en=fecha,
+                ))
+                usuarios.append(dict(
+                    id=f'user-{i}', nombre=f'Aprendiz {i}', documento=str(10_000_000 + i), username=f'u{i}',
+                    password='x', role='user', creado_en=fecha, actualizado_en=fecha,
+                ))
+                espera.append(dict(
+                    id=str(uuid.uuid4()), id_elemento=f'libro-{i}', id_usuario=f'user-{i}', contacto=f'user-{i}',
+                    estado='pendiente', creado_en=fecha, actualizado_en=fecha,
+                ))
+            for modelo, filas in ((LibroDB, libros), (PrestamoDB, prestamos), (MensajeDB, mensajes),
+                                  (UserDB, usuarios), (WaitlistDB, espera)):
+                db.execute(insert(modelo), filas)
+        reconstruir_libro_grupo(db)
+        incrementar_version(db, VERSION_CATALOGO)
+        db.commit()
+    finally:
+        db.close()
+
+
+def medir(cliente, ruta):
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    respuesta = cliente.get(ruta, buffered=False)
+    total = 0
+    for fragmento in respuesta.response:
+        total += len(fragmento)
+    respuesta.close()
+    transcurrido = time.perf_counter() - inicio
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return total, pico, transcurrido
+
+
+def main():
+    tamanos = [int(a) for a in sys.argv[1:]] or [10_000, 100_000]
+    Base.metadata.create_all(bind=engine)
+    cliente = app.test_client()
+    print(f"{'ruta':<36}{'filas':>9}{'bytes':>14}{'pico (MB)':>12}{'tiempo (s)':>12}")
+    for n in tamanos:
+        poblar(n)
+        for ruta in RUTAS:
+            total, pico, transcurrido = medir(cliente, ruta)
+            print(f"{ruta:<36}{n:>9}{total:>14}{pico / 1024 / 1024:>12.1f}{transcurrido:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
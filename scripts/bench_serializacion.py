@@ -0,0 +1,127 @@
+"""
+Micro-benchmark de serialización JSON de las respuestas de la API.
+
+Compara, para N filas de cada modelo, el camino anterior (dict con isoformat() + 'Z' y json.dumps
+ordenando claves, como hacía jsonify por defecto) con los esquemas precompilados + json_bytes.
+
+Uso:
+    python scripts/bench_serializacion.py [filas]
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Base de datos en memoria: el benchmark no toca bibliosena.db
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import (  # noqa: E402
+    ESQUEMA_LIBRO,
+    ESQUEMA_MENSAJE,
+    ESQUEMA_PRESTAMO,
+    ESQUEMA_SANCION,
+    ESQUEMA_USUARIO,
+    LibroDB,
+    MensajeDB,
+    PrestamoDB,
+    SancionDB,
+    UserDB,
+    json_bytes,
+    orjson,
+)
+
+
+def iso(valor):
+    return valor.isoformat() + 'Z' if valor else None
+
+
+def generar(modelo, n):
+    base = datetime(2024, 1, 1, 10, 0, 0)
+    filas = []
+    for i in range(n):
+        fecha = base + timedelta(minutes=i)
+        if modelo is LibroDB:
+            obj = LibroDB(
+                id=f'libro-{i}', titulo=f'Título {i}', autor='Autor Ñandú', isbn=f'978{i:010d}',
+                editorial='SENA', anio_publicacion=2020, categoria='Libros', subcategoria='Ingeniería',
+                descripcion='Descripción de prueba con acentos: canción', estado_disponibilidad='disponible',
+                estado_elemento='bueno', stock=3, cantidad_disponible=2, cantidad_prestado=1,
+                imagen=f'/uploads/portada_{i}.jpg', codigo_inventario=f'INV-{i}', creado_en=fecha, actualizado_en=fecha,
+            )
+        elif modelo is PrestamoDB:
+            obj = PrestamoDB(
+                id=f'prestamo-{i}', id_elemento=f'libro-{i}', id_usuario=f'user-{i % 100}', fecha_prestamo=fecha,
+                fecha_devolucion=fecha + timedelta(days=8), observaciones=None, estado='activo',
+                creado_en=fecha, actualizado_en=fecha,
+            )
+        elif modelo is UserDB:
+            obj = UserDB(
+                id=f'user-{i}', nombre=f'Aprendiz {i}', documento=str(1000000 + i), correo=f'u{i}@sena.edu.co',
+                username=f'u{i}', password='x', role='user', creado_en=fecha, actualizado_en=fecha,
+            )
+        elif modelo is MensajeDB:
+            obj = MensajeDB(
+                id=f'mensaje-{i}', id_remitente='admin', id_destinatario=f'user-{i % 100}', asunto='Recordatorio',
+                contenido='Su préstamo vence mañana', leido=0, relacionado_con=f'prestamo-{i}', tipo='info',
+                creado_en=fecha, actualizado_en=fecha,
+            )
+        else:
+            obj = SancionDB(
+                id=f'sancion-{i}', tipo_id='tipo-1', id_usuario=f'user-{i % 100}', id_prestamo=f'prestamo-{i}',
+                causa_id=None, causa='retraso', observaciones=None, estado='activa', fecha_inicio=fecha,
+                fecha_fin=fecha + timedelta(days=3), resuelto_en=None, usuario_registro='admin',
+                creado_en=fecha, actualizado_en=fecha,
+            )
+        filas.append(obj)
+    return filas
+
+
+def camino_anterior(esquema, filas):
+    items = []
+    for obj in filas:
+        item = {}
+        for campo in esquema.campos + esquema.opcionales:
+            valor = getattr(obj, campo, None)
+            item[campo] = iso(valor) if isinstance(valor, datetime) else valor
+        items.append(item)
+    return (json.dumps(items, sort_keys=True, ensure_ascii=True) + '\n').encode('utf-8')
+
+
+def camino_nuevo(esquema, filas):
+    return json_bytes([esquema(obj) for obj in filas])
+
+
+def medir(funcion, *args, repeticiones=5):
+    mejor = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(*args)
+        transcurrido = time.perf_counter() - inicio
+        mejor = transcurrido if mejor is None else min(mejor, transcurrido)
+    return mejor
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print(f"Codificador: {'orjson ' + orjson.__version__ if orjson else 'json (biblioteca estándar)'}")
+    print(f"{'modelo':<12}{'filas':>8}{'anterior (ms)':>16}{'nuevo (ms)':>14}{'mejora':>9}")
+    casos = [
+        ('libros', LibroDB, ESQUEMA_LIBRO),
+        ('prestamos', PrestamoDB, ESQUEMA_PRESTAMO),
+        ('usuarios', UserDB, ESQUEMA_USUARIO),
+        ('mensajes', MensajeDB, ESQUEMA_MENSAJE),
+        ('sanciones', SancionDB, ESQUEMA_SANCION),
+    ]
+    for nombre, modelo, esquema in casos:
+        filas = generar(modelo, n)
+        # Ambos caminos deben producir el mismo documento
+        assert json.loads(camino_anterior(esquema, filas)) == json.loads(camino_nuevo(esquema, filas))
+        anterior = medir(camino_anterior, esquema, filas)
+        nuevo = medir(camino_nuevo, esquema, filas)
+        print(f"{nombre:<12}{n:>8}{anterior * 1000:>16.1f}{nuevo * 1000:>14.1f}{anterior / nuevo:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Comprueba cuántas consultas SQL ejecuta GET /api/libros.
+
+Crea una base SQLite temporal con libros agrupados por código de inventario, por título/autor/ISBN,
+grupos sin ISBN (NULL) y copias sueltas; lista el catálogo completo (streaming) y una página con
+limit, crece el catálogo y repite. El número de consultas debe ser el mismo en ambos tamaños:
+la versión del catálogo más una consulta de grupos.
+
+Uso:
+    python scripts/contar_consultas_catalogo.py [filas]   (por defecto: 2000; se mide con filas/10 y filas)
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+_directorio = tempfile.mkdtemp(prefix='consultas_catalogo_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directorio, 'catalogo.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, insert  # noqa: E402
+
+from app import (  # noqa: E402
+    VERSION_CATALOGO, Base, LibroDB, SessionLocal, app, clave_grupo, engine, incrementar_version, recalcular_grupos,
+)
+
+CONSULTAS_ESPERADAS = 2  # versión del catálogo + grupos unidos a su copia representativa
+
+
+def poblar(desde, hasta):
+    """
+    Agrega las filas [desde, hasta). Cada bloque de 8 filas forma 4 grupos: 2 copias con el mismo código
+    de inventario, 3 copias con título/autor/ISBN iguales, 2 copias sin ISBN y 1 copia suelta sin ISBN.
+    Retorna las copias esperadas por clave de grupo.
+    """
+    base = datetime(2024, 1, 1)
+    libros, copias = [], {}
+    for i in range(desde, hasta):
+        bloque, posicion = divmod(i, 8)
+        libro = dict(
+            id=f'libro-{i:06d}', titulo=f'Título {bloque}', autor='Autor', isbn=None, categoria='Libros',
+            stock=1, cantidad_disponible=1, cantidad_prestado=0,
+            creado_en=base + timedelta(seconds=i), actualizado_en=base + timedelta(seconds=i),
+        )
+        if posicion < 2:
+            libro['codigo_inventario'] = f'INV-{bloque}'
+        elif posicion < 5:
+            libro['isbn'] = f'978{bloque:010d}'
+        elif posicion < 7:
+            libro['titulo'] = f'Sin ISBN {bloque}'
+        else:
+            libro['titulo'] = f'Suelto {bloque}'
+        libro['clave_grupo'] = clave_grupo(LibroDB(**libro))
+        copias[libro['clave_grupo']] = copias.get(libro['clave_grupo'], 0) + 1
+        libros.append(libro)
+    db = SessionLocal()
+    try:
+        db.execute(insert(LibroDB), libros)
+        recalcular_grupos(db, copias)
+        incrementar_version(db, VERSION_CATALOGO)
+        db.commit()
+    finally:
+        db.close()
+    return copias
+
+
+def contar(cliente, url):
+    sentencias = []
+
+    def registrar(*args):
+        sentencias.append(args[2])
+
+    event.listen(engine, 'before_cursor_execute', registrar)
+    try:
+        respuesta = cliente.get(url)
+        datos = respuesta.get_json()
+    finally:
+        event.remove(engine, 'before_cursor_execute', registrar)
+    assert respuesta.status_code == 200, respuesta.status_code
+    assert respuesta.headers.get('X-Cache') == 'MISS', 'la respuesta salió de la caché'
+    return datos, len(sentencias)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    Base.metadata.create_all(bind=engine)
+    cliente = app.test_client()
+
+    copias = {}
+    medidas = []
+    for desde, hasta in ((0, n // 10), (n // 10, n)):
+        copias.update(poblar(desde, hasta))
+        items, consultas = contar(cliente, '/api/libros')
+        pagina, consultas_pagina = contar(cliente, '/api/libros?limit=50')
+        print(f"libros: {hasta}  grupos: {len(items)}  consultas: {consultas} (página: {consultas_pagina})")
+
+        assert len(items) == len(copias), f'se esperaban {len(copias)} grupos'
+        assert sum(item['stock'] for item in items) == hasta, 'los totales de los grupos no suman el stock'
+        assert any(item['isbn'] and item['stock'] == 3 for item in items), 'grupo por ISBN ausente'
+        assert any(item['titulo'].startswith('Sin ISBN') and item['stock'] == 2 for item in items), 'grupo sin ISBN ausente'
+        assert any(item['titulo'].startswith('Suelto') and item['stock'] == 1 for item in items), 'copia suelta ausente'
+        assert len(pagina['items']) == min(50, len(items)) and bool(pagina['next_cursor']) == (len(items) > 50)
+        medidas.append((consultas, consultas_pagina))
+
+    assert medidas[0] == medidas[1], f'el número de consultas depende del tamaño del catálogo: {medidas}'
+    assert max(medidas[0]) <= CONSULTAS_ESPERADAS, f'se esperaban como máximo {CONSULTAS_ESPERADAS} consultas'
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Comprueba cuántas consultas SQL ejecuta GET /prestamos.
+
+Crea una base SQLite temporal con N préstamos (referenciando al usuario por ID, documento o username),
+cuenta las sentencias emitidas al listar y verifica que el número no depende de N:
+una consulta de préstamos más una de usuarios y una de elementos por lote.
+
+Uso:
+    python scripts/contar_consultas_prestamos.py [filas]   (por defecto: 2500)
+"""
+import math
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+_directorio = tempfile.mkdtemp(prefix='consultas_prestamos_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directorio, 'prestamos.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event, insert  # noqa: E402
+
+from app import LOTE_STREAM_JSON, Base, LibroDB, PrestamoDB, SessionLocal, UserDB, app, engine  # noqa: E402
+
+
+def poblar(n):
+    base = datetime(2024, 1, 1)
+    usuarios, libros, prestamos = [], [], []
+    for i in range(n):
+        fecha = base + timedelta(seconds=i)
+        usuarios.append(dict(
+            id=f'user-{i}', nombre=f'Aprendiz {i}', documento=str(10_000_000 + i), username=f'u{i}',
+            password='x', role='user', creado_en=fecha, actualizado_en=fecha,
+        ))
+        libros.append(dict(
+            id=f'libro-{i}', titulo=f'Título {i}', autor='Autor', categoria='Libros', stock=1,
+            cantidad_disponible=0, cantidad_prestado=1, creado_en=fecha, actualizado_en=fecha,
+        ))
+        referencia = (f'user-{i}', str(10_000_000 + i), f'u{i}')[i % 3]
+        prestamos.append(dict(
+            id=f'prestamo-{i}', id_elemento=f'libro-{i}', id_usuario=referencia, fecha_prestamo=fecha,
+            estado='pendiente', creado_en=fecha, actualizado_en=fecha,
+        ))
+    db = SessionLocal()
+    try:
+        db.execute(insert(UserDB), usuarios)
+        db.execute(insert(LibroDB), libros)
+        db.execute(insert(PrestamoDB), prestamos)
+        db.commit()
+    finally:
+        db.close()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2500
+    Base.metadata.create_all(bind=engine)
+    poblar(n)
+
+    sentencias = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: sentencias.append(args[2]))
+    items = app.test_client().get('/prestamos?estado=pendiente').get_json()
+
+    lotes = math.ceil(n / LOTE_STREAM_JSON)
+    esperado = 1 + 2 * lotes
+    print(f"préstamos: {len(items)}  consultas: {len(sentencias)}  esperado: {esperado} ({lotes} lotes)")
+    assert len(items) == n
+    assert all(item['usuario'] and item['elemento'] for item in items), 'préstamo sin usuario o elemento'
+    assert all(item['usuario']['id'] == f"user-{item['id'].split('-')[1]}" for item in items)
+    assert len(sentencias) <= esperado, f'se esperaban como máximo {esperado} consultas'
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
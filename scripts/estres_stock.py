@@ -0,0 +1,139 @@
+"""
+Prueba de estrés de la aprobación de préstamos desde varios procesos.
+
+Crea un elemento con pocas unidades y muchas solicitudes pendientes. Luego lanza varios procesos que
+aprueban las mismas solicitudes, en distinto orden y a la vez, y verifica que:
+- se aprueban exactamente tantas solicitudes como unidades había,
+- cantidad_disponible nunca queda en negativo (se muestrea mientras corren los procesos),
+- los totales de la copia y de libro_grupo coinciden con los préstamos aprobados.
+
+Por defecto usa una base SQLite temporal. Para probar contra PostgreSQL (varios workers reales),
+definir DATABASE_URL apuntando a una base de pruebas vacía.
+
+Uso:
+    python scripts/estres_stock.py [procesos] [unidades] [solicitudes]   (por defecto: 8 5 200)
+"""
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not os.environ.get('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='estres_stock_'), 'estres.db')
+sys.path.insert(0, RAIZ)
+
+ELEMENTO = 'estres-elemento'
+
+
+def preparar(unidades, solicitudes):
+    from sqlalchemy import delete, insert
+    from app import (
+        Base, LibroDB, PrestamoDB, SessionLocal, clave_grupo, engine, migrar_base_datos, recalcular_grupos,
+    )
+
+    Base.metadata.create_all(bind=engine)
+    migrar_base_datos()
+    ahora = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        db.execute(delete(PrestamoDB).where(PrestamoDB.id_elemento == ELEMENTO))
+        db.execute(delete(LibroDB).where(LibroDB.id == ELEMENTO))
+        libro = LibroDB(
+            id=ELEMENTO, titulo='Elemento de estrés', autor='Prueba', categoria='Libros', stock=unidades,
+            cantidad_disponible=unidades, cantidad_prestado=0, estado_disponibilidad='Disponible',
+            creado_en=ahora, actualizado_en=ahora,
+        )
+        libro.clave_grupo = clave_grupo(libro)
+        db.add(libro)
+        db.execute(insert(PrestamoDB), [
+            dict(id=f'estres-{i}', id_elemento=ELEMENTO, id_usuario=f'estres-user-{i}', fecha_prestamo=ahora,
+                 estado='pendiente', creado_en=ahora, actualizado_en=ahora)
+            for i in range(solicitudes)
+        ])
+        recalcular_grupos(db, [libro.clave_grupo])
+        db.commit()
+    finally:
+        db.close()
+
+
+def aprobar(semilla, solicitudes, inicio, resultados):
+    from app import app
+
+    ids = [f'estres-{i}' for i in range(solicitudes)]
+    random.Random(semilla).shuffle(ids)
+    cliente = app.test_client()
+    conteo = {}
+    inicio.wait()
+    for prestamo_id in ids:
+        codigo = cliente.put(f'/prestamos/{prestamo_id}/aprobar').status_code
+        conteo[codigo] = conteo.get(codigo, 0) + 1
+    resultados.put(conteo)
+
+
+def muestrear(detener, minimo):
+    from app import LibroDB, SessionLocal
+
+    while not detener.is_set():
+        db = SessionLocal()
+        try:
+            disponible = db.get(LibroDB, ELEMENTO).cantidad_disponible
+        finally:
+            db.close()
+        with minimo.get_lock():
+            minimo.value = min(minimo.value, disponible)
+        time.sleep(0.005)
+
+
+def main():
+    procesos = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    unidades = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    solicitudes = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    preparar(unidades, solicitudes)
+
+    ctx = multiprocessing.get_context('spawn')
+    inicio = ctx.Event()
+    detener = ctx.Event()
+    resultados = ctx.Queue()
+    minimo = ctx.Value('i', unidades)
+    muestreo = ctx.Process(target=muestrear, args=(detener, minimo))
+    trabajadores = [ctx.Process(target=aprobar, args=(n, solicitudes, inicio, resultados)) for n in range(procesos)]
+    muestreo.start()
+    for t in trabajadores:
+        t.start()
+    time.sleep(1)  # dar tiempo a que todos importen la app antes de arrancar
+    inicio.set()
+    conteo = {}
+    for _ in trabajadores:
+        for codigo, cantidad in resultados.get().items():
+            conteo[codigo] = conteo.get(codigo, 0) + cantidad
+    for t in trabajadores:
+        t.join()
+    detener.set()
+    muestreo.join()
+
+    from app import LibroDB, LibroGrupoDB, PrestamoDB, SessionLocal
+    db = SessionLocal()
+    try:
+        libro = db.get(LibroDB, ELEMENTO)
+        grupo = db.get(LibroGrupoDB, libro.clave_grupo)
+        aprobados = db.query(PrestamoDB).filter(
+            PrestamoDB.id_elemento == ELEMENTO, PrestamoDB.estado == 'aprobado'
+        ).count()
+        print(f"respuestas: {dict(sorted(conteo.items()))}")
+        print(f"aprobados: {aprobados}  disponible: {libro.cantidad_disponible}  prestado: {libro.cantidad_prestado}  "
+              f"grupo: {grupo.cantidad_disponible}/{grupo.cantidad_prestado}  mínimo observado: {minimo.value}")
+        assert minimo.value >= 0, 'cantidad_disponible quedó en negativo'
+        assert conteo.get(200, 0) == aprobados == unidades, 'se aprobaron más (o menos) préstamos que unidades'
+        assert libro.cantidad_disponible == 0 and libro.cantidad_prestado == unidades
+        assert grupo.cantidad_disponible == 0 and grupo.cantidad_prestado == unidades
+        print('OK')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()